@@ -1,6 +1,8 @@
 import pygame
 import sys
 
+from game.settings import TEXTURE_SIZE
+
 
 def get_playermodel_spritesheet():
     try:
@@ -32,6 +34,16 @@ def get_door_side_texture():
         return door_side
 
 
+def get_floor_texture(name):
+    # Floors and ceilings use the first texture of a wall texture sheet
+    try:
+        texture_sheet = pygame.image.load('../textures/walls/{}.png'.format(name)).convert()
+    except pygame.error as loading_error:
+        sys.exit(loading_error)
+    else:
+        return texture_sheet.subsurface(0, 0, TEXTURE_SIZE, TEXTURE_SIZE)
+
+
 def get_tile_values_info(enemy_info):
     try:
         # Wall textures
@@ -67,21 +79,23 @@ def get_tile_values_info(enemy_info):
         sys.exit(loading_error)
 
     else:
-        from game.settings import TEXTURE_SIZE
-
         class Tile:
             def __init__(self, texture, type, description):
                 self.texture = texture
                 self.type = type
                 self.desc = description
+                self.light = False  # True for lamps, see bake_light_map() in main.py
 
-        def assign_texture_sheet(texture_sheet, type, description, cell_w=TEXTURE_SIZE, cell_h=TEXTURE_SIZE, step=1):
+        def assign_texture_sheet(texture_sheet, type, description, cell_w=TEXTURE_SIZE, cell_h=TEXTURE_SIZE, step=1,
+                                 lights=()):
+            # lights are (column, row) cells of texture sheet that are lamps
             global index  # Sets current index as staring index
             for row in range(int(texture_sheet.get_height() / cell_h)):
                 for column in range(int(texture_sheet.get_width() / cell_w)):
                     texture = texture_sheet.subsurface(column * cell_w, row * cell_h, cell_w, cell_h)
                     tile_values_info[index] = Tile(texture, type,
                                                    description)  # Update tile_values_info with Tile object
+                    tile_values_info[index].light = (column, row) in lights
                     index += step
 
         # tile_values_info texture assigning can happen manually and via assign_texture_sheet()
@@ -99,15 +113,15 @@ def get_tile_values_info(enemy_info):
         # Dynamic objects
         assign_texture_sheet(dynamics, 'Object', 'Dynamic', step=-1)
 
-        # Other non-solid objects
-        assign_texture_sheet(nonsolids, 'Object', 'Non-solid', step=-1)
+        # Other non-solid objects, chandelier and ceiling lamp are lamps
+        assign_texture_sheet(nonsolids, 'Object', 'Non-solid', step=-1, lights=((5, 1), (6, 1)))
 
         # ---Positive values---
-        # Solid objects
+        # Solid objects, floor lamp is a lamp
         index = 1
         tile_values_info[index] = Tile(exploding_barrel, 'Object', 'Explosive')
         index += 1
-        assign_texture_sheet(solids, 'Object', 'Solid')
+        assign_texture_sheet(solids, 'Object', 'Solid', lights=((4, 0),))
 
         # Doors
         assign_texture_sheet(dynamic_doors, 'Door', 'Dynamic', cell_w=TEXTURE_SIZE * 2)
@@ -3,7 +3,6 @@
 # Make boss health bar update() func and add it to update_gameobjects()
 # Replace self.sound-s with ExplodingBarrel-somund etc
 # Fix level restart drawing system
-# Max draw dist system
 # Better portal/weapon system
 # Quitting from YOU DIED doesnt shut down properly
 # BOSSES
@@ -60,8 +59,7 @@ class Player:
     def __init__(self, pos, angle):
         self.x, self.y = pos
         self.viewangle = angle
-        self.dir_x = cos(self.viewangle)
-        self.dir_y = sin(self.viewangle)
+        self.update_direction()
         self.hp = Player.max_hp
         self.ammo = 20
         self.has_key = False
@@ -81,6 +79,13 @@ class Player:
     def rotate(self, radians):
         self.viewangle = fixed_angle(self.viewangle + radians)
 
+    def update_direction(self):
+        # Direction vector and camera plane vector, which is perpendicular to it (see CameraPlane)
+        self.dir_x = cos(self.viewangle)
+        self.dir_y = sin(self.viewangle)
+        self.plane_x = -self.dir_y * CAMERA_PLANE.len
+        self.plane_y = self.dir_x * CAMERA_PLANE.len
+
     def hurt(self, damage, damage_source=None):  # If damage source not given, player must've shot himself
         EFFECTS.update(Colour.red)
         self.hp -= damage
@@ -93,8 +98,7 @@ class Player:
     def handle_movement(self):
         # Checks for movement (WASD)
         keys_pressed = pygame.key.get_pressed()
-        self.dir_x = cos(self.viewangle)
-        self.dir_y = sin(self.viewangle)
+        self.update_direction()
         old_pos = (self.x, self.y)
 
         if keys_pressed:
@@ -247,6 +251,7 @@ class Door:
                     TILEMAP[self.y][self.x] = 0  # Make tile walkable
                     self.closed_state = 0
                     self.state += 1
+                update_tile_offset(self.x, self.y, self.closed_state)
 
             elif self.state == 2:  # Staying open
                 self.start_closing_if_needed()
@@ -258,6 +263,7 @@ class Door:
                 if self.closed_state >= 1:
                     self.closed_state = 1
                     self.state = 0
+                update_tile_offset(self.x, self.y, self.closed_state)
 
 
 class BossDoor(Door):
@@ -330,14 +336,19 @@ class PushWall:
             self.tile_offset += self.speed
             if self.tile_offset >= 1:
                 self.tile_offset = 0
+                update_tile_offset(self.x, self.y, 0)
                 TILEMAP[self.y][self.x] = 0  # Make tile walkable
                 EMPTY_TILES.add((self.x, self.y))
                 PUSH_WALL_TILES.remove((self.x, self.y))
+                update_tilemap_arrays(self.x, self.y)
                 self.x += self.move_dir_x
                 self.y += self.move_dir_y
                 TILEMAP[self.y][self.x] = self.value  # Make tile non-walkable
                 EMPTY_TILES.remove((self.x, self.y))
                 PUSH_WALL_TILES.add((self.x, self.y))
+                update_tilemap_arrays(self.x, self.y)
+            else:
+                update_tile_offset(self.x, self.y, self.tile_offset)
 
 
 class ThinWall:
@@ -372,6 +383,16 @@ class Portal:
     def set_other_portal(self, portal):
         self.other_portal = portal
 
+    def is_in_front(self, x, y):
+        # True if (x, y) is on the side of the wall the portal faces, only things there can be seen through it
+        if self.vertical:
+            offset = x - self.center_x
+        else:
+            offset = y - self.center_y
+        if self.side:
+            return offset >= 0
+        return offset <= 0
+
     def create_portal(self):
         #         non-vertical
         #           side = 0
@@ -382,7 +403,7 @@ class Portal:
         #          ---------
         #         non-vertical
         #           side = 1
-        collison_x, collison_y = raycast((PLAYER.x, PLAYER.y), PLAYER.viewangle)
+        collison_x, collison_y = raycast((PLAYER.x, PLAYER.y), (PLAYER.dir_x, PLAYER.dir_y))
 
         if collison_x == int(collison_x):
             vertical = True
@@ -415,6 +436,7 @@ class Portal:
                     vertical != self.other_portal.vertical or \
                     side != self.other_portal.side:
                 self.created = True
+                update_tiles_version()
                 self.map_x = map_x
                 self.map_y = map_y
                 self.vertical = vertical
@@ -434,6 +456,24 @@ class Portal:
                         self.center_y = self.map_y
 
 
+class PortalView:
+    # What rays see after going through the same chain of portals more than once, see get_deep_portal_views()
+    # A point at (x, y) in front of exit_portal is seen at (origin_x, origin_y) + (x, y) rotated back by rayangle_diff
+    # Sprites seen through it are clipped against its depth_array like sprites are clipped against a ColumnLayer's,
+    # the depth buffer only has the columns of the view and is 0 everywhere else
+    def __init__(self, exit_portal, rayangle_diff, origin_x, origin_y, portal_depth):
+        self.exit_portal = exit_portal
+        self.rayangle_diff = rayangle_diff
+        self.origin_x = origin_x
+        self.origin_y = origin_y
+        self.portal_depth = portal_depth
+        self.depth_array = np.zeros(R_W)
+
+    def get_clone_pos(self, x, y):
+        delta_x, delta_y = rotated((x, y), add_rayangle_diffs(0.0, -self.rayangle_diff))
+        return self.origin_x + delta_x, self.origin_y + delta_y
+
+
 class WeaponModel:
     channel_id = 1
     switch_ticks = 6  # Needs to be even number
@@ -463,7 +503,8 @@ class WeaponModel:
             bullet_x_pos = H_W + x_spread
             damage_multiplier = 1
             for sprite in shootable_things:
-                if sprite.start_x < bullet_x_pos < sprite.end_x:
+                if sprite.start_x < bullet_x_pos < sprite.end_x and \
+                        sprite.perp_dist < sprite.walls.depth_array[bullet_x_pos]:  # Not behind a wall at bullet column
                     if not max_range_squared or sprite.dist_squared < max_range_squared:
                         if sprite.hp:
                             hit = True
@@ -591,104 +632,732 @@ class Message:
         DISPLAY.blit(message, (HUD_SAFEZONE, draw_y))
 
 
-class CameraPlane:
-    def __init__(self, fov):
-        # Creates a list of rayangle offsets which will be added to player's viewangle when sending rays every frame
-        # Bc these offsets do not change during the game, they are calculated before the game starts
-        # Offsets are calculated so that each ray will be equal distance away from previous ray on the camera plane
-        # Of course in 2D rendering camera plane is actually a line
-        # FOV has to be < pi (and not <= pi) for it to work properly
-        # Also calculates camera plane's distance to later calculate sprite's display_pos
+class WallResGovernor:
+    # Changes WALL_RES between frames to keep frames inside the tick budget of CLOCK.tick(30)
+    # Sending rays and drawing are the stages that scale with the amount of wall columns, so when frames take too long
+    # WALL_RES goes up, and it comes back down once the frame estimated for the lower WALL_RES fits comfortably
+    # Different thresholds and a cooldown after every change keep it from jumping back and forth
+    budget = 1 / 30  # Seconds every frame has to fit in
+    raise_threshold = 0.9  # Fraction of budget average frame time has to go over for WALL_RES to go up
+    lower_threshold = 0.6  # Fraction of budget estimated frame time at lower WALL_RES has to fit in to go down
+    min_saved_share = 0.5  # Share of the time over raise threshold that going up has to save, see update()
+    smoothing = 0.1  # Weight of the latest frame in averages
+    cooldown_frames = 30  # Frames to wait after every change before measuring again
 
-        self.rayangle_offsets = []
+    def __init__(self):
+        self.min_wall_res = WALL_RES
+        self.frame_time = 0  # Average time a frame takes, without waiting for the next tick
+        self.column_time = 0  # Average time of send_rays() and draw_frame()
+        self.cooldown = WallResGovernor.cooldown_frames
+
+    def update(self, frame_time, column_time):
+        global WALL_RES
+        if self.cooldown:
+            self.cooldown -= 1
+            self.frame_time = frame_time
+            self.column_time = column_time
+            return
+        self.frame_time += (frame_time - self.frame_time) * WallResGovernor.smoothing
+        self.column_time += (column_time - self.column_time) * WallResGovernor.smoothing
+
+        new_wall_res = WALL_RES
+        overrun = self.frame_time - WallResGovernor.budget * WallResGovernor.raise_threshold
+        if overrun > 0:
+            # Column stages would take WALL_RES / (WALL_RES + 1) of their time, WALL_RES only goes up if that saves
+            # a real part of the overrun, frames slowed down by sprites, enemies or the HUD keep their walls
+            saved_time = self.column_time / (WALL_RES + 1)
+            if WALL_RES < MAX_WALL_RES and saved_time >= overrun * WallResGovernor.min_saved_share:
+                new_wall_res = WALL_RES + 1
+        elif WALL_RES > self.min_wall_res:
+            # Column stages would take WALL_RES / (WALL_RES - 1) times longer
+            estimated_time = self.frame_time + self.column_time / (WALL_RES - 1)
+            if estimated_time < WallResGovernor.budget * WallResGovernor.lower_threshold:
+                new_wall_res = WALL_RES - 1
+
+        if new_wall_res != WALL_RES:
+            WALL_RES = new_wall_res
+            self.cooldown = WallResGovernor.cooldown_frames
 
-        camera_plane_len = 1
-        camera_plane_start = -camera_plane_len / 2
-        camera_plane_step = camera_plane_len / D_W
 
-        self.dist = camera_plane_len / 2 / tan(fov / 2)
-        for x in range(D_W):
-            camera_plane_pos = camera_plane_start + x * camera_plane_step
+class CameraPlane:
+    # Every ray is sent in direction PLAYER.dir + PLAYER.plane * camera_x, where camera_x goes from -1 to 1 across
+    # the display, so no trigonometry is needed per ray
+    # Camera plane is perpendicular to the direction vector and its length is tan(fov / 2), so that rays cover the FOV
+    # Rays are spread equal distance away from each other on the camera plane
+    # Ray direction vectors aren't normalized, so the distance a ray travels in ray direction lengths is the
+    # perpendicular distance from the camera plane, which is what wall height is calculated from
+    # FOV has to be < pi (and not <= pi) for it to work properly
 
-            angle = atan2(camera_plane_pos, self.dist)
-            self.rayangle_offsets.append(angle)
+    def __init__(self, fov):
+        self.len = tan(fov / 2)
+        self.camera_x = [2 * x / R_W - 1 for x in range(R_W)]
+        self.camera_x_array = np.array(self.camera_x)  # Used by the vectorized raycaster
 
 
 class Drawable:
     def calc_cropping_height(self):
-        if self.height > D_H:
+        if self.height > R_H:
             # Based on image height, get cropping_height
             # Adjust height if cropping_height < TEXTURE_SIZE
 
             # Calculate how much of height is needed
             # Calculate the ideal cropping height
             # Calculate the actual cropping height which will be the closest even number rounding up perfect_height
-            amount_of_height_needed = D_H / self.height
+            amount_of_height_needed = R_H / self.height
             perfect_height = TEXTURE_SIZE * amount_of_height_needed
             self.cropping_height = ceil(perfect_height / 2) * 2
             if self.cropping_height < TEXTURE_SIZE:
-                self.height = int(self.cropping_height / perfect_height * D_H)
+                self.height = int(self.cropping_height / perfect_height * R_H)
         else:
             self.cropping_height = TEXTURE_SIZE
 
 
-class WallColumn(Drawable):
-    def __init__(self, delta_x, delta_y, texture, column):
-        self.perp_dist = delta_x * PLAYER.dir_x + delta_y * PLAYER.dir_y
-        self.height = int(Drawable.constant / self.perp_dist)
-        self.calc_cropping_height()
-        self.image = texture.subsurface((column, (TEXTURE_SIZE - self.cropping_height) / 2, 1, self.cropping_height))
-        self.display_x = DISPLAY_X
-        self.display_y = int((D_H - self.height) / 2)
+class TextureStrips:
+    # Every wall-like texture pre-split into 1 pixel wide columns for every cropping height a wall column can use
+    # Strips of a cropping height are built the first time it's drawn and kept, so drawing a wall column doesn't
+    # have to create any new subsurfaces and loading doesn't pay for cropping heights that are never seen
+    # Cropping height is always an even number from 2 to TEXTURE_SIZE (see Drawable.calc_cropping_height())
+    # Columns shorter than half TEXTURE_SIZE use mip levels, textures halved level times (see get_mip_level())
+    # Cropping only happens to columns taller than the view, so mip level strips are always whole columns
+    # Every texture and mip level also gets darker variants for distance shading (see Shading)
+    # Columns of see-through textures are sorted into transparent, opaque and mixed ones for every mip level,
+    # and textures with opaque columns get a copy without alpha for drawing them (see ColumnLayer.use_opacity())
+    transparent = 0
+    opaque = 1
+    mixed = 2
+
+    def __init__(self, textures):
+        self.texture_ids = {}  # Texture surface -> texture id
+        self.textures = []  # textures[texture_id] is the texture surface
+        self.strips = []  # strips[texture_id][cropping_height // 2 - 1][column], None until first used
+        self.mips = []  # mips[texture_id][level - 1] is the texture at mip level
+        self.mip_strips = []  # mip_strips[texture_id][level - 1][column >> level]
+        self.shades = []  # shades[texture_id][shade - 1][level] is the texture at mip level in shade
+        self.alpha = []  # alpha[texture_id] is True if texture has per pixel alpha
+        self.column_opacity = []  # column_opacity[texture_id][level][column >> level]
+        self.opaque_ids = []  # opaque_ids[texture_id] is the texture id of its copy without alpha
+        for texture in textures:
+            self.add(texture)
+        self.opacity = np.array(self.column_opacity)  # Same as column_opacity, for indexing with arrays
+
+    def add(self, texture):
+        if texture in self.texture_ids:
+            return
+        self.texture_ids[texture] = len(self.strips)
+        self.textures.append(texture)
+        self.alpha.append(bool(texture.get_flags() & SRCALPHA))
+
+        self.strips.append([None] * (TEXTURE_SIZE // 2))
+
+        mips = get_mip_chain(texture)
+        self.mips.append(mips)
+        self.mip_strips.append(
+            [[mip.subsurface((column, 0, 1, mip.get_height())) for column in range(mip.get_width())] for mip in mips]
+        )
+        self.shades.append(
+            [[SHADING.shade(level_texture, shade) for level_texture in [texture] + mips]
+             for shade in range(1, SHADING.levels + 1)] if SHADING else []
+        )
+
+        # Alpha is averaged into mip levels, so every level has its own opacities
+        # Mip levels are narrower, opacities past their width stay mixed
+        texture_id = self.texture_ids[texture]
+        alpha = self.alpha[texture_id]
+        opacity = np.full((MIP_LEVELS + 1, texture.get_width()),
+                          TextureStrips.mixed if alpha else TextureStrips.opaque, dtype=np.int8)
+        if alpha:
+            for level, level_texture in enumerate([texture] + mips):
+                texel_alpha = pygame.surfarray.array_alpha(level_texture)
+                opacity[level, :level_texture.get_width()][(texel_alpha == 255).all(axis=1)] = TextureStrips.opaque
+                opacity[level, :level_texture.get_width()][(texel_alpha == 0).all(axis=1)] = TextureStrips.transparent
+        self.column_opacity.append(opacity)
+        self.opaque_ids.append(texture_id)
+        if alpha and (opacity == TextureStrips.opaque).any():
+            opaque_texture = texture.convert()
+            self.add(opaque_texture)
+            self.opaque_ids[texture_id] = self.texture_ids[opaque_texture]
+
+    def get_texture(self, texture_id, level=0, shade=0):
+        if shade:
+            return self.shades[texture_id][shade - 1][level]
+        if level:
+            return self.mips[texture_id][level - 1]
+        return self.textures[texture_id]
+
+    def get(self, texture_id, column, cropping_height, level=0, shade=0):
+        if shade:
+            # Splitting shades into strips would take too many subsurfaces, they are only needed when scaling
+            texture = self.shades[texture_id][shade - 1][level]
+            if level:
+                return texture.subsurface((column >> level, 0, 1, texture.get_height()))
+            return texture.subsurface((column, (TEXTURE_SIZE - cropping_height) // 2, 1, cropping_height))
+        if level:
+            return self.mip_strips[texture_id][level - 1][column >> level]
+        strips = self.strips[texture_id][cropping_height // 2 - 1]
+        if strips is None:
+            strips = self.add_strips(texture_id, cropping_height)
+        return strips[column]
+
+    def add_strips(self, texture_id, cropping_height):
+        texture = self.textures[texture_id]
+        top = (TEXTURE_SIZE - cropping_height) / 2
+        strips = [texture.subsurface((column, top, 1, cropping_height)) for column in range(texture.get_width())]
+        self.strips[texture_id][cropping_height // 2 - 1] = strips
+        return strips
+
+
+class MipMaps:
+    # Mip levels of sprite spritesheets, made for whole parent surfaces so that every frame of a spritesheet
+    # at (x, y, w, h) is at (x, y, w, h) >> level of the spritesheet's mip level
+    # Spritesheets are added at load, anything else (like fogged frames) gets its mip levels when first drawn
+    def __init__(self):
+        self.mips = weakref.WeakKeyDictionary()  # Parent surface -> [mip level 1, mip level 2, ...]
+
+    def add(self, surface):
+        parent = surface.get_abs_parent()
+        mips = self.mips.get(parent)
+        if mips is None:
+            mips = self.mips[parent] = get_mip_chain(parent)
+        return mips
+
+    def get(self, image, frame_rect, level):
+        # Returns frame_rect part of image at mip level
+        offset_x, offset_y = image.get_abs_offset()
+        x, y, w, h = frame_rect
+        if not level:
+            return image.subsurface(frame_rect)
+        return self.add(image)[level - 1].subsurface(
+            ((offset_x + x) >> level, (offset_y + y) >> level, w >> level, h >> level)
+        )
+
+
+class ScaledSpriteCache:
+    # LRU cache of whole sprite frames scaled to their on-screen size, shared by every kind of sprite
+    # Sprites are only cropped to their visible columns when blitting, so the same scaled frame is used
+    # no matter how much of the sprite is hidden
+    # Frames are scaled from the mip level that matches their on-screen size
+    def __init__(self, max_bytes, max_width):
+        self.max_bytes = max_bytes
+        self.max_width = max_width  # Wider sprites are scaled every time, they are mostly off screen anyway
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.frames = OrderedDict()  # (parent surface, frame rect in parent, size) -> scaled frame, least recently used first
+
+    def get(self, image, frame_rect, size):
+        # Returns frame_rect part of image scaled to size
+        # Frames are keyed by their parent surface, because subsurfaces of the same frame can be new every frame
+        offset_x, offset_y = image.get_abs_offset()
+        x, y, w, h = frame_rect
+        key = (image.get_abs_parent(), (offset_x + x, offset_y + y, w, h), size)
+        scaled_frame = self.frames.get(key)
+        if scaled_frame is not None:
+            self.hits += 1
+            self.frames.move_to_end(key)
+            return scaled_frame
+
+        self.misses += 1
+        level = get_mip_level(h, size[1])
+        scaled_frame = pygame.transform.scale(MIPMAPS.get(image, frame_rect, level), size)
+        self.frames[key] = scaled_frame
+        self.bytes += size[0] * size[1] * scaled_frame.get_bytesize()
+        while self.bytes > self.max_bytes and self.frames:
+            _, dropped_frame = self.frames.popitem(last=False)
+            self.bytes -= dropped_frame.get_width() * dropped_frame.get_height() * dropped_frame.get_bytesize()
+        return scaled_frame
+
+
+class FloorCaster:
+    # Textured floor, and ceiling when the sky isn't shown, calculated for the whole view with array math
+    # Floor row y shows the floor at the perpendicular distance where a wall's bottom edge would be on row y,
+    # so every floor pixel is at PLAYER pos + that distance * ray direction of its column
+    # Ceiling rows mirror floor rows, so they are at the same world positions
+    # Only pixels below the wall in their column are cast, and they are written straight into VIEW
+    # Texels are sampled for every WALL_RES-th column and repeated for the columns between them, like walls
+
+    def __init__(self, floor_texture, ceiling_texture=None):
+        self.floor_texels = self.map_texels(floor_texture)
+        self.ceiling_texels = None
+        if ceiling_texture:
+            self.ceiling_texels = self.map_texels(ceiling_texture)
+        self.rows = np.arange(H_H, R_H)
+        self.row_dists = (Drawable.constant / (2 * self.rows + 1 - R_H)).astype(np.float32)
+
+    def map_texels(self, texture):
+        return pygame.surfarray.array2d(texture.convert(VIEW)).reshape(-1)
+
+    def get_first_rows(self):
+        # First floor row below the wall of every pixel column, same heights as ColumnLayer.finish() gives walls
+        # Columns without a wall in WALLS (portals and rays that missed) get floor from the horizon down
+        depth = WALLS.depth_array
+        height = (Drawable.constant / np.where(depth > 0, depth, inf)).astype(np.int64)
+        return np.clip(((R_H - height) / 2).astype(np.int64) + height, H_H, R_H)
 
     def draw(self):
-        DISPLAY.blit(pygame.transform.scale(self.image, (WALL_RES, self.height)), (self.display_x, self.display_y))
+        # Arrays are indexed [row, column] like VIEW's pixels are laid out in memory
+        # Every wall column covers WALL_RES pixel columns, so every WALL_RES-th column ends its wall on the same row
+        first_rows = self.get_first_rows()[::WALL_RES]
+        first_row = first_rows.min()
+        if first_row >= R_H:
+            return
+        # Everything is in texels instead of tiles and in float32, it's a lot of pixels
+        camera_x = CAMERA_PLANE.camera_x_array[::WALL_RES].astype(np.float32)
+        ray_dir_x = (PLAYER.dir_x + PLAYER.plane_x * camera_x) * TEXTURE_SIZE
+        ray_dir_y = (PLAYER.dir_y + PLAYER.plane_y * camera_x) * TEXTURE_SIZE
+        row_dists = self.row_dists[first_row - H_H:, None]
+        if (R_H - first_rows).sum() * 2 > first_rows.size * (R_H - first_row):
+            # Picking out the uncovered pixels costs about as much as casting half of the pixels below first_row,
+            # so when walls cover less than that, every pixel below first_row is cast and walls are drawn over them
+            uncovered = Ellipsis
+        else:
+            uncovered = self.rows[first_row - H_H:, None] >= first_rows
+            row_dists = np.broadcast_to(row_dists, uncovered.shape)[uncovered]
+            ray_dir_x = np.broadcast_to(ray_dir_x, uncovered.shape)[uncovered]
+            ray_dir_y = np.broadcast_to(ray_dir_y, uncovered.shape)[uncovered]
+        # TEXTURE_SIZE is a power of two, so texels wrap around with a bitwise and, which is a lot faster than %
+        texel_x = (PLAYER.x * TEXTURE_SIZE + ray_dir_x * row_dists).astype(np.int32)
+        texel_x &= TEXTURE_SIZE - 1
+        texel_y = (PLAYER.y * TEXTURE_SIZE + ray_dir_y * row_dists).astype(np.int32)
+        texel_y &= TEXTURE_SIZE - 1
+        texel_x *= TEXTURE_SIZE
+        texel_x += texel_y  # Index to flattened texels
+
+        pixels = pygame.surfarray.pixels2d(VIEW).T
+        self.write(pixels[first_row:], uncovered, self.floor_texels.take(texel_x))
+        if self.ceiling_texels is not None:
+            self.write(pixels[R_H - first_row - 1::-1], uncovered, self.ceiling_texels.take(texel_x))
+        del pixels
+
+    def write(self, pixels, uncovered, texels):
+        # Writes texels of every cast column into the WALL_RES pixel columns it covers
+        for x_offset in range(WALL_RES):
+            columns = pixels[:, x_offset::WALL_RES]
+            width = columns.shape[1]
+            if uncovered is Ellipsis:
+                columns[:] = texels[:, :width]
+            elif width < uncovered.shape[1]:
+                # Last cast column is partly outside the view
+                in_view = np.broadcast_to(np.arange(uncovered.shape[1]) < width, uncovered.shape)
+                columns[uncovered[:, :width]] = texels[in_view[uncovered]]
+            else:
+                columns[uncovered] = texels
+
+
+class TintedFrames:
+    # LRU cache of sprite frame copies blended some amount of the way to colour
+    max_frames = 256
+
+    def __init__(self, colour):
+        self.colour = colour
+        self.frames = OrderedDict()  # (parent surface, frame rect in parent, amount) -> tinted frame
+
+    def get(self, image, frame_rect, amount, cache=True):
+        # Returns frame_rect part of image blended amount (from 0 to 1) of the way to colour
+        offset_x, offset_y = image.get_abs_offset()
+        x, y, w, h = frame_rect
+        key = (image.get_abs_parent(), (offset_x + x, offset_y + y, w, h), amount)
+        frame = self.frames.get(key)
+        if frame is not None:
+            self.frames.move_to_end(key)
+            return frame
+
+        frame = image.subsurface(frame_rect).copy()
+        frame.fill([round(255 * (1 - amount))] * 3, special_flags=BLEND_RGB_MULT)
+        if any(self.colour):
+            frame.fill([round(value * amount) for value in self.colour], special_flags=BLEND_RGB_ADD)
+        if cache:
+            self.frames[key] = frame
+            if len(self.frames) > TintedFrames.max_frames:
+                self.frames.popitem(last=False)
+        return frame
+
+
+class Fog:
+    # Walls, floors and sprites fade into colour between start and end distance
+    # Anything further than start is on the band of rows around the horizon that a wall at start distance covers,
+    # so walls and floors are fogged with one blit of a fog band with per pixel alpha after walls are drawn
+    # Sprites get fogged copies of their frames with the fog amount rounded to one of levels
+
+    def __init__(self, start, end, colour, levels=8):
+        self.start = start
+        self.end = end
+        self.colour = colour
+        self.levels = levels
+        half_height = min(ceil(Drawable.constant / start / 2) + 1, H_H)
+        self.top = H_H - half_height
+        self.rows = np.arange(self.top, H_H + half_height)
+
+        # Fog on rows without a wall, rows above the horizon are as far away as the floor rows they mirror
+        row_dist = Drawable.constant / np.abs(2 * self.rows + 1 - R_H)
+        self.row_alpha = (self.get_amount(row_dist) * 255).astype(np.uint8)
+
+        self.band = pygame.Surface((R_W, self.rows.size), SRCALPHA)
+        self.band.fill(colour)
+        self.frames = TintedFrames(colour)
+
+    def get_amount(self, dist):
+        # From 0 (no fog) to 1 (only fog)
+        return np.clip((dist - self.start) / (self.end - self.start), 0, 1)
+
+    def get_level(self, dist):
+        return min(max(ceil((dist - self.start) / (self.end - self.start) * self.levels), 0), self.levels)
+
+    def draw(self, walls):
+        # Fogs band rows of the 3D view, walls is the ColumnLayer that has been drawn
+        depth = walls.depth_array
+        height = (Drawable.constant / np.where(depth > 0, depth, inf)).astype(np.int64)
+        wall_top = ((R_H - height) / 2).astype(np.int64)[:, None]
+        on_wall = (self.rows >= wall_top) & (self.rows < wall_top + height[:, None])
+        wall_alpha = (self.get_amount(depth) * 255).astype(np.uint8)[:, None]
+        alpha = pygame.surfarray.pixels_alpha(self.band)
+        alpha[:] = np.where(on_wall, wall_alpha, self.row_alpha)
+        del alpha
+        VIEW.blit(self.band, (0, self.top))
+
+    def get_frame(self, image, frame_rect, level, cache=True):
+        # Returns frame_rect part of image blended level / levels of the way to fog colour
+        return self.frames.get(image, frame_rect, level / self.levels, cache)
+
+
+class Shading:
+    # Walls and sprites get darker with distance, in levels steps down to darkest brightness at dist
+    # Shade 0 is the texture itself, shades are picked per wall column and per sprite, never per pixel
+    # Light shades from LIGHT_MAP darken things further on top of distance (see bake_light_map())
+    # Without dist there's no distance shading and only light shades are used
+    # Wall textures get every shade at load (see TextureStrips), sprites get shaded copies of their frames
+    def __init__(self, levels, dist, darkest):
+        self.levels = levels
+        self.dist = dist
+        self.brightness = [1 - shade / levels * (1 - darkest) for shade in range(levels + 1)]
+        self.frames = TintedFrames(Colour.black)
+
+    def get_shade(self, dist, light_shade=0):
+        shade = int(dist / self.dist * self.levels) if self.dist else 0
+        return min(shade + light_shade, self.levels)
+
+    def get_shades(self, dists, light_shades=0):
+        # get_shade() for an array of distances
+        if self.dist:
+            shades = (dists / self.dist * self.levels).astype(np.int32)
+        else:
+            shades = np.zeros(dists.shape, dtype=np.int32)
+        return np.minimum(shades + light_shades, self.levels)
+
+    def shade(self, surface, shade):
+        # Returns a darker copy of surface
+        shaded_surface = surface.copy()
+        shaded_surface.fill([round(255 * self.brightness[shade])] * 3, special_flags=BLEND_RGB_MULT)
+        return shaded_surface
+
+    def get_frame(self, image, frame_rect, shade, cache=True):
+        # Returns frame_rect part of image in shade
+        return self.frames.get(image, frame_rect, 1 - self.brightness[shade], cache)
+
+
+class ColumnLayer:
+    # Every wall column of one drawing layer stored as a struct of arrays, allocated once and reused every frame
+    # Columns can be added in any order, finish() sorts them by display_x and calculates their heights
+    # See-through layers only have opaque columns in their depth buffer (see use_opacity())
+    # Columns are blitted one by one, writing all of them into a pygame.surfarray pixel array with numpy indexing
+    # was tried and takes over twice as long for a full screen of walls
+    fields = ('display_x', 'perp_dist', 'texture_id', 'column', 'face_x', 'face_y', 'face_vertical', 'light_shade',
+              'height', 'cropping_height', 'display_y', 'shade')
+
+    def __init__(self, size, see_through=False):
+        self.size = size
+        self.see_through = see_through
+        self.count = 0  # Columns in use, only the first count values of every field array are valid
+        self.display_x = np.zeros(size, dtype=np.int32)
+        self.perp_dist = np.zeros(size)
+        self.texture_id = np.zeros(size, dtype=np.int32)
+        self.column = np.zeros(size, dtype=np.int32)
+        # Hit tile side, face_x is -1 if the column can't be merged into a span (see merge_wall_spans())
+        self.face_x = np.zeros(size, dtype=np.int32)
+        self.face_y = np.zeros(size, dtype=np.int32)
+        self.face_vertical = np.zeros(size, dtype=bool)
+        self.light_shade = np.zeros(size, dtype=np.int32)  # From LIGHT_MAP, see bake_light_map()
+        # Calculated in finish()
+        self.height = np.zeros(size, dtype=np.int64)
+        self.cropping_height = np.zeros(size, dtype=np.int64)
+        self.display_y = np.zeros(size, dtype=np.int64)
+        self.shade = np.zeros(size, dtype=np.int32)
+        # Depth buffer, perp_dist at every pixel column, 0 where there's no wall and inf where the ray missed
+        self.depth_array = np.zeros(R_W)
+        self.missed = np.zeros(R_W, dtype=bool)  # Pixel columns of rays that missed past MAX_DRAW_DIST
+
+    def clear(self):
+        self.count = 0
+        self.missed[:] = False
+
+    def grow(self):
+        for name in ColumnLayer.fields:
+            array = getattr(self, name)
+            setattr(self, name, np.concatenate((array, np.zeros_like(array))))
+        self.size *= 2
+
+    def add(self, delta_x, delta_y, texture, column, face=None, light_shade=0):
+        # Adds a column at DISPLAY_X
+        if self.count == self.size:
+            self.grow()
+        i = self.count
+        self.display_x[i] = DISPLAY_X
+        self.perp_dist[i] = delta_x * PLAYER.dir_x + delta_y * PLAYER.dir_y
+        self.texture_id[i] = TEXTURE_STRIPS.texture_ids[texture]
+        self.column[i] = column
+        self.light_shade[i] = light_shade
+        if face:
+            self.face_x[i], self.face_y[i], self.face_vertical[i] = face
+        else:
+            self.face_x[i] = -1
+        self.count += 1
+
+    def add_many(self, display_x, perp_dist, texture_id, column, face_x, face_y, face_vertical, light_shade=0):
+        # Adds a column for every value in the given arrays
+        while self.count + len(display_x) > self.size:
+            self.grow()
+        added = slice(self.count, self.count + len(display_x))
+        self.display_x[added] = display_x
+        self.perp_dist[added] = perp_dist
+        self.texture_id[added] = texture_id
+        self.column[added] = column
+        self.face_x[added] = face_x
+        self.face_y[added] = face_y
+        self.face_vertical[added] = face_vertical
+        self.light_shade[added] = light_shade
+        self.count += len(display_x)
+
+    def add_missed(self, display_xs):
+        # Marks columns at display_xs as seen into the distance, nothing is hidden behind them
+        for x_offset in range(WALL_RES):
+            x = np.asarray(display_xs) + x_offset
+            self.missed[x[x < R_W]] = True
+
+    def copy_columns(self, first, end, display_xs):
+        # Adds copies of columns from first to end at every display_x in display_xs
+        for display_x in display_xs:
+            while self.count + end - first > self.size:
+                self.grow()
+            added = slice(self.count, self.count + end - first)
+            for name in ColumnLayer.fields:
+                array = getattr(self, name)
+                array[added] = array[first:end]
+            self.display_x[added] = display_x
+            self.count += end - first
+
+    def finish(self):
+        count = self.count
+        order = np.argsort(self.display_x[:count], kind='stable')
+        for name in ('display_x', 'perp_dist', 'texture_id', 'column', 'face_x', 'face_y', 'face_vertical',
+                     'light_shade'):
+            array = getattr(self, name)
+            array[:count] = array[:count][order]
+
+        # Same as Drawable.calc_cropping_height() for every column at once
+        perp_dist = self.perp_dist[:count]
+        height = (Drawable.constant / perp_dist).astype(np.int64)
+        cropping_height = np.full(count, TEXTURE_SIZE, dtype=np.int64)
+        too_tall = np.flatnonzero(height > R_H)
+        if too_tall.size:
+            perfect_height = TEXTURE_SIZE * (R_H / height[too_tall])
+            cropping_height[too_tall] = np.ceil(perfect_height / 2).astype(np.int64) * 2
+            cropped = cropping_height[too_tall] < TEXTURE_SIZE
+            height[too_tall[cropped]] = \
+                (cropping_height[too_tall[cropped]] / perfect_height[cropped] * R_H).astype(np.int64)
+        self.height[:count] = height
+        self.cropping_height[:count] = cropping_height
+        if self.see_through:
+            opaque = self.use_opacity()
+            count = self.count
+            perp_dist = self.perp_dist[:count]
+        self.display_y[:count] = ((R_H - self.height[:count]) / 2).astype(np.int64)
+        if SHADING:
+            self.shade[:count] = SHADING.get_shades(perp_dist, self.light_shade[:count])
+
+        # Every column covers WALL_RES pixel columns
+        self.depth_array[:] = 0
+        if self.see_through:
+            # Only opaque columns hide what's behind them, where columns overlap the closest one is kept
+            self.depth_array[:] = inf
+            for x_offset in range(WALL_RES):
+                x = self.display_x[opaque] + x_offset
+                on_screen = x < R_W
+                np.minimum.at(self.depth_array, x[on_screen], self.perp_dist[opaque][on_screen])
+            self.depth_array[self.depth_array == inf] = 0
+            return
+        for x_offset in range(WALL_RES):
+            x = self.display_x[:count] + x_offset
+            on_screen = x < R_W
+            self.depth_array[x[on_screen]] = perp_dist[on_screen]
+        self.depth_array[self.missed & (self.depth_array == 0)] = inf
+
+    def use_opacity(self):
+        # Drops columns that are fully transparent at the mip level they are drawn at, and switches fully opaque
+        # columns to the texture's copy without alpha, so they are drawn without blending
+        # Returns indices of the opaque columns
+        count = self.count
+        texture_id = self.texture_id[:count]
+        level = get_mip_levels(TEXTURE_SIZE, self.height[:count])
+        opacity = TEXTURE_STRIPS.opacity[texture_id, level, self.column[:count] >> level]
+        opaque = opacity == TextureStrips.opaque
+        texture_id[opaque] = np.array(TEXTURE_STRIPS.opaque_ids)[texture_id[opaque]]
+        kept = np.flatnonzero(opacity != TextureStrips.transparent)
+        if kept.size < count:
+            for name in ColumnLayer.fields:
+                array = getattr(self, name)
+                array[:kept.size] = array[:count][kept]
+            self.count = kept.size
+        return np.flatnonzero(opaque[kept])
+
+    def draw_columns(self, indices, fog=None):
+        # Blits every column in indices separately and in given order, columns of see-through walls can overlap
+        # Columns drawn after Fog.draw() are given its fog, they get fogged copies like sprites do
+        for texture_id, column, cropping_height, height, shade, display_x, display_y, perp_dist in zip(
+                self.texture_id[indices].tolist(), self.column[indices].tolist(),
+                self.cropping_height[indices].tolist(), self.height[indices].tolist(),
+                self.shade[indices].tolist(), self.display_x[indices].tolist(), self.display_y[indices].tolist(),
+                self.perp_dist[indices].tolist()):
+            image = get_scaled_column(texture_id, column, cropping_height, height, shade)
+            if fog:
+                fog_level = fog.get_level(perp_dist)
+                if fog_level:
+                    # Scaled columns are new every frame, so fogged copies aren't cached
+                    image = fog.get_frame(image, image.get_rect(), fog_level, cache=False)
+            VIEW.blit(image, (display_x, display_y))
+
+    def draw_spans(self, spans):
+        # Draws every (first, end) column range in spans with one scale and blit
+        texture_ids = self.texture_id[:self.count].tolist()
+        columns = self.column[:self.count].tolist()
+        cropping_heights = self.cropping_height[:self.count].tolist()
+        heights = self.height[:self.count].tolist()
+        shades = self.shade[:self.count].tolist()
+        display_xs = self.display_x[:self.count].tolist()
+        for first, end in spans:
+            last = end - 1
+            if first == last:
+                image = get_scaled_column(texture_ids[first], columns[first], cropping_heights[first], heights[first],
+                                          shades[first])
+                VIEW.blit(image, (display_xs[first], int((R_H - heights[first]) / 2)))
+            else:
+                cropping_height = cropping_heights[first]
+                height = round(sum(heights[first:end]) / (end - first))
+                width = min(display_xs[last] + WALL_RES, R_W) - display_xs[first]
+                level = get_mip_level(TEXTURE_SIZE, height)
+                texture = TEXTURE_STRIPS.get_texture(texture_ids[first], level, shades[first])
+                if level:
+                    area = (columns[first] >> level, 0, (columns[last] >> level) - (columns[first] >> level) + 1,
+                            TEXTURE_SIZE >> level)
+                else:
+                    area = (columns[first], (TEXTURE_SIZE - cropping_height) // 2,
+                            columns[last] - columns[first] + 1, cropping_height)
+                VIEW.blit(
+                    pygame.transform.scale(texture.subsurface(area), (width, height)),
+                    (display_xs[first], int((R_H - height) / 2))
+                )
+
+
+class WallSnapshot:
+    # Copy of the 3D view right after walls have been drawn
+    # While send_rays() reuses walls and no sprites are seen through portals, it's drawn instead of the walls
+    def __init__(self):
+        self.image = None
+
+    def save(self):
+        self.image = VIEW.copy()
+
+    def restore(self):
+        VIEW.blit(self.image, (0, 0))
 
 
 class Sprite(Drawable):
     animation_ticks = 5  # Enemy animation frames delay
+    visible_to_player = False  # Set by update_for_drawing() or SpriteProjection
 
-    def update_for_drawing(self, walls, angle_from_player=None):
+    def update_for_drawing(self, walls):
         # Requires delta_(x/y), dist_squared
         self.visible_to_player = False
-        #if self.dist_squared < MAX_DRAW_DIST_SQUARED:
+        self.walls = walls  # ColumnLayer sprite is clipped against
         self.perp_dist = self.delta_x * PLAYER.dir_x + self.delta_y * PLAYER.dir_y
-        if self.perp_dist > 0:
-            if not angle_from_player:
-                angle_from_player = atan2(self.delta_y, self.delta_x)
-            self.display_pos = H_W + int(tan(angle_from_player - PLAYER.viewangle) * CAMERA_PLANE.dist * D_W)
+        if 0 < self.perp_dist < (MAX_DRAW_DIST or inf):
+            # Sprite's distance sideways from the center ray, divided by the camera plane width at its distance
+            lateral_dist = self.delta_y * PLAYER.dir_x - self.delta_x * PLAYER.dir_y
+            self.display_pos = H_W + int(lateral_dist / (self.perp_dist * CAMERA_PLANE.len) * H_W)
 
             self.width = self.height = round(Drawable.constant / self.perp_dist / 2) * 2  # Needs to be even number
             self.calc_start_and_end_x(walls)
-            if self.start_x is not None and self.end_x is not None:
+            if self.start_x is not None:
                 self.calc_cropping_height()
                 self.visible_to_player = True
 
     def calc_start_and_end_x(self, walls):
         # Requires display_pos, width and perp_dist
+        # Sprite is drawn from start_x to end_x, but only on visible_columns where it's in front of walls
         self.start_x = None
         self.end_x = None
 
         # Find start and end x if they exist
         left_side = int(self.display_pos - self.width / 2)
         right_side = left_side + self.width
-        if left_side < D_W and right_side > 0:
+        if left_side < R_W and right_side > 0:
             if left_side < 0:
                 left_side = 0
-            if right_side > D_W:
-                right_side = D_W
+            if right_side > R_W:
+                right_side = R_W
+
+            # Columns without a wall have depth 0 and hide the sprite, columns of missed rays have depth inf
+            visible_columns = self.perp_dist < walls.depth_array[left_side:right_side]
+            first = int(visible_columns.argmax())
+            if visible_columns[first]:
+                end = len(visible_columns) - int(visible_columns[::-1].argmax())
+                self.start_x = left_side + first
+                self.end_x = left_side + end
+                self.visible_columns = visible_columns[first:end]
+                self.fully_visible = bool(self.visible_columns.all())
+
+    def draw_cropped(self, image, frame_x=0, frame_y=0, cache=True):
+        # Draws sprite frame at (frame_x, frame_y) of image between start_x and end_x, except where it's behind a wall
+        # Frame is cropped to cropping_height in the middle
+        display_y = int((R_H - self.height) / 2)
+        if SHADING:
+            shade = SHADING.get_shade(self.perp_dist, self.get_light_shade())
+            if shade:
+                image = SHADING.get_frame(image, (frame_x, frame_y, TEXTURE_SIZE, TEXTURE_SIZE), shade, cache)
+                frame_x = frame_y = 0
+        if FOG:
+            fog_level = FOG.get_level(self.perp_dist)
+            if fog_level:
+                image = FOG.get_frame(image, (frame_x, frame_y, TEXTURE_SIZE, TEXTURE_SIZE), fog_level, cache)
+                frame_x = frame_y = 0
+        crop_y = frame_y + (TEXTURE_SIZE - self.cropping_height) // 2
+        cropping_rect = (
+            ((self.start_x - self.display_pos) / self.width + 0.5) * TEXTURE_SIZE + frame_x,
+            crop_y,
+            (self.end_x - self.start_x) / self.width * TEXTURE_SIZE,
+            self.cropping_height
+        )
+        if cache and self.width <= SCALED_SPRITES.max_width:
+            # Whole frame is scaled and cached, only the part between start_x and end_x is drawn
+            scaled_image = SCALED_SPRITES.get(image, (frame_x, crop_y, TEXTURE_SIZE, self.cropping_height),
+                                              (self.width, self.height))
+            offset_x = self.start_x - int(self.display_pos - self.width / 2)
+        else:
+            scaled_image = pygame.transform.scale(image.subsurface(cropping_rect),
+                                                  (self.end_x - self.start_x, self.height))
+            offset_x = 0
+        if self.fully_visible:
+            VIEW.blit(scaled_image, (self.start_x, display_y), (offset_x, 0, self.end_x - self.start_x, self.height))
+        else:
+            for first, end in get_runs(self.visible_columns):
+                VIEW.blit(scaled_image, (self.start_x + first, display_y),
+                          (offset_x + first, 0, end - first, self.height))
 
-            for w in walls[left_side:right_side]:  # Go from left to right
-                if w and self.perp_dist < w.perp_dist:  # If sprite in front of wall
-                    self.start_x = w.display_x
-                    break
-            for w in walls[right_side:left_side:-1]:  # Go from right to left
-                if w and self.perp_dist < w.perp_dist:  # If sprite in front of wall
-                    self.end_x = w.display_x
-                    break
+    def get_light_shade(self):
+        return LIGHT_MAP[int(self.y), int(self.x)]
 
     def get_portal_clones_info(self):
-        # Returns portal clone pos for each portal
+        # Yields (clone pos, walls clone is clipped against, rayangle_diff) for every portal view sprite is seen in
+        # Clones seen through one portal are clipped against its portal wall layer, clones seen through more
+        # portals against a PortalView
         if BLUE_PORTAL.created and RED_PORTAL.created:
             for portal in (BLUE_PORTAL, RED_PORTAL):
                 other_portal = portal.other_portal
@@ -698,20 +1367,8 @@ class Sprite(Drawable):
                 other_portal_to_object_x = self.x - other_portal.center_x
                 other_portal_to_object_y = self.y - other_portal.center_y
 
-                if other_portal.vertical:
-                    if other_portal.side:
-                        if other_portal_to_object_x < 0:
-                            continue
-                    else:
-                        if other_portal_to_object_x > 0:
-                            continue
-                else:
-                    if other_portal.side:
-                        if other_portal_to_object_y < 0:
-                            continue
-                    else:
-                        if other_portal_to_object_y > 0:
-                            continue
+                if not other_portal.is_in_front(self.x, self.y):
+                    continue
 
                 if portal.vertical == other_portal.vertical:
                     if portal.side == other_portal.side:
@@ -727,10 +1384,89 @@ class Sprite(Drawable):
                     new_delta_x = player_to_portal_x + other_portal_to_object_y
                     new_delta_y = player_to_portal_y - other_portal_to_object_x
 
-                if portal == BLUE_PORTAL:
-                    yield (PLAYER.x + new_delta_x, PLAYER.y + new_delta_y), True
-                else:
-                    yield (PLAYER.x + new_delta_x, PLAYER.y + new_delta_y), False
+                yield (PLAYER.x + new_delta_x, PLAYER.y + new_delta_y), get_wall_layer(1, portal), \
+                    get_rayangle_diff(portal, other_portal)
+
+            for view in DEEP_PORTAL_VIEWS:
+                if view.exit_portal.is_in_front(self.x, self.y):
+                    yield view.get_clone_pos(self.x, self.y), view, view.rayangle_diff
+
+
+class SpriteProjection:
+    # Does update_for_drawing() for every object, explosive and enemy at once
+    # Sprites not on VISIBLE_TILES, behind the player, past MAX_DRAW_DIST or outside the view are culled before
+    # any per-sprite work
+    def __init__(self):
+        # Objects and explosives never move, so their positions are only gathered when the lists change
+        self.objects = None
+        self.explosives = None
+        self.static_sprites = []
+        self.static_count = 0
+        self.static_xs = np.zeros(0)
+        self.static_ys = np.zeros(0)
+
+        self.visible = []  # Sprites visible to player, sorted from furthest to closest
+
+    def update_static_sprites(self):
+        # Objects get picked up and explosives blow up, but nothing is added to the lists during a level
+        if OBJECTS is self.objects and EXPLOSIVES is self.explosives and \
+                len(OBJECTS) + len(EXPLOSIVES) == self.static_count:
+            return
+        self.objects = OBJECTS
+        self.explosives = EXPLOSIVES
+        self.static_sprites = OBJECTS + EXPLOSIVES
+        self.static_count = len(self.static_sprites)
+        self.static_xs = np.fromiter((s.x for s in self.static_sprites), float, self.static_count)
+        self.static_ys = np.fromiter((s.y for s in self.static_sprites), float, self.static_count)
+
+    def project(self, walls):
+        self.update_static_sprites()
+        sprites = self.static_sprites + ENEMIES
+        xs = np.concatenate((self.static_xs, np.fromiter((e.x for e in ENEMIES), float, len(ENEMIES))))
+        ys = np.concatenate((self.static_ys, np.fromiter((e.y for e in ENEMIES), float, len(ENEMIES))))
+
+        previous = self.visible
+        for s in previous:
+            s.visible_to_player = False
+        visible = []
+
+        # Same math as update_for_drawing()
+        delta_x = xs - PLAYER.x
+        delta_y = ys - PLAYER.y
+        perp_dist = delta_x * PLAYER.dir_x + delta_y * PLAYER.dir_y
+        in_front = np.flatnonzero((perp_dist > 0) & (perp_dist < (MAX_DRAW_DIST or inf)) &
+                                  VISIBLE_TILES[ys.astype(int), xs.astype(int)])
+        perp_dist = perp_dist[in_front]
+        lateral_dist = delta_y[in_front] * PLAYER.dir_x - delta_x[in_front] * PLAYER.dir_y
+        display_pos = H_W + (lateral_dist / (perp_dist * CAMERA_PLANE.len) * H_W).astype(np.int64)
+        width = np.round(Drawable.constant / perp_dist / 2).astype(np.int64) * 2
+        left_side = (display_pos - width / 2).astype(np.int64)
+        on_screen = np.flatnonzero((left_side < R_W) & (left_side + width > 0))
+
+        candidates = in_front[on_screen].tolist()
+        perp_dist = perp_dist[on_screen].tolist()
+        display_pos = display_pos[on_screen].tolist()
+        width = width[on_screen].tolist()
+        for i, sprite_perp_dist, sprite_display_pos, sprite_width in zip(candidates, perp_dist, display_pos, width):
+            s = sprites[i]
+            s.walls = walls
+            s.perp_dist = sprite_perp_dist
+            s.display_pos = sprite_display_pos
+            s.width = s.height = sprite_width
+            s.calc_start_and_end_x(walls)
+            if s.start_x is not None:
+                s.calc_cropping_height()
+                s.visible_to_player = True
+                visible.append(s)
+
+        # Depth order barely changes between frames, so last frame's order is carried forward
+        # Sorting an almost sorted list only takes one pass
+        self.visible = [s for s in previous if s.visible_to_player]
+        if len(self.visible) < len(visible):
+            # Enemies compare equal by home room and can't be hashed, so sprites are matched by identity
+            previous_ids = {id(s) for s in previous}
+            self.visible += [s for s in visible if id(s) not in previous_ids]
+        self.visible.sort(key=attrgetter('perp_dist'), reverse=True)
 
 
 class Object(Sprite):
@@ -738,29 +1474,14 @@ class Object(Sprite):
         self.x, self.y = pos
         self.sprite = sprite
 
-    def update(self):
-        self.delta_x = self.x - PLAYER.x
-        self.delta_y = self.y - PLAYER.y
-        self.dist_squared = self.delta_x**2 + self.delta_y**2
-        self.update_for_drawing(WALLS)
-
     def create_portal_clones(self):
         clones_info = self.get_portal_clones_info()
-        for clone_pos, portal_colour in clones_info:
-            PORTAL_OBJECTS.append(PortalObject(self.sprite, clone_pos, portal_colour))
+        for clone_pos, walls, _ in clones_info:
+            PORTAL_OBJECTS.append(PortalObject(self.sprite, clone_pos, walls, light_pos=(self.x, self.y)))
 
     def draw(self):
-        cropping_rect = (
-            ((self.start_x - self.display_pos) / self.width + 0.5) * TEXTURE_SIZE,
-            (TEXTURE_SIZE - self.cropping_height) / 2,
-            (self.end_x - self.start_x) / self.width * TEXTURE_SIZE,
-            self.cropping_height
-        )
         try:
-            DISPLAY.blit(
-                pygame.transform.scale(self.sprite.subsurface(cropping_rect), (self.end_x - self.start_x, self.height)),
-                (self.start_x, (D_H - self.height) / 2)
-            )
+            self.draw_cropped(self.sprite)
         except pygame.error as error:
             print('Error occurred scaling object: {}'.format(error))
             print('width: {}'.format(self.end_x - self.start_x))
@@ -820,19 +1541,22 @@ class ExplodingBarrel(Object):
                         (self.explosion_frame * TEXTURE_SIZE, 0, TEXTURE_SIZE, TEXTURE_SIZE)
                     )
 
-        super().update()
+        self.delta_x = self.x - PLAYER.x
+        self.delta_y = self.y - PLAYER.y
+        self.dist_squared = self.delta_x**2 + self.delta_y**2
         self.angle_from_player = atan2(self.delta_y, self.delta_x)
 
     def create_portal_clones(self):
         clones_info = self.get_portal_clones_info()
-        for clone_pos, portal_colour in clones_info:
-            clone = PortalObject(self.sprite, clone_pos, portal_colour, parent=self)
+        for clone_pos, walls, _ in clones_info:
+            clone = PortalObject(self.sprite, clone_pos, walls, parent=self, light_pos=(self.x, self.y))
             PORTAL_OBJECTS.append(clone)
 
 class PortalObject(Object):
-    def __init__(self, sprite, pos, blue_portal_object, parent=None):
+    def __init__(self, sprite, pos, walls, parent=None, light_pos=None):
         self.x, self.y = pos
         self.sprite = sprite
+        self.light_pos = light_pos  # Clone is lit like the sprite it's cloned from, not like the tile it's drawn on
 
         # Hp will be used to determine if portal object is shootable or not
         self.parent = parent
@@ -844,14 +1568,14 @@ class PortalObject(Object):
         self.delta_x = self.x - PLAYER.x
         self.delta_y = self.y - PLAYER.y
         self.dist_squared = self.delta_x ** 2 + self.delta_y ** 2
-        if blue_portal_object:
-            self.update_for_drawing(BLUE_PORTAL_WALLS)
-        else:
-            self.update_for_drawing(RED_PORTAL_WALLS)
+        self.update_for_drawing(walls)  # Portal wall layer or PortalView clone is seen through
 
     def hurt(self, damage):
         self.parent.hurt(damage)
 
+    def get_light_shade(self):
+        return LIGHT_MAP[int(self.light_pos[1]), int(self.light_pos[0])]
+
 
 class PlayerModel(Sprite):
     # Spritesheet info
@@ -908,26 +1632,20 @@ class PlayerModel(Sprite):
 
     def create_portal_clones(self):
         clones_info = self.get_portal_clones_info()
-        for clone_pos, portal_colour in clones_info:
+        for clone_pos, walls, rayangle_diff in clones_info:
             clone_row = self.row
             if not PLAYER.hp:
                 clone_column = self.column
             else:
                 delta_x = clone_pos[0] - PLAYER.x
                 delta_y = clone_pos[1] - PLAYER.y
-                clone_angle_from_player = atan2(delta_y, delta_x)
-
-                if portal_colour:
-                    clone_angle_from_player += get_rayangle_diff(BLUE_PORTAL, RED_PORTAL)
-                else:
-                    clone_angle_from_player += get_rayangle_diff(RED_PORTAL, BLUE_PORTAL)
-
+                clone_angle_from_player = atan2(delta_y, delta_x) + rayangle_diff
                 clone_column = self.get_column(clone_angle_from_player)
 
             clone_sprite = self.spritesheet.subsurface(
                 (clone_column * TEXTURE_SIZE, clone_row * TEXTURE_SIZE, TEXTURE_SIZE, TEXTURE_SIZE)
             )
-            clone = PortalObject(clone_sprite, clone_pos, portal_colour, parent=PLAYER)
+            clone = PortalObject(clone_sprite, clone_pos, walls, parent=PLAYER, light_pos=(PLAYER.x, PLAYER.y))
             PORTAL_OBJECTS.append(clone)
 
 
@@ -1321,11 +2039,10 @@ class Enemy(Sprite):
             self.column = self.get_column(self.angle_from_player)
         #print(self.status)
         #print(self.row, self.column)
-        self.update_for_drawing(WALLS, self.angle_from_player)
 
     def create_portal_clones(self):
         clones_info = self.get_portal_clones_info()
-        for clone_pos, portal_colour in clones_info:
+        for clone_pos, walls, rayangle_diff in clones_info:
             if not self.hp and self.column == self.death_frames - 1:
                 if not self.looted:
                     self.outline_image.set_alpha(abs(self.outline_alpha))
@@ -1340,13 +2057,7 @@ class Enemy(Sprite):
                 if self.hp:
                     delta_x = clone_pos[0] - PLAYER.x
                     delta_y = clone_pos[1] - PLAYER.y
-                    clone_angle_from_player = atan2(delta_y, delta_x)
-
-                    if portal_colour:
-                        clone_angle_from_player += get_rayangle_diff(BLUE_PORTAL, RED_PORTAL)
-                    else:
-                        clone_angle_from_player += get_rayangle_diff(RED_PORTAL, BLUE_PORTAL)
-
+                    clone_angle_from_player = atan2(delta_y, delta_x) + rayangle_diff
                     clone_column = self.get_column(clone_angle_from_player)
                 else:
                     clone_column = self.column
@@ -1355,38 +2066,22 @@ class Enemy(Sprite):
                     (clone_column * TEXTURE_SIZE, clone_row * TEXTURE_SIZE, TEXTURE_SIZE, TEXTURE_SIZE)
                 )
 
-            clone = PortalObject(clone_sprite, clone_pos, portal_colour, parent=self)
+            clone = PortalObject(clone_sprite, clone_pos, walls, parent=self, light_pos=(self.x, self.y))
             PORTAL_OBJECTS.append(clone)
 
     def draw(self):
-        if not self.hp and self.column == self.death_frames - 1:
-            cropping_rect = (
-                ((self.start_x - self.display_pos) / self.width + 0.5) * TEXTURE_SIZE,
-                (TEXTURE_SIZE - self.cropping_height) / 2,
-                (self.end_x - self.start_x) / self.width * TEXTURE_SIZE,
-                self.cropping_height
-            )
-            if not self.looted:
-                self.outline_image.set_alpha(abs(self.outline_alpha))
-                image = self.dead_image.copy()
-                image.blit(self.outline_image, (0, 0))
-            else:
-                image = self.dead_image
-            cropped_image = image.subsurface(cropping_rect)
-
-        else:
-            cropping_rect = (
-                ((self.start_x - self.display_pos) / self.width + self.column + 0.5) * TEXTURE_SIZE,
-                (TEXTURE_SIZE - self.cropping_height) / 2 + self.row * TEXTURE_SIZE,
-                (self.end_x - self.start_x) / self.width * TEXTURE_SIZE,
-                self.cropping_height
-            )
-            cropped_image = self.spritesheet.subsurface(cropping_rect)
         try:
-            DISPLAY.blit(
-                pygame.transform.scale(cropped_image, (self.end_x - self.start_x, self.height)),
-                (self.start_x, (D_H - self.height) / 2)
-            )
+            if not self.hp and self.column == self.death_frames - 1:
+                if not self.looted:
+                    # Outline changes every frame, so it isn't cached
+                    self.outline_image.set_alpha(abs(self.outline_alpha))
+                    image = self.dead_image.copy()
+                    image.blit(self.outline_image, (0, 0))
+                    self.draw_cropped(image, cache=False)
+                else:
+                    self.draw_cropped(self.dead_image)
+            else:
+                self.draw_cropped(self.spritesheet, self.column * TEXTURE_SIZE, self.row * TEXTURE_SIZE)
         except pygame.error as error:
             print('Error occurred scaling enemy: {}'.format(error))
             print('width: {}'.format(self.end_x - self.start_x))
@@ -1522,8 +2217,6 @@ class Boss(Enemy):
                     if self.column == self.running_frames:
                         self.column = 0
 
-        self.update_for_drawing(WALLS, self.angle_from_player)
-
 
 class BossHealthBar:
     def __init__(self):
@@ -1535,7 +2228,7 @@ class BossHealthBar:
         self.visible = False
         self.speed = 5  # Pixels the bar moves up/down per tick
         self.outline = 4  # Black outline width
-        self.center_x = H_W
+        self.center_x = int(D_W / 2)
         self.center_y = 35
         self.current_y = -int(TEXTURE_SIZE / 2)  # The current healthbar y pos
 
@@ -1598,9 +2291,9 @@ class Level:
             except pygame.error as loading_error:
                 sys.exit(loading_error)
             else:
-                self.skytexture = pygame.Surface((D_W * 2, H_H))
-                self.skytexture.blit(pygame.transform.scale(raw_skytexture, (D_W, H_H)), (0, 0))
-                self.skytexture.blit(pygame.transform.scale(raw_skytexture, (D_W, H_H)), (D_W, 0))
+                self.skytexture = pygame.Surface((R_W * 2, H_H))
+                self.skytexture.blit(pygame.transform.scale(raw_skytexture, (R_W, H_H)), (0, 0))
+                self.skytexture.blit(pygame.transform.scale(raw_skytexture, (R_W, H_H)), (R_W, 0))
 
         # Load player file
         with open('../levels/{}/player.txt'.format(level_nr), 'r') as f:
@@ -1625,6 +2318,7 @@ class Level:
         PUSH_WALLS = []
         global THIN_WALLS
         THIN_WALLS = []
+        lamps = []
         for row in range(len(TILEMAP)):
             for column in range(len(TILEMAP[row])):
                 tile_value = TILEMAP[row][column]
@@ -1632,6 +2326,8 @@ class Level:
                 pos = (column + 0.5, row + 0.5)
                 map_pos = (column, row)
                 if tile.type == 'Object':
+                    if tile.light:
+                        lamps.append(pos)
                     if tile.desc == 'Explosive':
                         EXPLOSIVES.append(ExplodingBarrel(tile.texture, pos))
                     else:
@@ -1680,6 +2376,20 @@ class Level:
                 else:
                     EMPTY_TILES.add((column, row))
 
+        # Tilemap array copies for the vectorized and parallel raycasters
+        global TILE_ARRAYS
+        if TILE_ARRAYS:
+            TILE_ARRAYS.close()
+        TILE_ARRAYS = raycasting.TileArrays(len(TILEMAP[0]), len(TILEMAP), shared=bool(RAYCAST_POOL))
+        for row in range(len(TILEMAP)):
+            for column in range(len(TILEMAP[row])):
+                update_tilemap_arrays(column, row)
+        for door in DOORS:
+            update_tile_offset(door.x, door.y, door.closed_state)
+
+        global LIGHT_MAP
+        LIGHT_MAP = bake_light_map(lamps)
+
         # Get enemy home rooms after enemies have been cleared from the tilemap
         for e in ENEMIES:
             if e.type == 'Normal':
@@ -1688,7 +2398,7 @@ class Level:
         blue_portal, \
         blue_portal_closed, \
         red_portal, \
-        red_portal_closed = graphics.get_portal_textures()
+        red_portal_closed = PORTAL_TEXTURES
         global BLUE_PORTAL
         BLUE_PORTAL = Portal(blue_portal, blue_portal_closed)
         global RED_PORTAL
@@ -1713,8 +2423,7 @@ class Level:
 
         def prepare_frame():
             send_rays()
-            for sprite in ENEMIES + OBJECTS + EXPLOSIVES:
-                sprite.update_for_drawing(WALLS)
+            SPRITE_PROJECTION.project(WALLS)
             create_portal_objects()
 
         global QUIT
@@ -1731,8 +2440,7 @@ class Level:
                 turn_radians = -turn_speed
             while True:
                 PLAYER.rotate(turn_radians)
-                PLAYER.dir_x = cos(PLAYER.viewangle)
-                PLAYER.dir_y = sin(PLAYER.viewangle)
+                PLAYER.update_direction()
 
                 prepare_frame()
                 draw_frame()
@@ -1845,10 +2553,9 @@ def can_see(from_, to):
 
     start_x, start_y = from_
     end_x, end_y = to
-    angle_to_end = atan2(end_y - start_y, end_x - start_x)
 
     # Raycast a ray to end postition
-    collision_x, collision_y = raycast(from_, angle_to_end)
+    collision_x, collision_y = raycast(from_, (end_x - start_x, end_y - start_y))
     # If collision further than end point, it's possible to see
     return squared_dist(from_, (collision_x, collision_y)) > squared_dist(from_, to)
 
@@ -1906,12 +2613,12 @@ def display_text(horizontal_pos, vertical_pos, *rendered_texts):
     # |                   2
     #  -------------------
     # If given multiple texts, they will be drawn on top of each other
-    x = horizontal_pos * H_W
+    x = horizontal_pos * int(D_W / 2)
     if x == 0:
         x += HUD_SAFEZONE
     elif x == D_W:
         x -= HUD_SAFEZONE
-    y = vertical_pos * H_H
+    y = vertical_pos * int(D_H / 2)
     if y == 0:
         y += HUD_SAFEZONE
     elif y == D_H:
@@ -1924,6 +2631,49 @@ def display_text(horizontal_pos, vertical_pos, *rendered_texts):
         y += text_h
 
 
+def rotated(vector, angle):
+    # Rotates vector by angle, which has to be 0, pi or +-pi / 2 (see get_rayangle_diff())
+    x, y = vector
+    if angle == pi:
+        return -x, -y
+    elif angle > 0:
+        return -y, x
+    elif angle < 0:
+        return y, -x
+    return x, y
+
+
+def add_rayangle_diffs(rayangle_diff, other_rayangle_diff):
+    # Total rotation of going through two portals, same values as in get_rayangle_diff()
+    quarter_turns = (round(rayangle_diff / (pi / 2)) + round(other_rayangle_diff / (pi / 2))) % 4
+    return (0.0, pi / 2, pi, -pi / 2)[quarter_turns]
+
+
+def unrotated(delta_x, delta_y, rayangle_diffs):
+    # Rotates every delta back by its rayangle_diff, like get_delta_x_and_y() in raycast() does for one delta
+    return (np.select((rayangle_diffs == pi, rayangle_diffs > 0, rayangle_diffs < 0), (-delta_x, delta_y, -delta_y),
+                      delta_x),
+            np.select((rayangle_diffs == pi, rayangle_diffs > 0, rayangle_diffs < 0), (-delta_y, -delta_x, delta_x),
+                      delta_y))
+
+
+def get_portal_exit(portal, surface_offset):
+    # Point on portal where ray that hit the other portal at surface_offset comes out, works with arrays too
+    if portal.vertical:
+        start_x = portal.map_x + portal.side
+        if portal.side == 1:
+            start_y = portal.map_y + surface_offset
+        else:
+            start_y = portal.map_y + (1 - surface_offset)
+    else:
+        start_y = portal.map_y + portal.side
+        if portal.side == 1:
+            start_x = portal.map_x + (1 - surface_offset)
+        else:
+            start_x = portal.map_x + surface_offset
+    return start_x, start_y
+
+
 def get_rayangle_diff(portal, other_portal):
     if portal.vertical:
         if other_portal.vertical:
@@ -1950,42 +2700,471 @@ def get_rayangle_diff(portal, other_portal):
     return rayangle_diff
 
 
+def update_tiles_version():
+    # Has to be called whenever anything rays can hit changes, so send_rays() won't reuse walls from previous frame
+    global TILES_VERSION
+    TILES_VERSION += 1
+
+
+def update_tilemap_arrays(map_x, map_y):
+    # Copies tile at (map_x, map_y) from TILEMAP and the tile sets to TILE_ARRAYS
+    update_tiles_version()
+    TILE_ARRAYS.values[map_y, map_x] = TILEMAP[map_y][map_x]
+    if (map_x, map_y) in EMPTY_TILES:
+        TILE_ARRAYS.kinds[map_y, map_x] = raycasting.EMPTY
+    elif (map_x, map_y) in DOOR_TILES:
+        TILE_ARRAYS.kinds[map_y, map_x] = raycasting.DOOR
+    elif (map_x, map_y) in PUSH_WALL_TILES:
+        TILE_ARRAYS.kinds[map_y, map_x] = raycasting.PUSH_WALL
+    elif (map_x, map_y) in THIN_WALL_TILES:
+        TILE_ARRAYS.kinds[map_y, map_x] = raycasting.SPECIAL
+    else:
+        TILE_ARRAYS.kinds[map_y, map_x] = raycasting.WALL
+
+
+def update_tile_offset(map_x, map_y, offset):
+    # Door closed_state or push wall tile_offset for TILE_ARRAYS
+    update_tiles_version()
+    TILE_ARRAYS.offsets[map_y, map_x] = offset
+
+
+def bake_light_map(lamps):
+    # Returns light shades of every tile, how many shade levels darker walls and sprites on it are (see Shading)
+    # Light from every lamp spreads through tiles that aren't walls and fades out by LAMP_LIGHT_RADIUS
+    # Done once when the level starts, so lamps cost nothing while drawing
+    # Levels without lamps are evenly lit
+    light_map = np.zeros((len(TILEMAP), len(TILEMAP[0])), dtype=np.int32)
+    if not (SHADING and UNLIT_SHADE and lamps):
+        return light_map
+
+    light = np.zeros(light_map.shape)  # From 0 (unlit) to 1 (right next to a lamp)
+    for lamp_x, lamp_y in lamps:
+        lit_tiles = {(int(lamp_x), int(lamp_y))}
+        edge = list(lit_tiles)
+        for _ in range(LAMP_LIGHT_RADIUS):
+            next_edge = []
+            for x, y in edge:
+                for tile in ((x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1)):
+                    if tile not in lit_tiles and \
+                            (tile in EMPTY_TILES or tile in DOOR_TILES or tile in THIN_WALL_TILES):
+                        lit_tiles.add(tile)
+                        next_edge.append(tile)
+            edge = next_edge
+        for x, y in lit_tiles:
+            dist = sqrt((x + 0.5 - lamp_x) ** 2 + (y + 0.5 - lamp_y) ** 2)
+            light[y, x] = max(light[y, x], 1 - dist / LAMP_LIGHT_RADIUS)
+    light_map[:] = np.round(UNLIT_SHADE * (1 - light))
+    return light_map
+
+
 def send_rays():
-    ## MAX_DRAW_DIST_SQUARED is used in drawing enemies and objects
-    #global MAX_DRAW_DIST_SQUARED
-    #MAX_DRAW_DIST_SQUARED = 0
+    # Walls from previous frame are reused if camera, WALL_RES, raycaster and tiles are all the same
+    global WALLS_KEY
+    global WALLS_REUSED
+    global DEEP_PORTAL_VIEWS
+    walls_key = (PLAYER.x, PLAYER.y, PLAYER.dir_x, PLAYER.dir_y, WALL_RES, RAYCASTER, TILES_VERSION)
+    WALLS_REUSED = walls_key == WALLS_KEY
+    if WALLS_REUSED:
+        return
+    WALLS_KEY = walls_key
 
     # Deletes previous walls
-    global WALLS
-    WALLS = []
-    global BLUE_PORTAL_WALLS
-    BLUE_PORTAL_WALLS = []
-    global RED_PORTAL_WALLS
-    RED_PORTAL_WALLS = []
-    global SEETHROUGH_WALLS
-    SEETHROUGH_WALLS = []
-    global PORTAL_SEETHROUGH_WALLS
-    PORTAL_SEETHROUGH_WALLS = []
+    for layer in WALL_LAYERS:
+        layer.clear()
+    PORTAL_RAYS.clear()
+    TILE_ARRAYS.visible[:] = False
 
     # Send rays
+    if RAYCASTER in ('vectorized', 'parallel'):
+        send_rays_vectorized()
+    else:
+        global DISPLAY_X
+        for DISPLAY_X, camera_x in enumerate(CAMERA_PLANE.camera_x):
+            ray_start = (PLAYER.x, PLAYER.y)
+            if not DISPLAY_X % WALL_RES:
+                # Get values from raycast()
+                ray_dir = (PLAYER.dir_x + PLAYER.plane_x * camera_x, PLAYER.dir_y + PLAYER.plane_y * camera_x)
+                raycast(ray_start, ray_dir, create_walls=True)
+
+    send_portal_rays()
+
+    for layer in WALL_LAYERS:
+        layer.finish()
+    # Sprites behind opaque thin wall columns are hidden like behind walls, thin walls are always in front of walls
+    covered = SEETHROUGH_WALLS.depth_array > 0
+    WALLS.depth_array[covered] = SEETHROUGH_WALLS.depth_array[covered]
+    DEEP_PORTAL_VIEWS = get_deep_portal_views()
+    merge_wall_spans()
+    update_visible_tiles()
+
+
+def update_visible_tiles():
+    # Sprites and their portal clones are only handled on VISIBLE_TILES
+    # Tiles rays went through are grown by one tile, because sprites can stick out of their tile and
+    # rays are only cast every WALL_RES-th column
+    global VISIBLE_TILES
+    visible = TILE_ARRAYS.visible
+    grown = visible.copy()
+    grown[1:] |= visible[:-1]
+    grown[:-1] |= visible[1:]
+    VISIBLE_TILES = grown.copy()
+    VISIBLE_TILES[:, 1:] |= grown[:, :-1]
+    VISIBLE_TILES[:, :-1] |= grown[:, 1:]
+
+
+def send_rays_vectorized():
+    # Casts every WALL_RES-th ray at once with raycasting.cast_rays(), or on RAYCAST_POOL's workers in parallel
+    # if the machine has cores for at least 2 workers
+    # Rays that hit a thin wall are cast again with the scalar raycast()
+    camera_x = CAMERA_PLANE.camera_x_array[::WALL_RES]
+    ray_dir_x = PLAYER.dir_x + PLAYER.plane_x * camera_x
+    ray_dir_y = PLAYER.dir_y + PLAYER.plane_y * camera_x
+    if RAYCASTER == 'parallel' and RAYCAST_WORKER_COUNT > 1:
+        global RAYCAST_POOL
+        global TILE_ARRAYS
+        if not RAYCAST_POOL:
+            RAYCAST_POOL = raycasting.RayCastPool(RAYCAST_WORKER_COUNT, R_W, PARALLEL_MIN_RAYS)
+        if not TILE_ARRAYS.shared:
+            # Tiles are only moved to shared memory once there are workers to read them
+            shared_tiles = TILE_ARRAYS.copy(shared=True)
+            TILE_ARRAYS.close()
+            TILE_ARRAYS = shared_tiles
+        hits = RAYCAST_POOL.cast(TILE_ARRAYS, PLAYER.x, PLAYER.y, ray_dir_x, ray_dir_y, MAX_DRAW_DIST or inf)
+    else:
+        hits = raycasting.cast_rays(TILE_ARRAYS, PLAYER.x, PLAYER.y, ray_dir_x, ray_dir_y, MAX_DRAW_DIST or inf)
+
+    rays = np.arange(camera_x.size)
+    zeros = np.zeros(rays.size)
+    needs_raycast = add_cast_hits(hits, rays, rays * WALL_RES, ((WALLS, np.ones(rays.size, dtype=bool)),), 0,
+                                  zeros, zeros, zeros, zeros)
+
     global DISPLAY_X
-    for DISPLAY_X, rayangle_offset in enumerate(CAMERA_PLANE.rayangle_offsets):
-        ray_start = (PLAYER.x, PLAYER.y)
-        if not DISPLAY_X % WALL_RES:
-            # Get values from raycast()
-            raycast(ray_start, PLAYER.viewangle + rayangle_offset, create_walls=True, can_go_through_portal=True)
-
-            #new_dist = delta_x**2 + delta_y**2
-            #if new_dist > MAX_DRAW_DIST_SQUARED:
-            #    MAX_DRAW_DIST_SQUARED = new_dist
+    ray_dir_x = ray_dir_x.tolist()
+    ray_dir_y = ray_dir_y.tolist()
+    for ray_nr in np.flatnonzero(needs_raycast).tolist():
+        DISPLAY_X = ray_nr * WALL_RES
+        raycast((PLAYER.x, PLAYER.y), (ray_dir_x[ray_nr], ray_dir_y[ray_nr]), create_walls=True)
+
+
+def send_portal_rays():
+    # Casts rays that continue from the other portal, collected into PORTAL_RAYS during the main pass
+    # Rays are cast in waves, rays of every wave have gone through one more portal than the previous wave's
+    # and can queue rays for the next wave, until MAX_PORTAL_DEPTH or PORTAL_RAY_BUDGET is reached
+    wave_start = 0
+    while wave_start < len(PORTAL_RAYS):
+        wave = sorted(PORTAL_RAYS[wave_start:], key=lambda ray: ray[0])
+        wave_start = len(PORTAL_RAYS)
+        send_portal_ray_wave(wave)
+
+
+def get_deep_portal_views():
+    # Returns a PortalView for every chain of portals PORTAL_RAYS went through more than one portal of
+    # Rays going through the same chain see the world moved and rotated the same way, so their start point, its
+    # position on screen and rayangle_diff give the view's origin
+    # Every ray sees the closest DEEP_PORTAL_WALLS column past the portal it came out of, or nothing if it missed
+    deep_rays = [portal_ray for portal_ray in PORTAL_RAYS if portal_ray[7] > 1]
+    if not deep_rays:
+        return []
+    display_xs, start_positions, _, portals, rayangle_diffs, delta_xs, delta_ys, portal_depths = zip(*deep_rays)
+    display_xs = np.array(display_xs)
+    rayangle_diffs = np.array(rayangle_diffs)
+    delta_x = np.array(delta_xs)
+    delta_y = np.array(delta_ys)
+    start_perp_dist = delta_x * PLAYER.dir_x + delta_y * PLAYER.dir_y
+    start_x, start_y = unrotated(*np.array(start_positions).T, rayangle_diffs)
+    origin_x = np.round(PLAYER.x + delta_x - start_x, 6).tolist()
+    origin_y = np.round(PLAYER.y + delta_y - start_y, 6).tolist()
+
+    # Columns are sorted by display_x and then by distance, so the first one past a ray's start can be searched for
+    hit_dists = np.full(display_xs.size, inf)
+    count = DEEP_PORTAL_WALLS.count
+    if count:
+        wall_xs = DEEP_PORTAL_WALLS.display_x[:count]
+        wall_dists = DEEP_PORTAL_WALLS.perp_dist[:count]
+        order = np.lexsort((wall_dists, wall_xs))
+        wall_xs = wall_xs[order]
+        wall_dists = wall_dists[order]
+        scale = 2 * (max(wall_dists.max(), start_perp_dist.max()) + 1)  # Keeps columns of every display_x apart
+        closest = np.minimum(np.searchsorted(wall_xs * scale + wall_dists,
+                                             display_xs * scale + start_perp_dist + 0.000001), count - 1)
+        hit = (wall_xs[closest] == display_xs) & (wall_dists[closest] > start_perp_dist)
+        hit_dists[hit] = wall_dists[closest][hit]
+    hit_dists = hit_dists.tolist()
+
+    views = {}
+    for display_x, portal, rayangle_diff, view_x, view_y, portal_depth, hit_dist in zip(
+            display_xs.tolist(), portals, rayangle_diffs.tolist(), origin_x, origin_y, portal_depths, hit_dists):
+        key = (portal, rayangle_diff, view_x, view_y)
+        view = views.get(key)
+        if view is None:
+            view = views[key] = PortalView(portal.other_portal, rayangle_diff, view_x, view_y, portal_depth)
+        view.depth_array[display_x:display_x + WALL_RES] = hit_dist
+    return list(views.values())
+
+
+def send_portal_ray_wave(wave):
+    # Only every PORTAL_RES-th column of a portal and its first column are cast, the columns between them are
+    # copies of the cast column on their left, which stretches the view behind the portal into place
+    # Columns copied from a column that went through an open portal are cast too
+    # Rays are cast at once with raycasting.cast_rays(), rays that hit a thin wall use the scalar raycast()
+    display_xs, start_positions, ray_dirs, portals, rayangle_diffs, delta_xs, delta_ys, portal_depths = zip(*wave)
+    display_xs = np.array(display_xs)
+    blue = np.array([portal == BLUE_PORTAL for portal in portals])
+    cast = display_xs // WALL_RES % PORTAL_RES == 0
+    cast[0] = True
+    cast[1:] |= (display_xs[1:] != display_xs[:-1] + WALL_RES) | (blue[1:] != blue[:-1])
+
+    if RAYCASTER == 'scalar':
+        needs_raycast = np.ones(np.count_nonzero(cast), dtype=bool)
+    else:
+        start_x, start_y = np.array(start_positions).T
+        ray_dir_x, ray_dir_y = np.array(ray_dirs).T
+        # Rays start on the portal wall's tile side, so they are nudged off it like in raycast()
+        start_x += np.where(ray_dir_x > 0, 0.0000001, -0.0000001)
+        start_y += np.where(ray_dir_y > 0, 0.0000001, -0.0000001)
+        delta_x = np.array(delta_xs)
+        delta_y = np.array(delta_ys)
+        start_perp_dist = delta_x * PLAYER.dir_x + delta_y * PLAYER.dir_y
+        # Copied open portal columns would have nothing behind them, so they are cast like in the scalar path
+        portal_depth = portal_depths[0]
+        hits, cast = raycasting.cast_strided(TILE_ARRAYS, start_x, start_y, ray_dir_x, ray_dir_y,
+                                             (MAX_DRAW_DIST or inf) - start_perp_dist, cast,
+                                             lambda hits: get_open_portal_hits(hits, portal_depth))
+
+        if portal_depth == 1:
+            layers = ((BLUE_PORTAL_WALLS, blue), (RED_PORTAL_WALLS, ~blue))
         else:
-            WALLS.append(None)
-            BLUE_PORTAL_WALLS.append(None)
-            RED_PORTAL_WALLS.append(None)
-
+            layers = ((DEEP_PORTAL_WALLS, np.ones(display_xs.size, dtype=bool)),)
+        needs_raycast = add_cast_hits(hits, np.cumsum(cast) - 1, display_xs, layers, portal_depth,
+                                      start_perp_dist[cast], delta_x[cast], delta_y[cast],
+                                      np.array(rayangle_diffs)[cast])
+    source = np.cumsum(cast) - 1  # Index of the cast ray every column is copied from
+
+    for cast_nr in np.flatnonzero(needs_raycast).tolist():
+        columns = np.flatnonzero(source == cast_nr).tolist()
+        counts = [layer.count for layer in WALL_LAYERS]
+        queued = len(PORTAL_RAYS)
+        raycast_portal_ray(wave[columns[0]])
+        if len(PORTAL_RAYS) > queued:
+            # Copied open portal columns would have nothing behind them, so every column is cast
+            for column in columns[1:]:
+                raycast_portal_ray(wave[column])
+        elif len(columns) > 1:
+            for layer, count in zip(WALL_LAYERS, counts):
+                layer.copy_columns(count, layer.count, display_xs[columns[1:]].tolist())
+
+
+def raycast_portal_ray(portal_ray):
+    # Casts a PORTAL_RAYS ray with the scalar raycast()
+    global DISPLAY_X
+    DISPLAY_X, start_pos, ray_dir, portal, rayangle_diff, delta_x, delta_y, portal_depth = portal_ray
+    raycast(start_pos, ray_dir, create_walls=True, portal_depth=portal_depth,
+            previous_portal=portal, previous_rayangle_diff=rayangle_diff,
+            previous_delta_x=delta_x, previous_delta_y=delta_y)
+
+
+def add_cast_hits(hits, source, display_xs, layers, portal_depth,
+                  start_perp_dist, start_delta_x, start_delta_y, rayangle_diffs):
+    # Adds columns of cast_rays() hits to layers and queues rays going through portals into PORTAL_RAYS
+    # Column at display_xs[i] shows hit source[i], layers is a list of (layer, columns mask) pairs
+    # start_perp_dist, start_delta_(x/y) and rayangle_diffs are per hit, they are 0 for rays cast from player
+    # Returns mask of hits that cast_rays() can't fully resolve
+    # Rays that missed past MAX_DRAW_DIST add no columns, their columns are marked missed
+    needs_raycast = (hits.kind == raycasting.SPECIAL) & ~hits.missed
+    # Rays aren't normalized, so distance is the perpendicular distance
+    perp_dist = start_perp_dist + hits.dist
+    delta_x, delta_y = unrotated(hits.delta_x, hits.delta_y, rayangle_diffs)
+    delta_x += start_delta_x
+    delta_y += start_delta_y
+
+    portal_hits = []
+    for portal in (BLUE_PORTAL, RED_PORTAL):
+        if portal.created:
+            portal_hits.append((portal, get_portal_hits(hits, portal)[source]))
+
+    for layer, columns in layers:
+        layer.add_missed(display_xs[columns & hits.missed[source]])
+        columns = columns & ~(needs_raycast | hits.missed)[source]
+        for portal, portal_columns in portal_hits:
+            portal_columns = columns & portal_columns
+            columns &= ~portal_columns
+            add_portal_columns(layer, portal, hits, source[portal_columns], display_xs[portal_columns],
+                               perp_dist, delta_x, delta_y, rayangle_diffs, portal_depth)
+        add_ray_hits(layer, hits, source[columns], display_xs[columns], perp_dist[source[columns]])
+    return needs_raycast
+
+
+def get_portal_hits(hits, portal):
+    # Mask of cast_rays() hits on the tile side portal is on
+    if portal.vertical:
+        side = hits.ray_dir_x < 0  # Rays going right hit side 0
+    else:
+        side = hits.ray_dir_y < 0
+    return (hits.map_x == portal.map_x) & (hits.map_y == portal.map_y) & \
+        (hits.vertical == portal.vertical) & (side == portal.side)
+
+
+def get_open_portal_hits(hits, portal_depth):
+    # Mask of cast_rays() hits on a portal that rays would go through, like raycast() decides it
+    open_hits = np.zeros(hits.dist.size, dtype=bool)
+    if portal_depth >= MAX_PORTAL_DEPTH or len(PORTAL_RAYS) >= PORTAL_RAY_BUDGET:
+        return open_hits
+    for portal in (BLUE_PORTAL, RED_PORTAL):
+        if portal.created and portal.other_portal.created:
+            open_hits |= get_portal_hits(hits, portal) & ~hits.missed
+    return open_hits
+
+
+def add_portal_columns(layer, portal, hits, rays, display_xs, perp_dist, delta_x, delta_y, rayangle_diffs,
+                       portal_depth):
+    # Adds portal columns of hits at rays to layer and queues rays going through the portal, like raycast() does
+    # Columns over PORTAL_RAY_BUDGET or MAX_PORTAL_DEPTH are drawn closed
+    other_portal = portal.other_portal
+    open_columns = 0
+    if other_portal.created and portal_depth < MAX_PORTAL_DEPTH:
+        open_columns = min(max(PORTAL_RAY_BUDGET - len(PORTAL_RAYS), 0), rays.size)
+    texture_ids = np.full(rays.size, TEXTURE_STRIPS.texture_ids[portal.closed_texture])
+    texture_ids[:open_columns] = TEXTURE_STRIPS.texture_ids[portal.texture]
+    layer.add_many(display_xs, perp_dist[rays], texture_ids, hits.column[rays], -1, 0, False)
+    if not open_columns:
+        return
 
-def raycast(start_pos, rayangle, create_walls=False, can_go_through_portal=False,
+    rays = rays[:open_columns]
+    rayangle_diff = get_rayangle_diff(portal, other_portal)
+    start_x, start_y = get_portal_exit(other_portal, hits.get_surface_offset()[rays])
+    start_x = np.broadcast_to(start_x, rays.shape).tolist()
+    start_y = np.broadcast_to(start_y, rays.shape).tolist()
+    ray_dir_x, ray_dir_y = rotated((hits.ray_dir_x[rays], hits.ray_dir_y[rays]), rayangle_diff)
+    for display_x, start_pos, ray_dir, previous_rayangle_diff, ray_delta_x, ray_delta_y in zip(
+            display_xs[:open_columns].tolist(), zip(start_x, start_y), zip(ray_dir_x.tolist(), ray_dir_y.tolist()),
+            rayangle_diffs[rays].tolist(), delta_x[rays].tolist(), delta_y[rays].tolist()):
+        PORTAL_RAYS.append((display_x, start_pos, ray_dir, portal,
+                            add_rayangle_diffs(previous_rayangle_diff, rayangle_diff),
+                            ray_delta_x, ray_delta_y, portal_depth + 1))
+
+
+def get_wall_layer(portal_depth, previous_portal):
+    # Layer for walls rays hit after going through portal_depth portals
+    if portal_depth == 0:
+        return WALLS
+    if portal_depth == 1:
+        if previous_portal == BLUE_PORTAL:
+            return BLUE_PORTAL_WALLS
+        return RED_PORTAL_WALLS
+    return DEEP_PORTAL_WALLS
+
+
+def get_seethrough_layer(portal_depth):
+    # Layer for see-through walls rays hit after going through portal_depth portals
+    if portal_depth == 0:
+        return SEETHROUGH_WALLS
+    if portal_depth == 1:
+        return PORTAL_SEETHROUGH_WALLS
+    return DEEP_PORTAL_WALLS
+
+
+def add_ray_hits(layer, hits, rays, display_x, perp_dist):
+    # Adds columns of cast_rays() hits to layer, rays is a mask or indices of the hits to add
+    texture_ids = TILE_TEXTURE_IDS[hits.value]
+    # Walls seen right through a door tile use door side texture
+    prev_kind = TILE_ARRAYS.kinds[hits.prev_y, hits.prev_x]
+    texture_ids[(prev_kind == raycasting.DOOR) & (hits.kind != raycasting.DOOR)] = \
+        TEXTURE_STRIPS.texture_ids[Door.side_texture]
+
+    # Door and moving push wall columns aren't on the tile side, so they aren't merged
+    face_x = np.where((hits.kind == raycasting.DOOR) | (hits.offset > 0), -1, hits.map_x)
+
+    # Doors are lit by their own tile, walls by the tile in front of them
+    door = hits.kind == raycasting.DOOR
+    light_shades = LIGHT_MAP[np.where(door, hits.map_y, hits.prev_y), np.where(door, hits.map_x, hits.prev_x)]
+
+    layer.add_many(display_x, perp_dist, texture_ids[rays], hits.column[rays],
+                   face_x[rays], hits.map_y[rays], hits.vertical[rays], light_shades[rays])
+
+
+def get_mip_chain(surface):
+    # Returns surface halved 1 to MIP_LEVELS times
+    mips = []
+    for _ in range(MIP_LEVELS):
+        surface = pygame.transform.smoothscale(surface, (surface.get_width() // 2, surface.get_height() // 2))
+        mips.append(surface)
+    return mips
+
+
+def get_scaled_column(texture_id, column, cropping_height, height, shade=0):
+    # Wall column strip scaled to its on-screen height, from the mip level that height uses
+    # Scaling is about as fast as blitting an already scaled column from a cache, so columns are scaled every time
+    level = get_mip_level(TEXTURE_SIZE, height)
+    strip = TEXTURE_STRIPS.get(texture_id, column, cropping_height, level, shade)
+    return pygame.transform.scale(strip, (WALL_RES, height))
+
+
+def get_mip_level(size, on_screen_size):
+    # Highest mip level that is still at least on_screen_size big, when size is the full size
+    level = 0
+    while level < MIP_LEVELS and size >> (level + 1) >= on_screen_size:
+        level += 1
+    return level
+
+
+def get_mip_levels(size, on_screen_sizes):
+    # get_mip_level() for an array of on-screen sizes
+    level = np.floor(np.log2(size / np.maximum(on_screen_sizes, 1)))
+    return np.clip(level, 0, MIP_LEVELS).astype(np.int32)
+
+
+def get_runs(mask):
+    # Returns (first, end) index ranges of consecutive True values in mask
+    edges = np.flatnonzero(np.diff(np.concatenate(([False], mask, [False]))))
+    return zip(edges[::2].tolist(), edges[1::2].tolist())
+
+
+def merge_wall_spans():
+    # Groups consecutive wall columns on the same tile face into spans
+    # Door columns, moving push wall columns and portal columns have no face, so they are always drawn one by one
+    global WALL_SPANS
+    global BLUE_PORTAL_WALL_SPANS
+    global RED_PORTAL_WALL_SPANS
+    WALL_SPANS = get_wall_spans(WALLS)
+    BLUE_PORTAL_WALL_SPANS = get_wall_spans(BLUE_PORTAL_WALLS)
+    RED_PORTAL_WALL_SPANS = get_wall_spans(RED_PORTAL_WALLS)
+
+
+def get_wall_spans(walls):
+    # Returns (first, end) column index ranges of walls, every range is drawn with one blit
+    if not SPAN_MERGING:
+        return [(i, i + 1) for i in range(walls.count)]
+
+    count = walls.count
+    display_xs = walls.display_x[:count].tolist()
+    texture_ids = walls.texture_id[:count].tolist()
+    columns = walls.column[:count].tolist()
+    cropping_heights = walls.cropping_height[:count].tolist()
+    heights = walls.height[:count].tolist()
+    shades = walls.shade[:count].tolist()
+    faces = list(zip(walls.face_x[:count].tolist(), walls.face_y[:count].tolist(),
+                     walls.face_vertical[:count].tolist()))
+
+    spans = []
+    first = 0
+    for i in range(1, count):
+        if faces[i][0] == -1 or faces[i] != faces[i - 1] or \
+                display_xs[i] != display_xs[i - 1] + WALL_RES or \
+                texture_ids[i] != texture_ids[i - 1] or \
+                cropping_heights[i] != cropping_heights[i - 1] or \
+                shades[i] != shades[i - 1] or \
+                columns[i] < columns[i - 1] or \
+                abs(heights[i] - heights[first]) > SPAN_HEIGHT_TOLERANCE:
+            spans.append((first, i))
+            first = i
+    if count:
+        spans.append((first, count))
+    return spans
+
+
+def raycast(start_pos, ray_dir, create_walls=False, portal_depth=0,
             previous_portal=None, previous_rayangle_diff=0.0, previous_delta_x=0.0, previous_delta_y=0.0):
+    # portal_depth is the amount of portals the ray has gone through, previous_rayangle_diff is their total rotation
     def check_collision(collision_x, collision_y, x_step, y_step):
         # x_step is the distance needed to move in x to get to the next similar type interception
         # y_step is the distance needed to move in y to get to the next similar type interception
@@ -2029,16 +3208,8 @@ def raycast(start_pos, rayangle, create_walls=False, can_go_through_portal=False
                         texture = TILE_VALUES_INFO[TILEMAP[map_y][map_x]].texture
                         column += int(TEXTURE_SIZE * abs(surface_offset - door.closed_state))
                         delta_x, delta_y = get_delta_x_and_y()
-                        if can_go_through_portal:
-                            WALLS.append(WallColumn(delta_x, delta_y, texture, column))
-                            BLUE_PORTAL_WALLS.append(None)
-                            RED_PORTAL_WALLS.append(None)
-                        elif previous_portal == BLUE_PORTAL:
-                            BLUE_PORTAL_WALLS.append(WallColumn(delta_x, delta_y, texture, column))
-                            RED_PORTAL_WALLS.append(None)
-                        else:
-                            RED_PORTAL_WALLS.append(WallColumn(delta_x, delta_y, texture, column))
-                            BLUE_PORTAL_WALLS.append(None)
+                        get_wall_layer(portal_depth, previous_portal).add(delta_x, delta_y, texture, column,
+                                                                          light_shade=LIGHT_MAP[map_y, map_x])
                         return True
                     else:
                         return collision_x, collision_y
@@ -2086,13 +3257,12 @@ def raycast(start_pos, rayangle, create_walls=False, can_go_through_portal=False
                             texture = TILE_VALUES_INFO[TILEMAP[map_y][map_x]].texture
                             column += int(TEXTURE_SIZE * surface_offset)
                             delta_x, delta_y = get_delta_x_and_y()
-                            if can_go_through_portal:
-                                SEETHROUGH_WALLS.append(WallColumn(delta_x, delta_y, texture, column))
-                            else:
-                                PORTAL_SEETHROUGH_WALLS.append(WallColumn(delta_x, delta_y, texture, column))
+                            get_seethrough_layer(portal_depth).add(delta_x, delta_y, texture, column,
+                                                                   light_shade=LIGHT_MAP[map_y, map_x])
                         break
 
         else:
+            face = (map_x, map_y, abs(x_step) == 1)
             if (map_x, map_y) in PUSH_WALL_TILES:
                 for push_wall in PUSH_WALLS:
                     if (push_wall.x, push_wall.y) == (map_x, map_y):
@@ -2101,6 +3271,7 @@ def raycast(start_pos, rayangle, create_walls=False, can_go_through_portal=False
                             collision_y += y_step * push_wall.tile_offset
                             if (int(collision_x), int(collision_y)) != (map_x, map_y):
                                 return  # Ray misses the pushwall
+                            face = None  # Moving push wall isn't on the tile side, so its columns aren't merged
                         break
 
             if create_walls:
@@ -2141,42 +3312,23 @@ def raycast(start_pos, rayangle, create_walls=False, can_go_through_portal=False
                     if (abs(x_step) == 1 and portal.vertical and portal.side == (1 - a)) or \
                             (abs(x_step) != 1 and not portal.vertical and portal.side == (1 - b)):
                         # Ray hits portal
-                        if can_go_through_portal:
-                            if other_portal.created:
-                                # Draw non-closed wall
-                                WALLS.append(WallColumn(delta_x, delta_y, portal.texture, column))
+                        layer = get_wall_layer(portal_depth, previous_portal)
+                        if other_portal.created and portal_depth < MAX_PORTAL_DEPTH and \
+                                len(PORTAL_RAYS) < PORTAL_RAY_BUDGET:
+                            # Draw non-closed wall
+                            layer.add(delta_x, delta_y, portal.texture, column)
 
-                                rayangle_diff = get_rayangle_diff(portal, other_portal)
+                            rayangle_diff = get_rayangle_diff(portal, other_portal)
 
-                                if other_portal.vertical:
-                                    start_x = other_portal.map_x + other_portal.side
-                                    if other_portal.side == 1:
-                                        start_y = other_portal.map_y + surface_offset
-                                    else:
-                                        start_y = other_portal.map_y + (1 - surface_offset)
-                                else:
-                                    start_y = other_portal.map_y + other_portal.side
-                                    if other_portal.side == 1:
-                                        start_x = other_portal.map_x + (1 - surface_offset)
-                                    else:
-                                        start_x = other_portal.map_x + surface_offset
+                            start_x, start_y = get_portal_exit(other_portal, surface_offset)
 
-                                raycast((start_x, start_y), rayangle + rayangle_diff,
-                                        create_walls=True, can_go_through_portal=False,
-                                        previous_portal=portal, previous_rayangle_diff=rayangle_diff,
-                                        previous_delta_x=delta_x, previous_delta_y=delta_y)
-                            else:
-                                # Draw closed wall
-                                WALLS.append(WallColumn(delta_x, delta_y, portal.closed_texture, column))
-                                BLUE_PORTAL_WALLS.append(None)
-                                RED_PORTAL_WALLS.append(None)
-                        elif previous_portal == BLUE_PORTAL:
-                            # Draw closed portalwall
-                            BLUE_PORTAL_WALLS.append(WallColumn(delta_x, delta_y, portal.closed_texture, column))
-                            RED_PORTAL_WALLS.append(None)
+                            # Cast later together with other rays going through portals in send_portal_rays()
+                            PORTAL_RAYS.append((DISPLAY_X, (start_x, start_y), rotated(ray_dir, rayangle_diff), portal,
+                                                add_rayangle_diffs(previous_rayangle_diff, rayangle_diff),
+                                                delta_x, delta_y, portal_depth + 1))
                         else:
-                            RED_PORTAL_WALLS.append(WallColumn(delta_x, delta_y, portal.closed_texture, column))
-                            BLUE_PORTAL_WALLS.append(None)
+                            # Draw closed wall, also when there's no ray budget or portal depth left
+                            layer.add(delta_x, delta_y, portal.closed_texture, column)
                         return True
 
                 # Just a normal wall
@@ -2184,16 +3336,13 @@ def raycast(start_pos, rayangle, create_walls=False, can_go_through_portal=False
                     texture = Door.side_texture
                 else:
                     texture = TILE_VALUES_INFO[TILEMAP[map_y][map_x]].texture
-                if can_go_through_portal:
-                    WALLS.append(WallColumn(delta_x, delta_y, texture, column))
-                    BLUE_PORTAL_WALLS.append(None)
-                    RED_PORTAL_WALLS.append(None)
-                elif previous_portal == BLUE_PORTAL:
-                    BLUE_PORTAL_WALLS.append(WallColumn(delta_x, delta_y, texture, column))
-                    RED_PORTAL_WALLS.append(None)
+                # Lit by the tile the ray came from
+                if abs(x_step) == 1:
+                    light_shade = LIGHT_MAP[map_y, map_x - int(x_step)]
                 else:
-                    RED_PORTAL_WALLS.append(WallColumn(delta_x, delta_y, texture, column))
-                    BLUE_PORTAL_WALLS.append(None)
+                    light_shade = LIGHT_MAP[map_y - int(y_step), map_x]
+                get_wall_layer(portal_depth, previous_portal).add(delta_x, delta_y, texture, column, face,
+                                                                  light_shade)
                 return True
             else:
                 return collision_x, collision_y
@@ -2217,29 +3366,32 @@ def raycast(start_pos, rayangle, create_walls=False, can_go_through_portal=False
     #     -------|------- 0 radians
     #  pi  a = 0 | a = 1  +
     #      b = 1 | b = 1
-    rayangle = fixed_angle(rayangle + 0.0000001)
-    tan_rayangle = tan(rayangle)
-
-    if abs(rayangle) < pi / 2:
+    # Ray direction doesn't have to be normalized, only the ratio of its components is used
+    ray_dir_x, ray_dir_y = ray_dir
+    if not ray_dir_x:
+        ray_dir_x = 0.0000001
+    if not ray_dir_y:
+        ray_dir_y = 0.0000001
+    tan_rayangle = ray_dir_y / ray_dir_x
+
+    if ray_dir_x > 0:
         a = 1
         start_x = start_pos[0] + 0.0000001
         tile_step_x = 1
-        y_step = tan_rayangle
     else:
         a = 0
         start_x = start_pos[0] - 0.0000001
         tile_step_x = -1
-        y_step = -tan_rayangle
-    if rayangle > 0:
+    y_step = ray_dir_y / abs(ray_dir_x)
+    if ray_dir_y > 0:
         b = 1
         start_y = start_pos[1] + 0.0000001
         tile_step_y = 1
-        x_step = 1 / tan_rayangle
     else:
         b = 0
         start_y = start_pos[1] - 0.0000001
         tile_step_y = -1
-        x_step = 1 / -tan_rayangle
+    x_step = ray_dir_x / abs(ray_dir_y)
 
     x = int(start_x)
     y = int(start_y)
@@ -2249,11 +3401,21 @@ def raycast(start_pos, rayangle, create_walls=False, can_go_through_portal=False
     y_intercept = y + dy + (a - dx) * tan_rayangle
     x += a
     y += b
+    max_dist = inf  # In ray direction lengths, like in cast_rays()
+    if create_walls:
+        TILE_ARRAYS.visible[int(start_y), int(start_x)] = True
+        if MAX_DRAW_DIST:
+            max_dist = MAX_DRAW_DIST - (previous_delta_x * PLAYER.dir_x + previous_delta_y * PLAYER.dir_y)
 
     while True:
         while interception_horizontal():
             map_x = int(x_intercept)
             map_y = y - (1 - b)
+            if create_walls:
+                if (y - start_pos[1]) / ray_dir_y > max_dist:
+                    get_wall_layer(portal_depth, previous_portal).add_missed(DISPLAY_X)  # Nothing is drawn past it
+                    return
+                TILE_ARRAYS.visible[map_y, map_x] = True  # Same as cast_rays()
             if (map_x, map_y) not in EMPTY_TILES:
                 collision = check_collision(x_intercept, y, x_step, tile_step_y)
                 if collision:
@@ -2263,6 +3425,11 @@ def raycast(start_pos, rayangle, create_walls=False, can_go_through_portal=False
         while interception_vertical():
             map_x = x - (1 - a)
             map_y = int(y_intercept)
+            if create_walls:
+                if (x - start_pos[0]) / ray_dir_x > max_dist:
+                    get_wall_layer(portal_depth, previous_portal).add_missed(DISPLAY_X)
+                    return
+                TILE_ARRAYS.visible[map_y, map_x] = True
             if (map_x, map_y) not in EMPTY_TILES:
                 collision = check_collision(x, y_intercept, tile_step_x, y_step)
                 if collision:
@@ -2285,6 +3452,8 @@ def events():
                     update_sound_channels()
                 elif event.key == K_F1:
                     SHOW_FPS = not SHOW_FPS
+                elif event.key == K_F2:
+                    switch_raycaster()
                 elif event.key == K_RETURN:
                     QUIT = True
         pygame.mouse.get_rel()
@@ -2297,6 +3466,8 @@ def events():
                     update_sound_channels()
                 elif event.key == K_F1:
                     SHOW_FPS = not SHOW_FPS
+                elif event.key == K_F2:
+                    switch_raycaster()
                 elif event.key == K_q:
                     BLUE_PORTAL.create_portal()
                 elif event.key == K_r:
@@ -2331,6 +3502,7 @@ def events():
                     elif tile.desc == 'End-trigger':
                         play_sound(SWITCH_SOUND, 0, (action_x + 0.5, action_y + 0.5))
                         TILEMAP[action_y][action_x] += 1  # Change trigger block texture
+                        update_tilemap_arrays(action_x, action_y)
                         LEVEL.finish()
                 else:
                     key = pygame.key.name(event.key)
@@ -2348,17 +3520,27 @@ def events():
                        play_sound(WEAPON_MODEL.weapon.sounds.no_ammo, WeaponModel.channel_id)
 
 
+def switch_raycaster():
+    global RAYCASTER
+    if RAYCASTER == 'vectorized':
+        RAYCASTER = 'parallel'
+    elif RAYCASTER == 'parallel':
+        RAYCASTER = 'scalar'
+    else:
+        RAYCASTER = 'vectorized'
+    MESSAGES.append(Message('Raycaster: {}'.format(RAYCASTER)))
+
+
 def update_gameobjects():
     for d in DOORS:
         d.move()
     for p in PUSH_WALLS:
         p.move()
-    for o in OBJECTS:
-        o.update()
     for e in EXPLOSIVES:
         e.update()
     for e in ENEMIES:
         e.update()
+    SPRITE_PROJECTION.project(WALLS)
     for m in MESSAGES:
         m.update()
     PLAYER_MODEL.update()
@@ -2368,8 +3550,10 @@ def update_gameobjects():
 def create_portal_objects():
     global PORTAL_OBJECTS
     PORTAL_OBJECTS = []
-    for o in OBJECTS + EXPLOSIVES + ENEMIES + [PLAYER_MODEL]:
-        o.create_portal_clones()
+    for o in OBJECTS + EXPLOSIVES + ENEMIES:
+        if VISIBLE_TILES[int(o.y), int(o.x)]:  # Only rays through portals can reach clones
+            o.create_portal_clones()
+    PLAYER_MODEL.create_portal_clones()
 
 
 def handle_objects_under_player():
@@ -2423,6 +3607,7 @@ def handle_objects_under_player():
             TILEMAP[int(PLAYER.y)][int(PLAYER.x)] = 0
             for c, o in enumerate(OBJECTS):
                 if (int(o.x), int(o.y)) == (int(PLAYER.x), int(PLAYER.y)):
+                    o.visible_to_player = False  # Already projected this frame
                     del OBJECTS[c]
                     break
 
@@ -2437,7 +3622,10 @@ def draw_hud():
     # FPS counter
     if SHOW_FPS:
         fps_counter = render_text(str(ceil(CLOCK.get_fps())), Colour.green, size=font_size)
-        display_text(2, 0, fps_counter)
+        wall_res = render_text('Wall res: {}'.format(WALL_RES), Colour.green, size=Message.font_size)
+        portal_rays = render_text('Portal rays: {}/{}'.format(len(PORTAL_RAYS), PORTAL_RAY_BUDGET), Colour.green,
+                                  size=Message.font_size)
+        display_text(2, 0, fps_counter, wall_res, portal_rays)
 
     # Weapon HUD
     WEAPON_MODEL.draw()
@@ -2472,47 +3660,81 @@ def draw_hud():
 
 def draw_background():
     # Sky texture
-    angle = PLAYER.viewangle + pi
-    while angle > pi / 2:
-        angle -= pi / 2
-    texture_offset = angle / (pi / 2)  # ranges from 0 to 1
-    DISPLAY.blit(LEVEL.skytexture, (0, 0), (D_W * texture_offset, 0, D_W, H_H))
-
-    # Floor
-    pygame.draw.rect(DISPLAY, Colour.grey, (0, H_H, D_W, H_H))
+    if not FLOOR_CASTER or FLOOR_CASTER.ceiling_texels is None:
+        angle = PLAYER.viewangle + pi
+        while angle > pi / 2:
+            angle -= pi / 2
+        texture_offset = angle / (pi / 2)  # ranges from 0 to 1
+        VIEW.blit(LEVEL.skytexture, (0, 0), (R_W * texture_offset, 0, R_W, H_H))
+
+    # Floor, and ceiling if there's no sky
+    if FLOOR_CASTER:
+        FLOOR_CASTER.draw()
+    else:
+        pygame.draw.rect(VIEW, Colour.grey, (0, H_H, R_W, R_H - H_H))
+
+
+def draw_sorted(walls, sprites, fog=None):
+    # Draws see-through wall columns and sprites from furthest to closest
+    # Sprites have to be sorted from furthest to closest already, fog is for walls drawn after Fog.draw()
+    wall_order = np.argsort(-walls.perp_dist[:walls.count], kind='stable')
+    wall_dists = walls.perp_dist[wall_order].tolist()
+
+    # Walls further away than the next sprite are drawn before it
+    first = 0
+    for s in sprites:
+        end = first
+        while end < len(wall_dists) and wall_dists[end] >= s.perp_dist:
+            end += 1
+        if end > first:
+            walls.draw_columns(wall_order[first:end], fog)
+            first = end
+        s.draw()
+    if len(wall_dists) > first:
+        walls.draw_columns(wall_order[first:], fog)
 
 
 def draw_frame():
-    # Draw background
-    draw_background()
-
-    # Draw portal walls
-    for w in BLUE_PORTAL_WALLS + RED_PORTAL_WALLS:
-        if w:
-            w.draw()
-
-    # Draw everything inside portals
-    to_draw = PORTAL_SEETHROUGH_WALLS
+    to_draw = []
     for o in PORTAL_OBJECTS:
         if o.visible_to_player:
             to_draw.append(o)
-    to_draw.sort(key=lambda x: x.perp_dist, reverse=True)
-    for s in to_draw:
-        s.draw()
+    if not WALLS_REUSED or to_draw:
+        WALL_SNAPSHOT.image = None
 
-    # Draw regular walls
-    for w in WALLS:
-        if w:
-            w.draw()
+    # Draw background
+    if WALL_SNAPSHOT.image is None:
+        draw_background()
+
+    if WALL_SNAPSHOT.image is not None:
+        # Nothing behind the sprites has changed
+        WALL_SNAPSHOT.restore()
+    else:
+        # Draw everything seen through more than one portal, from furthest to closest
+        to_draw.sort(key=attrgetter('perp_dist'), reverse=True)  # Clones are new every frame
+        draw_sorted(DEEP_PORTAL_WALLS, [o for o in to_draw if isinstance(o.walls, PortalView)])
+
+        # Draw portal walls
+        BLUE_PORTAL_WALLS.draw_spans(BLUE_PORTAL_WALL_SPANS)
+        RED_PORTAL_WALLS.draw_spans(RED_PORTAL_WALL_SPANS)
+
+        # Draw everything inside portals
+        draw_sorted(PORTAL_SEETHROUGH_WALLS, [o for o in to_draw if not isinstance(o.walls, PortalView)])
+
+        # Draw regular walls
+        WALLS.draw_spans(WALL_SPANS)
+        if FOG:
+            FOG.draw(WALLS)
+        if WALLS_REUSED and not to_draw:
+            WALL_SNAPSHOT.save()
 
     # Draw everything in front of walls
-    to_draw = SEETHROUGH_WALLS
-    for s in OBJECTS + EXPLOSIVES + ENEMIES:  # Dont draw player model here
-        if s.visible_to_player:
-            to_draw.append(s)
-    to_draw.sort(key=lambda x: x.perp_dist, reverse=True)
-    for s in to_draw:
-        s.draw()
+    to_draw = [s for s in SPRITE_PROJECTION.visible if s.visible_to_player]  # Dont draw player model here
+    draw_sorted(SEETHROUGH_WALLS, to_draw, FOG)
+
+    # 3D view is upscaled to display once, HUD is drawn at display resolution
+    if VIEW is not DISPLAY:
+        pygame.transform.scale(VIEW, (D_W, D_H), DISPLAY)
 
     #if PLAYER.hp:
     draw_hud()
@@ -2574,31 +3796,43 @@ def draw_black_overlay(alpha):
 def game_loop():
     global TIME
     while not QUIT:
+        frame_start = time.perf_counter()
         if not PAUSED and PLAYER.hp:
             TIME += 1
             PLAYER.rotate(pygame.mouse.get_rel()[0] * SENSITIVITY)
             PLAYER.handle_movement()
 
+        stage_start = time.perf_counter()
         send_rays()
+        column_time = time.perf_counter() - stage_start
         if not PAUSED:
             update_gameobjects()
             handle_objects_under_player()
         create_portal_objects()
         events()
+        stage_start = time.perf_counter()
         draw_frame()
+        column_time += time.perf_counter() - stage_start
         if PAUSED:
             draw_pause_overlay()
 
         pygame.display.flip()
+        if ADAPTIVE_WALL_RES and not PAUSED:
+            WALL_RES_GOVERNOR.update(time.perf_counter() - frame_start, column_time)
         CLOCK.tick(30)
 
 
 if __name__ == '__main__':
     import sys
     import os
+    import time
     import random
-    from math import sin, cos, tan, atan2, sqrt, pi, ceil
+    import weakref
+    from collections import OrderedDict
+    from operator import attrgetter
+    from math import sin, cos, tan, atan2, sqrt, pi, ceil, inf
 
+    import numpy as np
     import pygame
     from pygame.locals import *
 
@@ -2607,18 +3841,23 @@ if __name__ == '__main__':
     import game.sounds as sounds
     import game.enemies as enemies
     import game.weapons as weapons
+    import game.raycasting as raycasting
 
-    H_W = int(D_W / 2)  # Display half width
-    H_H = int(D_H / 2)  # Display half height
+    H_W = int(R_W / 2)  # 3D view half width
+    H_H = int(R_H / 2)  # 3D view half height
 
     # Set drawable constant
-    Drawable.constant = int(0.65 * D_H)
+    Drawable.constant = int(0.65 * R_H)
 
     # Pygame stuff
     pygame.mixer.init(11025, -16, 2, 256)
     pygame.init()
     pygame.display.set_caption('Raycaster')
     DISPLAY = pygame.display.set_mode((D_W, D_H))
+    if (R_W, R_H) == (D_W, D_H):
+        VIEW = DISPLAY  # Surface the 3D view is drawn on
+    else:
+        VIEW = pygame.Surface((R_W, R_H)).convert()
     CLOCK = pygame.time.Clock()
     pygame.mouse.set_visible(False)
     pygame.event.set_grab(True)
@@ -2644,6 +3883,59 @@ if __name__ == '__main__':
 
     # Textures
     Door.side_texture = graphics.get_door_side_texture()
+    PORTAL_TEXTURES = graphics.get_portal_textures()
+
+    wall_textures = [Door.side_texture]
+    wall_textures.extend(PORTAL_TEXTURES)
+    for tile in TILE_VALUES_INFO.values():
+        if tile.type in ('Wall', 'Door', 'Thin Wall'):
+            wall_textures.append(tile.texture)
+    SHADING = None
+    if SHADE_LEVELS:
+        SHADING = Shading(SHADE_LEVELS, SHADE_DIST, DARKEST_SHADE)
+    elif UNLIT_SHADE:
+        SHADING = Shading(UNLIT_SHADE, None, DARKEST_SHADE)  # Only lamp lighting, unlit tiles get the darkest shade
+    TEXTURE_STRIPS = TextureStrips(wall_textures)
+    SCALED_SPRITES = ScaledSpriteCache(SCALED_SPRITE_CACHE_SIZE * 1024**2, R_W)
+    SPRITE_PROJECTION = SpriteProjection()
+    MIPMAPS = MipMaps()
+    for tile in TILE_VALUES_INFO.values():
+        if tile.type in ('Object', 'Enemy'):
+            MIPMAPS.add(tile.texture)
+    FOG = None
+    if MAX_DRAW_DIST and FOG_START:
+        FOG = Fog(FOG_START, MAX_DRAW_DIST, FOG_COLOUR)
+    FLOOR_CASTER = None
+    if FLOOR_TEXTURE:
+        FLOOR_CASTER = FloorCaster(graphics.get_floor_texture(FLOOR_TEXTURE),
+                                   CEILING_TEXTURE and graphics.get_floor_texture(CEILING_TEXTURE))
+    WALL_RES_GOVERNOR = WallResGovernor()
+
+    TILE_TEXTURE_IDS = np.zeros(max(TILE_VALUES_INFO) + 1, dtype=np.int32)  # Wall tile value -> texture id
+    for tile_value, tile in TILE_VALUES_INFO.items():
+        if tile.type in ('Wall', 'Door', 'Thin Wall'):
+            TILE_TEXTURE_IDS[tile_value] = TEXTURE_STRIPS.texture_ids[tile.texture]
+
+    # Wall column layers filled by send_rays()
+    WALLS = ColumnLayer(R_W)
+    BLUE_PORTAL_WALLS = ColumnLayer(R_W)
+    RED_PORTAL_WALLS = ColumnLayer(R_W)
+    SEETHROUGH_WALLS = ColumnLayer(R_W, see_through=True)
+    PORTAL_SEETHROUGH_WALLS = ColumnLayer(R_W, see_through=True)
+    DEEP_PORTAL_WALLS = ColumnLayer(R_W)  # Everything seen through more than one portal
+    WALL_LAYERS = (WALLS, BLUE_PORTAL_WALLS, RED_PORTAL_WALLS, SEETHROUGH_WALLS, PORTAL_SEETHROUGH_WALLS,
+                   DEEP_PORTAL_WALLS)
+    TILES_VERSION = 0
+    TILE_ARRAYS = None  # Created for every level in Level.start()
+    VISIBLE_TILES = None  # Tiles sprites can be seen on, see update_visible_tiles()
+    LIGHT_MAP = None  # Baked for every level in Level.start(), see bake_light_map()
+    RAYCAST_POOL = None  # Started when parallel raycaster is first used
+    RAYCAST_WORKER_COUNT = raycasting.get_worker_count(RAYCAST_WORKERS)  # Parallel raycaster needs at least 2
+    WALLS_KEY = None  # Camera, raycaster and tiles the walls in WALL_LAYERS were cast with
+    WALLS_REUSED = False
+    PORTAL_RAYS = []  # Rays continuing from the other portal this frame, see send_portal_rays()
+    DEEP_PORTAL_VIEWS = []  # Views through more than one portal this frame, see get_deep_portal_views()
+    WALL_SNAPSHOT = WallSnapshot()
 
     QUIT = False
     PAUSED = False
@@ -2653,3 +3945,6 @@ if __name__ == '__main__':
     LEVEL = Level()
     LEVEL.start(9)
     pygame.quit()
+    if RAYCAST_POOL:
+        RAYCAST_POOL.close()
+    TILE_ARRAYS.close()
@@ -0,0 +1,357 @@
+import multiprocessing
+import os
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from game.settings import TEXTURE_SIZE
+
+# Tile kinds in the tilemap array copy that cast_rays() steps through
+EMPTY = 0  # Rays go through these tiles
+WALL = 1  # Regular walls, cast_rays() can fully resolve these
+SPECIAL = 2  # Thin walls, these need the scalar raycast() to resolve
+DOOR = 3  # Door in the middle of the tile, its offset is how much of the door is closed (0 to 1)
+PUSH_WALL = 4  # Wall that has been pushed offset deep into the tile (0 to 1)
+
+
+class TileArrays:
+    # Tilemap copies that cast_rays() steps through, all indexed [y, x] like TILEMAP
+    # Shared arrays are in shared memory, so RayCastPool workers can read them without copying
+    # Passing names of an existing shared TileArrays attaches to its memory instead of creating new
+    # Only the process that created the memory unlinks it, workers share its resource tracker
+
+    def __init__(self, width, height, shared=False, names=None):
+        self.shape = (height, width)
+        self.shared = shared or bool(names)
+        self.memory = []
+        self.kinds = self.create_array(np.int8, names and names[0])
+        self.values = self.create_array(np.int64, names and names[1])
+        self.offsets = self.create_array(np.float64, names and names[2])
+        self.visible = self.create_array(np.bool_, names and names[3])  # Tiles rays went through, see cast_rays()
+
+    def create_array(self, dtype, name):
+        if not self.shared:
+            return np.zeros(self.shape, dtype=dtype)
+        if name:
+            memory = SharedMemory(name=name)
+        else:
+            memory = SharedMemory(create=True, size=int(np.prod(self.shape)) * np.dtype(dtype).itemsize)
+        self.memory.append(memory)
+        array = np.ndarray(self.shape, dtype=dtype, buffer=memory.buf)
+        if not name:
+            array[:] = 0
+        return array
+
+    def get_names(self):
+        return [memory.name for memory in self.memory]
+
+    def copy(self, shared=False):
+        tiles = TileArrays(self.shape[1], self.shape[0], shared)
+        for name in ('kinds', 'values', 'offsets', 'visible'):
+            getattr(tiles, name)[:] = getattr(self, name)
+        return tiles
+
+    def close(self, unlink=True):
+        self.kinds = self.values = self.offsets = self.visible = None  # Arrays have to be gone before memory can be closed
+        for memory in self.memory:
+            memory.close()
+            if unlink:
+                memory.unlink()
+        self.memory = []
+
+
+class RayHits:
+    # Per-ray results of cast_rays(), every attribute is an array with one value per ray
+    def __init__(self, tiles, start_x, start_y, ray_dir_x, ray_dir_y,
+                 map_x, map_y, prev_x, prev_y, vertical, dist, column, missed):
+        self.ray_dir_x = ray_dir_x
+        self.ray_dir_y = ray_dir_y
+        self.map_x = map_x  # Hit tile
+        self.map_y = map_y
+        self.prev_x = prev_x  # Tile the ray was in before hitting the wall
+        self.prev_y = prev_y
+        self.vertical = vertical  # True if ray hit a vertical (x = const) tile side
+        self.dist = dist  # Distance travelled in ray direction lengths
+        self.delta_x = dist * ray_dir_x  # Collision point relative to ray start
+        self.delta_y = dist * ray_dir_y
+        self.collision_x = start_x + self.delta_x
+        self.collision_y = start_y + self.delta_y
+        self.value = tiles.values[map_y, map_x]  # Tile value at the hit tile
+        self.kind = tiles.kinds[map_y, map_x]
+        self.offset = tiles.offsets[map_y, map_x]
+        self.column = column  # Texture column, same layout as in raycast()
+        self.missed = missed  # True if ray got further than max_dist without hitting anything
+
+    def get_surface_offset(self):
+        return get_surface_offset(self.vertical, self.ray_dir_x, self.ray_dir_y, self.collision_x, self.collision_y)
+
+
+def get_surface_offset(vertical, ray_dir_x, ray_dir_y, collision_x, collision_y):
+    # Position of collision on the hit tile side from 0 to 1, the same way raycast() calculates it for walls
+    return np.where(
+        vertical,
+        np.where(ray_dir_x > 0, collision_y - np.floor(collision_y), np.ceil(collision_y) - collision_y),
+        np.where(ray_dir_y > 0, np.ceil(collision_x) - collision_x, collision_x - np.floor(collision_x))
+    )
+
+
+def cast_rays(tiles, start_x, start_y, ray_dir_x, ray_dir_y, max_dist=np.inf):
+    # Steps all rays through the tilemap at once using DDA
+    # start_(x/y) and max_dist can either be a number or an array with one value per ray
+    # Rays that would enter a tile further than max_dist ray direction lengths away are stopped as missed
+    # Every ray stops at the first tile that is not EMPTY, tiles outside the map count as WALL
+    # Doors and push walls are only hit if the ray reaches the door or the pushed wall before leaving the tile
+    # Every tile a ray enters is marked in tiles.visible, it's up to the caller to clear it
+    ray_dir_x = np.asarray(ray_dir_x, dtype=float)
+    ray_dir_y = np.asarray(ray_dir_y, dtype=float)
+    rays = ray_dir_x.size
+    start_x = np.broadcast_to(np.asarray(start_x, dtype=float), (rays,))
+    start_y = np.broadcast_to(np.asarray(start_y, dtype=float), (rays,))
+    max_dist = np.broadcast_to(np.asarray(max_dist, dtype=float), (rays,))
+    limited = bool(np.isfinite(max_dist).any())
+    map_h, map_w = tiles.shape
+
+    with np.errstate(divide='ignore'):
+        delta_dist_x = np.abs(1 / ray_dir_x)
+        delta_dist_y = np.abs(1 / ray_dir_y)
+
+    map_x = np.floor(start_x).astype(int)
+    map_y = np.floor(start_y).astype(int)
+    step_x = np.where(ray_dir_x < 0, -1, 1)
+    step_y = np.where(ray_dir_y < 0, -1, 1)
+    with np.errstate(invalid='ignore'):  # 0 * inf for rays parallel to an axis
+        side_dist_x = np.where(ray_dir_x < 0, start_x - map_x, map_x + 1 - start_x) * delta_dist_x
+        side_dist_y = np.where(ray_dir_y < 0, start_y - map_y, map_y + 1 - start_y) * delta_dist_y
+    side_dist_x[np.isnan(side_dist_x)] = np.inf
+    side_dist_y[np.isnan(side_dist_y)] = np.inf
+    vertical = np.zeros(rays, dtype=bool)
+    missed = np.zeros(rays, dtype=bool)
+    depth = np.zeros(rays)  # How deep into the hit tile the hit surface is, in tiles
+    inside = (map_x >= 0) & (map_x < map_w) & (map_y >= 0) & (map_y < map_h)
+    tiles.visible[map_y[inside], map_x[inside]] = True
+
+    # Only rays that haven't hit anything yet are stepped
+    active = np.arange(rays)
+    for _ in range(map_w + map_h):
+        if not active.size:
+            break
+        x_side = side_dist_x[active] < side_dist_y[active]
+        x_rays = active[x_side]
+        y_rays = active[~x_side]
+        map_x[x_rays] += step_x[x_rays]
+        side_dist_x[x_rays] += delta_dist_x[x_rays]
+        map_y[y_rays] += step_y[y_rays]
+        side_dist_y[y_rays] += delta_dist_y[y_rays]
+        vertical[active] = x_side
+
+        if limited:
+            # Distance where the ray enters its new tile
+            with np.errstate(invalid='ignore'):  # inf - inf on the axis the ray didn't step
+                enter_dist = np.where(x_side, side_dist_x[active] - delta_dist_x[active],
+                                      side_dist_y[active] - delta_dist_y[active])
+            too_far = enter_dist > max_dist[active]
+            if too_far.any():
+                missed[active[too_far]] = True
+                active = active[~too_far]
+
+        ray_map_x = map_x[active]
+        ray_map_y = map_y[active]
+        inside = (ray_map_x >= 0) & (ray_map_x < map_w) & (ray_map_y >= 0) & (ray_map_y < map_h)
+        tiles.visible[ray_map_y[inside], ray_map_x[inside]] = True
+        kind = np.full(active.size, WALL, dtype=np.int8)
+        kind[inside] = tiles.kinds[ray_map_y[inside], ray_map_x[inside]]
+        hit = kind != EMPTY
+
+        offset_tiles = np.flatnonzero((kind == DOOR) | (kind == PUSH_WALL))
+        if offset_tiles.size:
+            offset_rays = active[offset_tiles]
+            offset = tiles.offsets[map_y[offset_rays], map_x[offset_rays]]
+            door = kind[offset_tiles] == DOOR
+            tile_depth = np.where(door, 0.5, offset)
+
+            # Distance where ray meets the door or push wall, it has to be before the ray leaves the tile
+            ray_vertical = vertical[offset_rays]
+            delta_dist = np.where(ray_vertical, delta_dist_x[offset_rays], delta_dist_y[offset_rays])
+            side_dist = np.where(ray_vertical, side_dist_x[offset_rays], side_dist_y[offset_rays])
+            other_side_dist = np.where(ray_vertical, side_dist_y[offset_rays], side_dist_x[offset_rays])
+            hit_dist = side_dist - delta_dist + tile_depth * delta_dist
+            offset_hit = (hit_dist < other_side_dist) | (tile_depth == 0)
+
+            # Doors slide open sideways, so the open part of the door can be seen through
+            collision = np.where(ray_vertical,
+                                 start_y[offset_rays] + hit_dist * ray_dir_y[offset_rays],
+                                 start_x[offset_rays] + hit_dist * ray_dir_x[offset_rays])
+            offset_hit &= ~door | (collision - np.floor(collision) < offset)
+
+            hit[offset_tiles] = offset_hit
+            depth[offset_rays[offset_hit]] = tile_depth[offset_hit]
+        active = active[~hit]
+
+    with np.errstate(invalid='ignore'):  # inf - inf on the axis the ray didn't hit
+        dist = np.where(vertical,
+                        side_dist_x - delta_dist_x * (1 - depth),
+                        side_dist_y - delta_dist_y * (1 - depth))
+    dist[missed] = max_dist[missed]
+    collision_x = start_x + dist * ray_dir_x
+    collision_y = start_y + dist * ray_dir_y
+
+    # Texture column the same way raycast() does it, vertical sides use the right half of the texture
+    surface_offset = get_surface_offset(vertical, ray_dir_x, ray_dir_y, collision_x, collision_y)
+    column = np.minimum((surface_offset * TEXTURE_SIZE).astype(int), TEXTURE_SIZE - 1) + vertical * TEXTURE_SIZE
+
+    prev_x = np.where(vertical, map_x - step_x, map_x)
+    prev_y = np.where(vertical, map_y, map_y - step_y)
+
+    # Rays that left the map report the closest edge tile as their hit tile, but its kind as WALL
+    outside = (map_x < 0) | (map_x >= map_w) | (map_y < 0) | (map_y >= map_h)
+    map_x = np.clip(map_x, 0, map_w - 1)
+    map_y = np.clip(map_y, 0, map_h - 1)
+
+    # Door texture moves with the door instead of depending on the side it's seen from
+    door = (tiles.kinds[map_y, map_x] == DOOR) & ~outside
+    if door.any():
+        door_surface_offset = np.where(vertical, collision_y - np.floor(collision_y), collision_x - np.floor(collision_x))
+        door_column = (TEXTURE_SIZE * np.abs(door_surface_offset - tiles.offsets[map_y, map_x])).astype(int)
+        column = np.where(door, door_column + vertical * TEXTURE_SIZE, column)
+
+    hits = RayHits(tiles, start_x, start_y, ray_dir_x, ray_dir_y,
+                   map_x, map_y, prev_x, prev_y, vertical, dist, column, missed)
+    hits.kind[outside] = WALL
+    hits.offset[outside] = 0
+    return hits
+
+
+def cast_strided(tiles, start_x, start_y, ray_dir_x, ray_dir_y, max_dist, cast, needs_own_cast):
+    # Casts only rays where cast is True, every other ray is a copy of the closest cast ray on its left
+    # All arguments but tiles have one value per ray, cast[0] has to be True
+    # needs_own_cast(hits) returns a mask of hits that can't be copied, rays copied from those are cast too
+    # Returns hits of the cast rays and the mask of rays that ended up cast
+    max_dist = np.broadcast_to(np.asarray(max_dist, dtype=float), cast.shape)
+    cast = cast.copy()
+    hits = cast_rays(tiles, start_x[cast], start_y[cast], ray_dir_x[cast], ray_dir_y[cast], max_dist[cast])
+    copied = needs_own_cast(hits)[np.cumsum(cast) - 1] & ~cast
+    if copied.any():
+        # Rays cast now are their own sources, so one more cast covers them all
+        cast |= copied
+        hits = cast_rays(tiles, start_x[cast], start_y[cast], ray_dir_x[cast], ray_dir_y[cast], max_dist[cast])
+    return hits, cast
+
+
+def get_worker_count(workers):
+    # Workers that are worth starting, one core is left for the game itself
+    return min(workers, (os.cpu_count() or 1) - 1)
+
+
+class RayCastPool:
+    # Worker processes that cast rays in parallel, every worker casts one strip of the rays given to cast()
+    # Tiles, ray directions and results are all in shared memory, so per frame only the strip bounds and
+    # ray start are sent to the workers
+    result_fields = (('map_x', np.int64), ('map_y', np.int64), ('prev_x', np.int64), ('prev_y', np.int64),
+                     ('vertical', bool), ('dist', np.float64), ('column', np.int64), ('missed', bool))
+
+    def __init__(self, workers, max_rays, min_rays):
+        self.min_rays = min_rays  # Least amount of rays worth sending to a worker
+        self.max_rays = max_rays
+        self.tiles = None
+        self.rays = RayBuffers(max_rays)
+
+        context = multiprocessing.get_context('spawn')
+        self.connections = []
+        self.processes = []
+        for _ in range(workers):
+            connection, worker_connection = context.Pipe()
+            process = context.Process(target=work, args=(worker_connection, self.rays.get_names(), max_rays),
+                                      daemon=True)
+            process.start()
+            worker_connection.close()  # Only the worker's end is left open, so a dead worker can't hang recv()
+            self.connections.append(connection)
+            self.processes.append(process)
+
+    def cast(self, tiles, start_x, start_y, ray_dir_x, ray_dir_y, max_dist=np.inf):
+        # Same as cast_rays() with a single start position and max_dist, tiles have to be shared for the workers
+        rays = len(ray_dir_x)
+        strips = min(len(self.connections), rays // self.min_rays)
+        if strips < 2 or rays > self.max_rays or not tiles.shared:
+            return cast_rays(tiles, start_x, start_y, ray_dir_x, ray_dir_y, max_dist)
+
+        if tiles is not self.tiles:
+            self.tiles = tiles
+            for connection in self.connections:
+                connection.send(('tiles', tiles.get_names(), tiles.shape))
+
+        self.rays.ray_dir_x[:rays] = ray_dir_x
+        self.rays.ray_dir_y[:rays] = ray_dir_y
+        bounds = np.linspace(0, rays, strips + 1).astype(int).tolist()
+        for connection, first, end in zip(self.connections, bounds, bounds[1:]):
+            connection.send(('cast', first, end, start_x, start_y, max_dist))
+        # Every strip's reply is received before raising, so no replies are left over for the next cast
+        replies = [connection.recv() for connection in self.connections[:strips]]
+        for reply in replies:
+            if isinstance(reply, Exception):
+                raise reply
+
+        results = [getattr(self.rays, name)[:rays].copy() for name, _ in RayCastPool.result_fields]
+        return RayHits(tiles, start_x, start_y, ray_dir_x, ray_dir_y, *results)
+
+    def close(self):
+        for connection in self.connections:
+            connection.send(None)
+        for process in self.processes:
+            process.join()
+        self.rays.close()
+
+
+class RayBuffers:
+    # Shared memory ray directions and RayCastPool results
+    def __init__(self, size, names=None):
+        self.memory = []
+        fields = (('ray_dir_x', np.float64), ('ray_dir_y', np.float64)) + RayCastPool.result_fields
+        for field_nr, (name, dtype) in enumerate(fields):
+            if names:
+                memory = SharedMemory(name=names[field_nr])
+            else:
+                memory = SharedMemory(create=True, size=size * np.dtype(dtype).itemsize)
+            self.memory.append(memory)
+            setattr(self, name, np.ndarray((size,), dtype=dtype, buffer=memory.buf))
+        self.fields = [name for name, _ in fields]
+
+    def get_names(self):
+        return [memory.name for memory in self.memory]
+
+    def close(self, unlink=True):
+        for name in self.fields:
+            setattr(self, name, None)
+        for memory in self.memory:
+            memory.close()
+            if unlink:
+                memory.unlink()
+
+
+def work(connection, ray_buffer_names, max_rays):
+    # RayCastPool worker process loop
+    rays = RayBuffers(max_rays, ray_buffer_names)
+    tiles = None
+    while True:
+        message = connection.recv()
+        if message is None:
+            break
+        if message[0] == 'tiles':
+            if tiles:
+                tiles.close(unlink=False)
+            _, names, (height, width) = message
+            tiles = TileArrays(width, height, names=names)
+        else:
+            _, first, end, start_x, start_y, max_dist = message
+            try:
+                hits = cast_rays(tiles, start_x, start_y, rays.ray_dir_x[first:end], rays.ray_dir_y[first:end],
+                                 max_dist)
+                for name, _ in RayCastPool.result_fields:
+                    getattr(rays, name)[first:end] = getattr(hits, name)
+                del hits  # Holds views of tile arrays
+            except Exception as error:
+                connection.send(error)  # RayCastPool.cast() raises it in the game's process
+            else:
+                connection.send(True)
+    if tiles:
+        tiles.close(unlink=False)
+    rays.close(unlink=False)
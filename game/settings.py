@@ -1,7 +1,39 @@
 D_W = 640
 D_H = 480
-WALL_RES = 1  # Lower is better
+WALL_RES = 1  # Lower is better, lowest value WALL_RES can have when ADAPTIVE_WALL_RES is on
 HUD_SAFEZONE = 5  # In pixels
 FOV = 3.14159265359 / 2  # = 90 degrees
 SENSITIVITY = 0.003  # Radians turned per every pixel the mouse has moved horizontally
 TEXTURE_SIZE = 64  # Main texture size
+RAYCASTER = 'vectorized'  # 'vectorized', 'parallel' or 'scalar', can be switched in game with F2
+RAYCAST_WORKERS = 4  # Worker processes used by parallel raycaster, every one of them casts a strip of the screen
+# Capped at one less than the CPU count, with fewer than 2 workers parallel raycaster casts like vectorized
+PARALLEL_MIN_RAYS = 160  # Least amount of rays per strip, narrower views are cast without the workers
+SCALED_SPRITE_CACHE_SIZE = 16  # Max memory used for already scaled sprite frames, in megabytes
+MIP_LEVELS = 3  # Times textures are halved for drawing far away walls and sprites, 0 turns mipmapping off
+FLOOR_TEXTURE = None  # Texture from textures/walls drawn on floors, e.g. 'brownstone', None draws a flat grey floor
+CEILING_TEXTURE = None  # Texture from textures/walls drawn on ceilings, None shows the level's sky (needs FLOOR_TEXTURE)
+SPAN_MERGING = True  # Draws neighbouring wall columns on the same tile side with one blit
+SPAN_HEIGHT_TOLERANCE = 1  # Max height difference in pixels between wall columns merged into one span
+PORTAL_RES = 1  # Only every PORTAL_RES-th wall column seen through portals is ray cast, higher is faster but blurrier
+# PORTAL_RES only covers walls, sprites seen through portals are always drawn at full quality
+RENDER_SCALE = 1  # 3D view is ray cast and drawn at this fraction of display resolution and then upscaled, HUD isn't
+R_W = int(D_W * RENDER_SCALE)  # 3D view width, also the amount of rays
+R_H = int(D_H * RENDER_SCALE)  # 3D view height
+MAX_PORTAL_DEPTH = 6  # How many portals in a row rays can go through, 1 shows portals seen through portals closed
+# Sprites are drawn through every portal rays go through, so MAX_PORTAL_DEPTH limits sprites too
+PORTAL_RAY_BUDGET = R_W * 3  # Max rays going through portals per frame, portals over budget are drawn closed
+# The budget counts rays and not DDA steps: whether a portal column is drawn open has to be known when its ray is
+# queued, before it's cast and its steps are known. Steps of one ray are bounded by the map size and MAX_DRAW_DIST,
+# and rays are cast in vectorized waves whose cost grows with the amount of rays more than with their steps
+MAX_DRAW_DIST = None  # In tiles, rays stop and sprites are culled past this, None draws everything
+FOG_START = None  # Walls, floors and sprites fade into FOG_COLOUR from this distance to MAX_DRAW_DIST, None for no fog
+FOG_COLOUR = (96, 96, 96)
+SHADE_LEVELS = 0  # Darker texture variants for far away walls and sprites, 0 turns distance shading off
+SHADE_DIST = 16  # In tiles, walls and sprites this far away or further get the darkest shade
+DARKEST_SHADE = 0.4  # Brightness of the darkest shade, from 0 (black) to 1 (no shading)
+UNLIT_SHADE = 2  # Shade levels darker walls and sprites away from lamps are, 0 turns lamp lighting off
+# Without SHADE_LEVELS, walls and sprites away from lamps get DARKEST_SHADE and lighting gets UNLIT_SHADE levels
+LAMP_LIGHT_RADIUS = 6  # In tiles, how far light from lamps reaches, it doesn't go through walls
+ADAPTIVE_WALL_RES = False  # Raises WALL_RES up to MAX_WALL_RES while frames take longer than a tick
+MAX_WALL_RES = 4
@@ -41,7 +41,7 @@ def get():
                      spread):
             super().__init__(name, weapon_sheet, sounds, ammo_consumption, shot_column, fire_columns, fire_delay, damage, automatic)
             camera_plane_dist = 0.5 / math.tan(FOV / 2)
-            self.max_x_spread = int(math.tan(spread) * camera_plane_dist * D_W)
+            self.max_x_spread = int(math.tan(spread) * camera_plane_dist * R_W)
 
     class Shotgun(Weapon):
         type = 'Shotgun'
@@ -50,7 +50,7 @@ def get():
                      spread, shot_bullets):
             super().__init__(name, weapon_sheet, sounds, ammo_consumption, shot_column, fire_columns, fire_delay, damage, automatic)
             camera_plane_dist = 0.5 / math.tan(FOV / 2)
-            self.max_x_spread = int(math.tan(spread) * camera_plane_dist * D_W)
+            self.max_x_spread = int(math.tan(spread) * camera_plane_dist * R_W)
             self.shot_bullets = shot_bullets
 
     try:
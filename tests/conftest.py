@@ -0,0 +1,134 @@
+import math
+import operator
+import os
+import random
+import sys
+import time
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+import pygame
+import pygame.locals
+import pytest
+
+from game import graphics, main, raycasting, settings
+
+
+@pytest.fixture
+def game(monkeypatch):
+    # game.main with the names it imports and the globals it sets up when it's run as the game
+    # Drawing goes to a small hidden display, tests set up whatever else they use
+    monkeypatch.setenv('SDL_VIDEODRIVER', 'dummy')
+    pygame.display.init()
+    names = {name: value for module in (pygame.locals, settings) for name, value in vars(module).items()
+             if not name.startswith('_')}
+    names.update(sys=sys, os=os, time=time, random=random, weakref=weakref, OrderedDict=OrderedDict,
+                 attrgetter=operator.attrgetter, np=np, pygame=pygame, graphics=graphics, raycasting=raycasting,
+                 sin=math.sin, cos=math.cos, tan=math.tan, atan2=math.atan2, sqrt=math.sqrt, pi=math.pi,
+                 ceil=math.ceil, inf=math.inf)
+    r_w, r_h = 64, 48
+    view = pygame.display.set_mode((r_w, r_h))
+    names.update(R_W=r_w, R_H=r_h, H_W=r_w // 2, H_H=r_h // 2, D_W=r_w, D_H=r_h, DISPLAY=view, VIEW=view,
+                 SHADING=None, FOG=None, FLOOR_CASTER=None, LIGHT_MAP=None, MAX_DRAW_DIST=None, WALL_RES=1,
+                 PORTAL_RES=1, RAYCASTER='vectorized', RAYCAST_POOL=None, TILES_VERSION=0, WALLS_KEY=None,
+                 WALLS_REUSED=False, PORTAL_RAYS=[])
+    for name, value in names.items():
+        monkeypatch.setattr(main, name, value, raising=False)
+    monkeypatch.setattr(main, 'CAMERA_PLANE', main.CameraPlane(settings.FOV), raising=False)
+    monkeypatch.setattr(main.Drawable, 'constant', int(0.65 * r_h), raising=False)
+    yield main
+    pygame.display.quit()
+
+
+@pytest.fixture
+def make_texture(game):
+    # Makes textures whose columns are filled with colours in turn
+    return _make_texture
+
+
+def _make_texture(colours, width=settings.TEXTURE_SIZE, alpha=False):
+    size = settings.TEXTURE_SIZE
+    texture = pygame.Surface((width, size), pygame.SRCALPHA if alpha else 0)
+    for column in range(width):
+        texture.fill(colours[column % len(colours)], (column, 0, 1, size))
+    return texture
+
+
+class Tile:
+    # Stand-in for the tiles graphics.get_tile_values_info() loads
+    def __init__(self, type, texture=None, desc='Normal'):
+        self.type = type
+        self.texture = texture
+        self.desc = desc
+        self.light = False
+
+
+@pytest.fixture
+def make_level(game, monkeypatch):
+    # Makes a level from rows of '.' (empty), '#' (wall) and 'B' (wall with another texture) tiles,
+    # with the player at pos looking towards angle
+    # Walls are red and green stripes, open portals are blue and yellow rims and closed portals are grey
+    # Like the game's wall textures, they are two textures wide, vertical tile sides use the right half
+    created = []
+
+    def make_level(rows, pos, angle=0.0):
+        width = settings.TEXTURE_SIZE * 2
+        blue, red, grey = (0, 0, 255, 255), (255, 255, 0, 255), (128, 128, 128, 255)
+        portal_textures = [_make_texture([colour], width, alpha=True) for colour in (blue, grey, red, grey)]
+        for texture in portal_textures[::2]:
+            for left in (0, settings.TEXTURE_SIZE):
+                texture.fill((0, 0, 0, 0), (left + 3, 3, settings.TEXTURE_SIZE - 6, settings.TEXTURE_SIZE - 6))
+        tile_values_info = {0: Tile('Empty'), 1: Tile('Wall', _make_texture([(255, 0, 0), (0, 255, 0)], width)),
+                            2: Tile('Wall', _make_texture([(255, 0, 255), (0, 255, 255)], width))}
+        monkeypatch.setattr(game.Door, 'side_texture', _make_texture([(64, 64, 64)], width), raising=False)
+        texture_strips = game.TextureStrips([game.Door.side_texture] + portal_textures +
+                                            [tile_values_info[1].texture, tile_values_info[2].texture])
+        tilemap = [['.#B'.index(char) for char in row] for row in rows]
+        names = dict(
+            TILEMAP=tilemap, TILE_VALUES_INFO=tile_values_info, PORTAL_TEXTURES=portal_textures,
+            TEXTURE_STRIPS=texture_strips,
+            TILE_TEXTURE_IDS=np.array([0] + [texture_strips.texture_ids[tile_values_info[value].texture]
+                                             for value in (1, 2)], dtype=np.int32),
+            EMPTY_TILES={(x, y) for y, row in enumerate(tilemap) for x, value in enumerate(row) if not value},
+            DOOR_TILES=set(), PUSH_WALL_TILES=set(), THIN_WALL_TILES=set(), DOORS=[], PUSH_WALLS=[],
+            THIN_WALLS=[], OBJECTS=[], EXPLOSIVES=[], ENEMIES=[], PORTAL_OBJECTS=[], MESSAGES=[],
+            TILE_ARRAYS=raycasting.TileArrays(len(tilemap[0]), len(tilemap)),
+            PLAYER=game.Player(pos, angle), BLUE_PORTAL=game.Portal(*portal_textures[:2]),
+            RED_PORTAL=game.Portal(*portal_textures[2:]), PORTAL_RAY_BUDGET=game.R_W * 3,
+            SPRITE_PROJECTION=game.SpriteProjection(), WALL_SNAPSHOT=game.WallSnapshot())
+        layers = {name: game.ColumnLayer(game.R_W, see_through='SEETHROUGH' in name)
+                  for name in ('WALLS', 'BLUE_PORTAL_WALLS', 'RED_PORTAL_WALLS', 'SEETHROUGH_WALLS',
+                               'PORTAL_SEETHROUGH_WALLS', 'DEEP_PORTAL_WALLS')}
+        names.update(layers, WALL_LAYERS=tuple(layers.values()))
+        for name, value in names.items():
+            monkeypatch.setattr(game, name, value, raising=False)
+        created.append(game.TILE_ARRAYS)
+        names['BLUE_PORTAL'].set_other_portal(names['RED_PORTAL'])
+        names['RED_PORTAL'].set_other_portal(names['BLUE_PORTAL'])
+        for y, row in enumerate(tilemap):
+            for x in range(len(row)):
+                game.update_tilemap_arrays(x, y)
+        monkeypatch.setattr(game, 'LIGHT_MAP', game.bake_light_map([]), raising=False)
+        return game
+
+    yield make_level
+    for tile_arrays in created:
+        tile_arrays.close()
+
+
+@pytest.fixture
+def place_portal(make_level):
+    # Places portals like Portal.create_portal() does
+    return _place_portal
+
+
+def _place_portal(portal, map_x, map_y, vertical, side):
+    # side is 0 for the left or top side of the tile and 1 for the right or bottom side
+    portal.created = True
+    portal.map_x, portal.map_y, portal.vertical, portal.side = map_x, map_y, vertical, side
+    if vertical:
+        portal.center_x, portal.center_y = map_x + side, map_y + 0.5
+    else:
+        portal.center_x, portal.center_y = map_x + 0.5, map_y + side
+    main.update_tiles_version()
@@ -0,0 +1,97 @@
+import numpy as np
+import pytest
+
+SENTINEL = (1, 2, 3, 255)
+
+
+@pytest.fixture
+def floor(game, monkeypatch):
+    # FloorCaster whose floor and ceiling textures have a different colour in every texel,
+    # with the player somewhere off the tile grid
+    size = game.TEXTURE_SIZE
+    textures = game.pygame.Surface((size, size)), game.pygame.Surface((size, size))
+    for x in range(size):
+        for y in range(size):
+            textures[0].set_at((x, y), (x * 4, y * 4, 0))
+            textures[1].set_at((x, y), (x * 4, y * 4, 255))
+    monkeypatch.setattr(game, 'PLAYER', game.Player((3.3, 4.1), 0.3), raising=False)
+    monkeypatch.setattr(game, 'WALLS', game.ColumnLayer(game.R_W), raising=False)
+    game.floor_textures = textures
+    monkeypatch.setattr(game, 'FLOOR_CASTER', game.FloorCaster(*textures))
+    yield game
+    del game.floor_textures
+
+
+def get_texel(game, display_x, row):
+    # Texel the floor pixel at (display_x, row) shows, worked out one pixel at a time
+    # None when the floor position is too close to a texel edge for float32 math to agree on the texel
+    row_dist = game.Drawable.constant / (2 * row + 1 - game.R_H)
+    camera_x = float(game.CAMERA_PLANE.camera_x_array[display_x - display_x % game.WALL_RES])
+    texel = []
+    for pos, direction, plane in ((game.PLAYER.x, game.PLAYER.dir_x, game.PLAYER.plane_x),
+                                  (game.PLAYER.y, game.PLAYER.dir_y, game.PLAYER.plane_y)):
+        coordinate = (pos + row_dist * (direction + plane * camera_x)) * game.TEXTURE_SIZE
+        if abs(coordinate - round(coordinate)) < 0.01:
+            return None
+        texel.append(int(coordinate) % game.TEXTURE_SIZE)  # Truncated like the caster does, it's the same off the map
+    return tuple(texel)
+
+
+def draw(game, depth):
+    # Draws floor and ceiling with walls at depth, returns the first row below the wall of every column
+    game.WALLS.depth_array[:] = depth
+    height = (game.Drawable.constant / np.where(depth > 0, depth, np.inf)).astype(int)
+    game.VIEW.fill(SENTINEL)
+    game.FLOOR_CASTER.draw()
+    return np.clip((game.R_H - height) // 2 + height, game.H_H, game.R_H)
+
+
+def check(game, first_rows, covered_cast=False):
+    # Uncovered floor and ceiling pixels have the texels of the scalar reference, covered ones are left alone
+    # unless covered_cast
+    floor_texture, ceiling_texture = game.floor_textures
+    checked = 0
+    for display_x in range(game.R_W):
+        for row in range(game.H_H, game.R_H):
+            pixel = game.VIEW.get_at((display_x, row))
+            ceiling_pixel = game.VIEW.get_at((display_x, game.R_H - 1 - row))
+            if row < first_rows[display_x]:
+                if not covered_cast or row < first_rows.min():
+                    assert pixel == ceiling_pixel == SENTINEL
+                continue
+            texel = get_texel(game, display_x, row)
+            if texel is not None:
+                assert pixel == floor_texture.get_at(texel)
+                assert ceiling_pixel == ceiling_texture.get_at(texel)
+                checked += 1
+    assert checked > game.R_W * (game.R_H - first_rows.max()) // 2
+
+
+@pytest.mark.parametrize('wall_res', [1, 2, 3])
+def test_only_floor_below_walls_is_cast(floor, monkeypatch, wall_res):
+    game = floor
+    monkeypatch.setattr(game, 'WALL_RES', wall_res)
+    # Close walls over most columns and far ones over the rest, every wall column covers wall_res pixel columns
+    wall_columns = np.arange(-(-game.R_W // wall_res))
+    depth = np.where(wall_columns % 4 < 3, 0.8, 6.0)
+    depth[:2] = 0  # No wall, like columns of a portal
+    check(game, draw(game, np.repeat(depth, wall_res)[:game.R_W]))
+
+
+@pytest.mark.parametrize('wall_res', [1, 3])
+def test_floor_at_even_and_mostly_uncovered_walls(floor, monkeypatch, wall_res):
+    game = floor
+    monkeypatch.setattr(game, 'WALL_RES', wall_res)
+    check(game, draw(game, np.full(game.R_W, 3.0)))
+    check(game, draw(game, np.full(game.R_W, np.inf)))  # Rays that missed
+    # When walls only cover a little, the pixels under them are cast too and walls are drawn over them
+    depth = np.full(game.R_W, 6.0)
+    depth[9:15] = 2.0
+    check(game, draw(game, depth), covered_cast=True)
+
+
+def test_nothing_cast_when_walls_cover_the_floor(floor):
+    game = floor
+    first_rows = draw(game, np.full(game.R_W, 0.5))
+    assert (first_rows == game.R_H).all()
+    assert (game.pygame.surfarray.array3d(game.VIEW) == SENTINEL[:3]).all()
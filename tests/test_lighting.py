@@ -0,0 +1,100 @@
+from collections import OrderedDict
+from math import sqrt
+
+import numpy as np
+import pygame
+import pytest
+from pygame.locals import BLEND_RGB_ADD, BLEND_RGB_MULT
+
+from game import main
+
+
+@pytest.fixture
+def shading(monkeypatch):
+    # Names main.py imports when it's run as the game
+    for name, value in (('np', np), ('OrderedDict', OrderedDict), ('BLEND_RGB_MULT', BLEND_RGB_MULT),
+                        ('BLEND_RGB_ADD', BLEND_RGB_ADD)):
+        monkeypatch.setattr(main, name, value, raising=False)
+    return main.Shading(4, 16, 0.4)
+
+
+def test_shades_by_distance(shading):
+    assert [shading.get_shade(dist) for dist in (0, 3.9, 4, 8, 15.9, 16, 40)] == [0, 0, 1, 2, 3, 4, 4]
+    assert shading.get_shade(4, light_shade=2) == 3
+    assert shading.get_shade(12, light_shade=2) == 4  # Never darker than the darkest shade
+    assert shading.get_shades(np.array([0, 4, 8, 40]), 1).tolist() == [1, 2, 3, 4]
+
+
+def test_shaded_pixels(shading):
+    texture = pygame.Surface((2, 1))
+    texture.set_at((0, 0), (200, 100, 40))
+    texture.set_at((1, 0), (255, 255, 255))
+    assert shading.shade(texture, 0).get_at((0, 0))[:3] == (200, 100, 40)
+    darkest = shading.shade(texture, 4)
+    assert darkest.get_at((0, 0))[:3] == pytest.approx((80, 40, 16), abs=1)
+    assert darkest.get_at((1, 0))[:3] == pytest.approx((102, 102, 102), abs=1)  # DARKEST_SHADE of white
+    assert texture.get_at((0, 0))[:3] == (200, 100, 40)  # Texture itself isn't changed
+
+    # Sprites get the same shades as walls
+    frame = shading.get_frame(texture, (0, 0, 2, 1), 4)
+    assert [frame.get_at((x, 0)) for x in range(2)] == [darkest.get_at((x, 0)) for x in range(2)]
+
+
+def test_lighting_without_distance_shading(shading):
+    # Shading made for lamp lighting alone, like the game does when SHADE_LEVELS is 0
+    lighting = main.Shading(2, None, 0.4)
+    assert [lighting.get_shade(dist) for dist in (0, 16, 100)] == [0, 0, 0]
+    assert [lighting.get_shade(100, light_shade) for light_shade in (0, 1, 2)] == [0, 1, 2]
+    assert lighting.get_shades(np.array([0, 16, 100]), np.array([2, 1, 0])).tolist() == [2, 1, 0]
+    assert lighting.get_shades(np.array([0, 100])).tolist() == [0, 0]
+    assert lighting.brightness == pytest.approx([1, 0.7, 0.4])  # Unlit is the darkest shade
+
+
+def bake_light_map(monkeypatch, rows, lamps, door_tiles=(), shading=True):
+    # main.bake_light_map() for rows of '.' (empty) and '#' (wall) tiles, UNLIT_SHADE is 2 and light reaches 6 tiles
+    empty_tiles = {(x, y) for y, row in enumerate(rows) for x, char in enumerate(row) if char == '.'}
+    for name, value in (('np', np), ('sqrt', sqrt), ('TILEMAP', [[0] * len(row) for row in rows]),
+                        ('EMPTY_TILES', empty_tiles), ('DOOR_TILES', set(door_tiles)), ('THIN_WALL_TILES', set()),
+                        ('SHADING', shading), ('UNLIT_SHADE', 2), ('LAMP_LIGHT_RADIUS', 6)):
+        monkeypatch.setattr(main, name, value, raising=False)
+    return main.bake_light_map(lamps).tolist()
+
+
+ROOMS = ['#########',
+         '#...#...#',
+         '#########']
+
+
+def test_light_map(monkeypatch):
+    light_map = bake_light_map(monkeypatch, ROOMS, [(2.5, 1.5)])
+    # Light fades with distance and doesn't go through the wall into the other room
+    assert light_map[1] == [2, 0, 0, 0, 2, 2, 2, 2, 2]
+    assert light_map[0] == light_map[2] == [2] * 9
+
+
+def test_light_goes_through_doors(monkeypatch):
+    light_map = bake_light_map(monkeypatch, ROOMS, [(2.5, 1.5)], door_tiles=[(4, 1)])
+    assert light_map[1] == [2, 0, 0, 0, 1, 1, 1, 2, 2]
+
+
+def test_evenly_lit_without_lamps_or_shading(monkeypatch):
+    assert bake_light_map(monkeypatch, ROOMS, []) == [[0] * 9] * 3
+    assert bake_light_map(monkeypatch, ROOMS, [(2.5, 1.5)], shading=None) == [[0] * 9] * 3
+
+
+HALL = ['#################',
+        '#...............#',
+        '#...............#',
+        '#################']
+
+
+def test_lamps_light_walls_without_distance_shading(game, make_level, monkeypatch):
+    monkeypatch.setattr(game, 'SHADING', game.Shading(2, None, 0.4))
+    game = make_level(HALL, (1.5, 1.5), 0.013)
+    monkeypatch.setattr(game, 'LIGHT_MAP', game.bake_light_map([(14.5, 1.5)]))
+    game.send_rays()
+    walls = game.WALLS
+    shades = dict(zip(walls.display_x[:walls.count].tolist(), walls.shade[:walls.count].tolist()))
+    # The end wall next to the lamp is lit, the side walls next to the player aren't
+    assert shades[game.H_W] == 0
+    assert shades[0] == shades[game.R_W - 1] == 2
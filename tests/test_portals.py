@@ -0,0 +1,119 @@
+import numpy as np
+import pytest
+
+ROOM = ['#######',
+        '#.....#',
+        '#.....#',
+        '#######']
+
+LAYERS = ('WALLS', 'BLUE_PORTAL_WALLS', 'RED_PORTAL_WALLS', 'DEEP_PORTAL_WALLS')
+
+
+@pytest.fixture
+def facing_portals(make_level, place_portal):
+    # Blue portal straight ahead on the right wall and red portal behind the player on the left wall,
+    # so through the blue portal the blue portal is seen again, and again through that
+    # Player looks a little off the tile center, rays through it would hit tile corners exactly
+    game = make_level(ROOM, (1.5, 1.5), 0.013)
+    place_portal(game.BLUE_PORTAL, 6, 1, True, 0)
+    place_portal(game.RED_PORTAL, 0, 1, True, 1)
+    return game
+
+
+def get_columns(game):
+    # Layer name -> display_x -> [(texture_id, column, perp_dist)] of every column at display_x
+    columns = {}
+    for name in LAYERS:
+        layer = getattr(game, name)
+        columns[name] = {}
+        for x, texture_id, column, perp_dist in zip(
+                layer.display_x[:layer.count].tolist(), layer.texture_id[:layer.count].tolist(),
+                layer.column[:layer.count].tolist(), layer.perp_dist[:layer.count].tolist()):
+            columns[name].setdefault(x, []).append((texture_id, column, round(perp_dist, 4)))
+    return columns
+
+
+def cast(game, monkeypatch, portal_res, raycaster='vectorized'):
+    monkeypatch.setattr(game, 'PORTAL_RES', portal_res)
+    monkeypatch.setattr(game, 'RAYCASTER', raycaster)
+    monkeypatch.setattr(game, 'WALLS_KEY', None)  # PORTAL_RES can't change in game, so walls would be reused
+    game.send_rays()
+    return get_columns(game)
+
+
+def test_portal_res_copies_skipped_columns(facing_portals, monkeypatch):
+    game = facing_portals
+    open_portals = {game.TEXTURE_STRIPS.texture_ids[portal.texture] for portal in (game.BLUE_PORTAL, game.RED_PORTAL)}
+    full = cast(game, monkeypatch, 1)
+    coarse = cast(game, monkeypatch, 2)
+    assert coarse['WALLS'] == full['WALLS']  # PORTAL_RES doesn't touch walls outside portals
+
+    portal_walls = coarse['BLUE_PORTAL_WALLS']
+    assert sorted(portal_walls) == sorted(full['BLUE_PORTAL_WALLS'])  # Every column of the portal is filled
+    copied = cast_alone = 0
+    for x, columns in portal_walls.items():
+        if x % 2 and x - 1 in portal_walls:
+            left = portal_walls[x - 1]
+            if left[0][0] in open_portals:
+                # Left column went through the portal again, a copy would have nothing behind it
+                assert columns == full['BLUE_PORTAL_WALLS'][x]
+                assert x in coarse['DEEP_PORTAL_WALLS']
+                cast_alone += 1
+            else:
+                assert columns == left
+                copied += 1
+        else:
+            assert columns == full['BLUE_PORTAL_WALLS'][x]
+    assert copied and cast_alone
+
+
+@pytest.mark.parametrize('portal_res', [1, 2, 3])
+def test_portal_res_raycasters_match(facing_portals, monkeypatch, portal_res):
+    game = facing_portals
+    assert cast(game, monkeypatch, portal_res, 'scalar') == cast(game, monkeypatch, portal_res, 'vectorized')
+
+
+def test_sprites_seen_through_portals_more_than_once(make_level, place_portal, make_texture, monkeypatch):
+    # Object right behind the player is seen through the blue portal ahead, and again through every blue portal
+    # seen through it, 5 tiles further every time
+    game = make_level(ROOM, (2.5, 1.5), 0.013)
+    place_portal(game.BLUE_PORTAL, 6, 1, True, 0)
+    place_portal(game.RED_PORTAL, 0, 1, True, 1)
+    monkeypatch.setattr(game, 'MAX_PORTAL_DEPTH', 3)
+    monkeypatch.setattr(game, 'SCALED_SPRITES', game.ScaledSpriteCache(1024 ** 2, game.R_W), raising=False)
+    monkeypatch.setattr(game, 'MIPMAPS', game.MipMaps(), raising=False)
+    white = (255, 255, 255, 255)
+    lamp = game.Object(make_texture([white], alpha=True), (1.5, 1.5))
+    game.send_rays()
+
+    clones = [(round(x, 6), round(y, 6), walls) for (x, y), walls, _ in lamp.get_portal_clones_info()]
+    # The clone seen through the red portal is behind the player
+    assert [clone[:2] for clone in clones] == [(6.5, 1.5), (-3.5, 1.5), (11.5, 1.5), (16.5, 1.5)]
+    assert [walls for _, _, walls in clones[:2]] == [game.BLUE_PORTAL_WALLS, game.RED_PORTAL_WALLS]
+    assert [walls.portal_depth for _, _, walls in clones[2:]] == [2, 3]
+
+    portal_objects = []
+    monkeypatch.setattr(game, 'PORTAL_OBJECTS', portal_objects)
+    lamp.create_portal_clones()
+    assert [o.visible_to_player for o in portal_objects] == [True, False, True, True]
+    del portal_objects[1]
+    for inner, outer in zip(portal_objects[1:], portal_objects):
+        # Every clone is only drawn inside the portal the one before it is seen through
+        assert outer.start_x <= inner.start_x and inner.end_x <= outer.end_x
+        assert inner.walls.depth_array[inner.start_x:inner.end_x].min() > inner.perp_dist
+
+    sky = game.pygame.Surface((game.R_W * 2, game.H_H))
+    monkeypatch.setattr(game, 'LEVEL', type('Level', (), {'skytexture': sky}), raising=False)
+    monkeypatch.setattr(game, 'draw_hud', lambda: None)
+    game.SPRITE_PROJECTION.project(game.WALLS)
+
+    def draw(objects):
+        portal_objects[:] = objects
+        game.draw_frame()
+        return game.pygame.surfarray.array3d(game.VIEW)
+
+    # The clone seen through one portal would cover the others, so only the deeper ones are drawn
+    deep_clones = portal_objects[1:]
+    changed = (draw(deep_clones) != draw([])).any(axis=(1, 2))
+    drawn = set(np.flatnonzero(changed).tolist())
+    assert drawn and drawn <= {x for o in deep_clones for x in range(o.start_x, o.end_x)}
@@ -0,0 +1,255 @@
+from math import inf
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from game import main, raycasting
+from game.settings import TEXTURE_SIZE
+
+KINDS = {'.': raycasting.EMPTY, '#': raycasting.WALL, 'T': raycasting.SPECIAL, 'D': raycasting.DOOR,
+         'P': raycasting.PUSH_WALL}
+
+
+def make_tiles(rows, offsets=None):
+    # TileArrays from rows of KINDS characters, offsets maps (x, y) to a door or push wall offset
+    tiles = raycasting.TileArrays(len(rows[0]), len(rows))
+    for y, row in enumerate(rows):
+        for x, char in enumerate(row):
+            tiles.kinds[y, x] = KINDS[char]
+            tiles.values[y, x] = 0 if char == '.' else 1
+    for (x, y), offset in (offsets or {}).items():
+        tiles.offsets[y, x] = offset
+    return tiles
+
+
+ROOM = ['#####',
+        '#...#',
+        '#...#',
+        '#...#',
+        '#####']
+
+
+class RecordedLayer:
+    # Stands in for a ColumnLayer, keeps the arguments of every add()
+    def __init__(self):
+        self.columns = []
+
+    def add(self, delta_x, delta_y, texture, column, face=None, light_shade=0):
+        self.columns.append((delta_x, delta_y, column, face))
+
+
+def scalar_raycast(monkeypatch, tiles, start_pos, ray_dir):
+    # Casts a ray with the scalar main.raycast() through the same tiles cast_rays() gets
+    # Returns arguments of the column it added, see RecordedLayer
+    height, width = tiles.shape
+    empty = {(x, y) for y in range(height) for x in range(width) if tiles.kinds[y, x] == raycasting.EMPTY}
+    doors = [SimpleNamespace(x=x, y=y, closed_state=tiles.offsets[y, x])
+             for y in range(height) for x in range(width) if tiles.kinds[y, x] == raycasting.DOOR]
+    no_portal = SimpleNamespace(map_x=-1, map_y=-1)
+    layer = RecordedLayer()
+    for name, value in (('TILEMAP', tiles.values.tolist()), ('EMPTY_TILES', empty),
+                        ('DOORS', doors), ('DOOR_TILES', {(d.x, d.y) for d in doors}),
+                        ('THIN_WALL_TILES', set()), ('PUSH_WALL_TILES', set()), ('PUSH_WALLS', []),
+                        ('TILE_VALUES_INFO', {1: SimpleNamespace(texture=None)}),
+                        ('LIGHT_MAP', np.zeros(tiles.shape, dtype=np.int32)), ('TILE_ARRAYS', tiles),
+                        ('BLUE_PORTAL', no_portal), ('RED_PORTAL', no_portal), ('WALLS', layer),
+                        ('MAX_DRAW_DIST', None), ('DISPLAY_X', 0), ('TEXTURE_SIZE', TEXTURE_SIZE), ('inf', inf)):
+        monkeypatch.setattr(main, name, value, raising=False)
+    main.raycast(start_pos, ray_dir, create_walls=True)
+    assert len(layer.columns) == 1
+    return layer.columns[0]
+
+
+def test_vertical_wall():
+    hits = raycasting.cast_rays(make_tiles(ROOM), 1.5, 2.5, [1.0], [0.0])
+    assert (hits.map_x[0], hits.map_y[0]) == (4, 2)
+    assert (hits.prev_x[0], hits.prev_y[0]) == (3, 2)
+    assert hits.vertical[0]
+    assert hits.dist[0] == pytest.approx(2.5)
+    assert hits.column[0] == TEXTURE_SIZE // 2 + TEXTURE_SIZE  # Vertical sides use the right half of the texture
+    assert hits.kind[0] == raycasting.WALL
+    assert not hits.missed[0]
+
+
+def test_horizontal_wall():
+    hits = raycasting.cast_rays(make_tiles(ROOM), 1.25, 2.5, [0.0], [-1.0])
+    assert (hits.map_x[0], hits.map_y[0]) == (1, 0)
+    assert not hits.vertical[0]
+    assert hits.dist[0] == pytest.approx(1.5)
+    assert hits.column[0] == TEXTURE_SIZE // 4
+
+
+def test_closed_door():
+    tiles = make_tiles(['#####',
+                        '#..D#',
+                        '#####'], {(3, 1): 1.0})
+    hits = raycasting.cast_rays(tiles, 1.5, 1.5, [1.0], [0.0])
+    assert (hits.map_x[0], hits.map_y[0]) == (3, 1)
+    assert hits.kind[0] == raycasting.DOOR
+    assert hits.dist[0] == pytest.approx(2.0)  # Doors are in the middle of their tile
+
+
+def test_half_open_door():
+    tiles = make_tiles(['#####',
+                        '#..D#',
+                        '#####'], {(3, 1): 0.5})
+    hits = raycasting.cast_rays(tiles, 1.5, [1.25, 1.75], [1.0, 1.0], [0.0, 0.0])
+    # Closed half of the door is hit, the ray through the open half hits the wall behind it
+    assert hits.kind.tolist() == [raycasting.DOOR, raycasting.WALL]
+    assert hits.dist.tolist() == pytest.approx([2.0, 2.5])
+    assert hits.column[0] == TEXTURE_SIZE // 4 + TEXTURE_SIZE  # Door texture moves with the door
+
+
+def test_push_wall():
+    tiles = make_tiles(['#####',
+                        '#..P#',
+                        '#####'], {(3, 1): 0.25})
+    hits = raycasting.cast_rays(tiles, 1.5, 1.5, [1.0], [0.0])
+    assert (hits.map_x[0], hits.map_y[0]) == (3, 1)
+    assert hits.kind[0] == raycasting.PUSH_WALL
+    assert hits.dist[0] == pytest.approx(1.75)
+
+
+def test_thin_wall_is_special():
+    tiles = make_tiles(['#####',
+                        '#.T.#',
+                        '#####'])
+    hits = raycasting.cast_rays(tiles, 1.5, 1.5, [1.0], [0.0])
+    assert (hits.map_x[0], hits.map_y[0]) == (2, 1)
+    assert hits.kind[0] == raycasting.SPECIAL
+
+
+def test_max_dist_miss():
+    hits = raycasting.cast_rays(make_tiles(ROOM), 1.5, 2.5, [1.0, 0.0], [0.0, 1.0], max_dist=1.0)
+    # First ray would enter the wall tile 2.5 away, second one enters it 1.5 away
+    assert hits.missed.tolist() == [True, True]
+    assert hits.dist.tolist() == pytest.approx([1.0, 1.0])
+    hits = raycasting.cast_rays(make_tiles(ROOM), 1.5, 2.5, [1.0], [0.0], max_dist=3.0)
+    assert not hits.missed[0]
+
+
+def test_out_of_map():
+    tiles = make_tiles(['..D'], {(2, 0): 1.0})
+    hits = raycasting.cast_rays(tiles, 0.5, 0.5, [1.0, -1.0], [0.0, 0.0])
+    # Tiles outside the map count as walls, even when the closest edge tile is empty or a door
+    assert hits.dist.tolist() == pytest.approx([2.0, 0.5])
+    assert hits.kind.tolist() == [raycasting.DOOR, raycasting.WALL]
+    hits = raycasting.cast_rays(make_tiles(['...']), 0.5, 0.5, [1.0], [0.0])
+    assert hits.dist[0] == pytest.approx(2.5)
+    assert (hits.map_x[0], hits.map_y[0]) == (2, 0)
+    assert hits.kind[0] == raycasting.WALL
+    assert not hits.missed[0]
+
+
+def test_visible_tiles():
+    tiles = make_tiles(ROOM)
+    raycasting.cast_rays(tiles, 1.5, 2.5, [1.0], [0.0])
+    assert np.flatnonzero(tiles.visible[2]).tolist() == [1, 2, 3, 4]
+    assert tiles.visible.sum() == 4
+
+
+def test_rays_cast_together_match_single_rays():
+    tiles = make_tiles(['########',
+                        '#......#',
+                        '#..#...#',
+                        '#....D.#',
+                        '#......#',
+                        '########'], {(5, 3): 0.5})
+    angles = np.linspace(0, 2 * np.pi, 37)
+    ray_dir_x = np.cos(angles)
+    ray_dir_y = np.sin(angles)
+    hits = raycasting.cast_rays(tiles, 2.3, 3.6, ray_dir_x, ray_dir_y)
+    for ray in range(angles.size):
+        single = raycasting.cast_rays(tiles, 2.3, 3.6, ray_dir_x[ray:ray + 1], ray_dir_y[ray:ray + 1])
+        for name in ('map_x', 'map_y', 'vertical', 'dist', 'column'):
+            assert getattr(hits, name)[ray] == getattr(single, name)[0]
+
+
+def test_strided_cast_recasts_copies_of_portal_hits():
+    # Portal on the west side of tile (6, 1), every second ray is cast like with PORTAL_RES = 2
+    tiles = make_tiles(['#######',
+                        '#.....#',
+                        '#.....#',
+                        '#######'])
+    angles = np.linspace(-0.6, 0.6, 41)
+    ray_dir_x = np.cos(angles)
+    ray_dir_y = np.sin(angles)
+    start_x = np.full(angles.size, 1.5)
+    start_y = np.full(angles.size, 1.9)
+
+    def portal_hits(hits):
+        return (hits.map_x == 6) & (hits.map_y == 1) & hits.vertical
+
+    cast = np.arange(angles.size) % 2 == 0
+    hits, cast = raycasting.cast_strided(tiles, start_x, start_y, ray_dir_x, ray_dir_y, np.inf, cast, portal_hits)
+    source = np.cumsum(cast) - 1
+    every_ray = raycasting.cast_rays(tiles, start_x, start_y, ray_dir_x, ray_dir_y)
+
+    # Columns showing the portal are all cast, so the portal doesn't spread over its edge into walls
+    on_portal = portal_hits(hits)[source]
+    assert on_portal.any()
+    assert cast[on_portal].all()
+    for name in ('map_x', 'map_y', 'vertical', 'dist', 'column'):
+        assert (getattr(hits, name) == getattr(every_ray, name)[cast]).all()
+    assert not cast.all()  # Columns not showing the portal are still copied
+
+
+def test_matches_scalar_raycast(monkeypatch):
+    tiles = make_tiles(['########',
+                        '#......#',
+                        '#..#...#',
+                        '#....D.#',
+                        '#......#',
+                        '########'], {(5, 3): 0.5})
+    angles = np.linspace(0.01, 2 * np.pi + 0.01, 91)[:-1]
+    ray_dir_x = np.cos(angles) * 1.3  # Ray directions don't have to be normalized
+    ray_dir_y = np.sin(angles) * 1.3
+    hits = raycasting.cast_rays(tiles, 2.3, 3.6, ray_dir_x, ray_dir_y)
+    for ray in range(angles.size):
+        delta_x, delta_y, column, face = scalar_raycast(monkeypatch, tiles, (2.3, 3.6),
+                                                        (ray_dir_x[ray], ray_dir_y[ray]))
+        assert hits.delta_x[ray] == pytest.approx(delta_x, abs=1e-6)
+        assert hits.delta_y[ray] == pytest.approx(delta_y, abs=1e-6)
+        assert hits.column[ray] == column
+        if hits.kind[ray] == raycasting.DOOR:
+            assert face is None
+        else:
+            assert face == (hits.map_x[ray], hits.map_y[ray], hits.vertical[ray])
+
+
+def test_pool_matches_cast_rays():
+    tiles = make_tiles(['########',
+                        '#......#',
+                        '#..#...#',
+                        '#....D.#',
+                        '#......#',
+                        '########'], {(5, 3): 0.5})
+    shared_tiles = tiles.copy(shared=True)
+    angles = np.linspace(0, 2 * np.pi, 40)
+    ray_dir_x = np.cos(angles)
+    ray_dir_y = np.sin(angles)
+    pool = raycasting.RayCastPool(2, angles.size, 10)
+    try:
+        hits = pool.cast(shared_tiles, 2.3, 3.6, ray_dir_x, ray_dir_y, 4.0)
+        expected = raycasting.cast_rays(tiles, 2.3, 3.6, ray_dir_x, ray_dir_y, 4.0)
+        for name, _ in raycasting.RayCastPool.result_fields:
+            assert (getattr(hits, name) == getattr(expected, name)).all()
+        assert (shared_tiles.visible == tiles.visible).all()
+
+        # Errors in workers are raised in the calling process instead of leaving it waiting
+        with pytest.raises(ValueError):
+            pool.cast(shared_tiles, 2.3, 3.6, ray_dir_x, ray_dir_y, 'far')
+        hits = pool.cast(shared_tiles, 2.3, 3.6, ray_dir_x, ray_dir_y, 4.0)
+        assert (hits.dist == expected.dist).all()
+    finally:
+        pool.close()
+        shared_tiles.close()
+
+
+def test_worker_count_leaves_a_core_for_the_game(monkeypatch):
+    monkeypatch.setattr(raycasting.os, 'cpu_count', lambda: 4)
+    assert raycasting.get_worker_count(8) == 3
+    assert raycasting.get_worker_count(2) == 2
+    monkeypatch.setattr(raycasting.os, 'cpu_count', lambda: None)  # Unknown CPU count
+    assert raycasting.get_worker_count(4) == 0
@@ -0,0 +1,186 @@
+import numpy as np
+import pytest
+
+WHITE = (255, 255, 255, 255)
+BLACK = (0, 0, 0, 255)
+
+
+@pytest.fixture
+def sprites(game, monkeypatch):
+    # Player at (1.5, 1.5) looking along x, with the caches sprites are drawn from
+    monkeypatch.setattr(game, 'PLAYER', game.Player((1.5, 1.5), 0.0), raising=False)
+    monkeypatch.setattr(game, 'SCALED_SPRITES', game.ScaledSpriteCache(1024 ** 2, game.R_W), raising=False)
+    monkeypatch.setattr(game, 'MIPMAPS', game.MipMaps(), raising=False)
+    return game
+
+
+def make_walls(game, depths):
+    # ColumnLayer with one column at every display_x, at the distance depths gives for it
+    walls = game.ColumnLayer(game.R_W)
+    walls.add_many(np.arange(game.R_W), np.asarray(depths, dtype=float), np.zeros(game.R_W, dtype=np.int32),
+                   np.zeros(game.R_W, dtype=np.int32), np.zeros(game.R_W), np.zeros(game.R_W),
+                   np.zeros(game.R_W, dtype=bool))
+    walls.finish()
+    return walls
+
+
+def place(game, sprite, walls):
+    sprite.delta_x = sprite.x - game.PLAYER.x
+    sprite.delta_y = sprite.y - game.PLAYER.y
+    sprite.update_for_drawing(walls)
+
+
+def test_sprites_are_clipped_by_the_depth_buffer(sprites, make_texture):
+    game = sprites
+    # Pillar 2 tiles away in the middle of a wall 5 tiles away, and a sprite 3 tiles away straight ahead
+    depths = np.full(game.R_W, 5.0)
+    pillar = range(game.H_W - 2, game.H_W + 2)
+    depths[pillar] = 2.0
+    walls = make_walls(game, depths)
+    lamp = game.Object(make_texture([WHITE]), (4.5, 1.5))
+    place(game, lamp, walls)
+
+    assert lamp.visible_to_player and not lamp.fully_visible
+    assert lamp.start_x < pillar[0] and lamp.end_x > pillar[-1] + 1
+    assert lamp.visible_columns.tolist() == [x not in pillar for x in range(lamp.start_x, lamp.end_x)]
+
+    game.VIEW.fill(BLACK)
+    lamp.draw()
+    row = [tuple(game.VIEW.get_at((x, game.H_H))) for x in range(game.R_W)]
+    assert row == [WHITE if lamp.start_x <= x < lamp.end_x and x not in pillar else BLACK for x in range(game.R_W)]
+
+
+def test_sprites_behind_every_column_are_not_drawn(sprites, make_texture):
+    game = sprites
+    lamp = game.Object(make_texture([WHITE]), (4.5, 1.5))
+    place(game, lamp, make_walls(game, np.full(game.R_W, 2.0)))
+    assert not lamp.visible_to_player
+    place(game, lamp, make_walls(game, np.full(game.R_W, 3.5)))
+    assert lamp.visible_to_player and lamp.fully_visible
+
+
+def test_scaled_sprite_cache(sprites, make_texture):
+    game = sprites
+    sheet = make_texture([WHITE, BLACK], width=game.TEXTURE_SIZE * 2)
+    size = game.TEXTURE_SIZE
+    cache = game.ScaledSpriteCache((16 * 16 * 2 + 8 * 8) * sheet.get_bytesize(), game.R_W)
+
+    frame = cache.get(sheet, (0, 0, size, size), (16, 16))
+    assert frame.get_size() == (16, 16) and (cache.hits, cache.misses) == (0, 1)
+    # Subsurfaces are new every frame, so frames are found by their parent surface
+    assert cache.get(sheet.subsurface(sheet.get_rect()), (0, 0, size, size), (16, 16)) is frame
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    cache.get(sheet, (size, 0, size, size), (16, 16))
+    cache.get(sheet, (0, 0, size, size), (8, 8))
+    cache.get(sheet, (0, 0, size, size), (16, 16))  # Most recently used again
+    cache.get(sheet, (0, 0, size, size), (4, 4))
+    # Least recently used frame is dropped when the cache goes over max_bytes
+    sizes = [(rect[0], scaled_size) for _, rect, scaled_size in cache.frames]
+    assert sizes == [(0, (8, 8)), (0, (16, 16)), (0, (4, 4))]
+    assert cache.bytes == (8 * 8 + 16 * 16 + 4 * 4) * sheet.get_bytesize()
+    assert cache.get(sheet, (0, 0, size, size), (16, 16)) is frame
+
+
+ROOM = ['########',
+        '#......#',
+        '#......#',
+        '#......#',
+        '########']
+
+
+def test_projection_matches_update_for_drawing(make_level, make_texture, monkeypatch):
+    game = make_level(ROOM, (1.2, 2.3), 0.4)
+    monkeypatch.setattr(game, 'SCALED_SPRITES', game.ScaledSpriteCache(1024 ** 2, game.R_W), raising=False)
+    texture = make_texture([WHITE])
+    objects = [game.Object(texture, (x + 0.5, y + offset)) for x in range(1, 7) for y in range(1, 4)
+               for offset in (0.3, 0.7)]
+    monkeypatch.setattr(game, 'OBJECTS', objects)
+    game.send_rays()
+    game.SPRITE_PROJECTION.project(game.WALLS)
+
+    attributes = ('perp_dist', 'display_pos', 'width', 'height', 'start_x', 'end_x', 'cropping_height')
+    projected = {id(o): tuple(getattr(o, name) for name in attributes) for o in game.SPRITE_PROJECTION.visible}
+    expected = {}
+    for o in objects:
+        place(game, o, game.WALLS)
+        if o.visible_to_player:
+            expected[id(o)] = tuple(getattr(o, name) for name in attributes)
+    assert 0 < len(expected) < len(objects)  # Some are behind the player or outside the view
+    assert projected == expected
+    dists = [o.perp_dist for o in game.SPRITE_PROJECTION.visible]
+    assert dists == sorted(dists, reverse=True)
+
+
+TWO_ROOMS = ['#########',
+             '#...#...#',
+             '#...#...#',
+             '#########']
+
+
+def test_sprites_on_tiles_no_ray_reached_are_culled(make_level, make_texture, monkeypatch):
+    # Player looks at the wall between the rooms, nothing in the other room can be seen
+    game = make_level(TWO_ROOMS, (1.5, 1.5), 0.013)
+    texture = make_texture([WHITE])
+    seen, hidden = game.Object(texture, (2.5, 1.5)), game.Object(texture, (6.5, 1.5))
+    monkeypatch.setattr(game, 'OBJECTS', [seen, hidden])
+    game.send_rays()
+    assert game.VISIBLE_TILES[1, 1:6].all()  # Tiles rays went through and the tiles next to them
+    assert not game.VISIBLE_TILES[:, 6:].any()
+
+    def calc_start_and_end_x(walls):
+        raise AssertionError('Culled sprites are not clipped')
+    hidden.calc_start_and_end_x = calc_start_and_end_x
+    game.SPRITE_PROJECTION.project(game.WALLS)
+    assert game.SPRITE_PROJECTION.visible == [seen]
+
+    cloned = []
+    monkeypatch.setattr(game.Object, 'create_portal_clones', lambda self: cloned.append(self))
+    monkeypatch.setattr(game, 'PLAYER_MODEL', type('PlayerModel', (), {'create_portal_clones': lambda self: None})(),
+                        raising=False)
+    game.create_portal_objects()
+    assert cloned == [seen]
+
+
+def test_draw_order_is_carried_over_between_frames(make_level, make_texture, monkeypatch):
+    game = make_level(ROOM, (1.5, 2.5), 0.0)
+    texture = make_texture([WHITE])
+    near, middle, far = (game.Object(texture, (x, 2.5 + offset)) for x, offset in ((2.5, 0.1), (4.5, -0.1), (6.5, 0)))
+    objects = [near, middle, far]
+    monkeypatch.setattr(game, 'OBJECTS', objects)
+
+    def project():
+        game.send_rays()
+        game.SPRITE_PROJECTION.project(game.WALLS)
+        visible = game.SPRITE_PROJECTION.visible
+        assert all(s.visible_to_player for s in visible)
+        assert sum(s.visible_to_player for s in objects) == len(visible)
+        return visible
+
+    assert project() == [far, middle, near]
+    # Turning around reverses the order, sprites behind the player drop out
+    game.PLAYER.x = 7.0
+    game.PLAYER.rotate(game.pi)
+    game.PLAYER.update_direction()
+    assert project() == [near, middle, far]
+    # Picked up objects are gone and new sprites are sorted in with the carried over ones
+    objects.remove(middle)
+    assert project() == [near, far]
+    objects.append(middle)
+    assert project() == [near, middle, far]
+    game.PLAYER.x = 4.0
+    assert project() == [near]
+
+
+def test_sprites_past_max_draw_dist_are_culled(make_level, make_texture, monkeypatch):
+    game = make_level(ROOM, (1.2, 2.5), 0.0)
+    monkeypatch.setattr(game, 'MAX_DRAW_DIST', 4)
+    texture = make_texture([WHITE])
+    near, far = game.Object(texture, (4.5, 2.5)), game.Object(texture, (5.5, 2.3))
+    monkeypatch.setattr(game, 'OBJECTS', [near, far])
+    game.send_rays()
+    assert game.WALLS.depth_array[game.H_W] == np.inf  # Nothing hides far
+    game.SPRITE_PROJECTION.project(game.WALLS)
+    assert game.SPRITE_PROJECTION.visible == [near]
+    place(game, far, game.WALLS)
+    assert not far.visible_to_player
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+RED = (255, 0, 0, 255)
+GREEN = (0, 255, 0, 255)
+
+
+@pytest.fixture
+def strips(game, make_texture):
+    return game.TextureStrips([make_texture([RED, GREEN])])
+
+
+def test_strips_are_cropped_columns(game, strips):
+    strip = strips.get(0, 5, 32)
+    assert strip.get_size() == (1, 32)
+    assert strip.get_abs_offset() == (5, 16)  # Cropped from the middle of the column
+    assert strip.get_at((0, 0)) == GREEN
+    assert strips.get(0, 4, 64).get_at((0, 63)) == RED
+
+
+def test_strips_are_built_once_on_first_use(game, strips):
+    assert strips.strips[0] == [None] * 32
+    strip = strips.get(0, 5, 32)
+    assert strips.get(0, 5, 32) is strip
+    built = [cropping_height for cropping_height, row in zip(range(2, 65, 2), strips.strips[0]) if row]
+    assert built == [32]
+
+
+def test_mip_strips(game, strips):
+    strip = strips.get(0, 5, 64, level=2)
+    assert strip.get_size() == (1, 16)
+    assert strip.get_abs_offset() == (1, 0)  # Texture column 5 is in column 1 of the quarter size texture
+    assert strips.get(0, 4, 64, level=2) is strip
+
+
+def test_mip_level_for_on_screen_size(game, monkeypatch):
+    size = game.TEXTURE_SIZE
+    # Halved as many times as the texture stays at least as big as it is on screen, but at most MIP_LEVELS times
+    expected = {size * 2: 0, size: 0, size - 1: 0, size // 2: 1, size // 2 - 1: 1, size // 4: 2, size // 8: 3,
+                1: 3, 0: 3}
+    assert {height: game.get_mip_level(size, height) for height in expected} == expected
+    heights = np.arange(size * 3)
+    assert game.get_mip_levels(size, heights).tolist() == [game.get_mip_level(size, height) for height in heights]
+    monkeypatch.setattr(game, 'MIP_LEVELS', 0)
+    assert game.get_mip_level(size, 1) == 0 and not game.get_mip_levels(size, heights).any()
+
+
+def test_mip_level_for_distance(game):
+    # Walls drawn at half texture size or smaller use level 1, and every time their distance doubles from there
+    # they use the next level
+    full_size_dist = game.Drawable.constant / game.TEXTURE_SIZE
+    walls = game.ColumnLayer(game.R_W)
+    dists = np.array([0.9, 1.9, 2.1, 4.1, 8.1, 100]) * full_size_dist
+    count = dists.size
+    walls.add_many(np.arange(count), dists, np.zeros(count), np.zeros(count), np.zeros(count), np.zeros(count),
+                   np.zeros(count, dtype=bool))
+    walls.finish()
+    assert game.get_mip_levels(game.TEXTURE_SIZE, walls.height[:count]).tolist() == [0, 0, 1, 2, 3, 3]
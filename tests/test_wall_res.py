@@ -0,0 +1,46 @@
+import pytest
+
+
+@pytest.fixture
+def governor(game):
+    return game.WallResGovernor()
+
+
+def run(game, governor, frames, frame_time, column_time):
+    # Returns WALL_RES after every frame
+    wall_res = []
+    for _ in range(frames):
+        governor.update(frame_time, column_time)
+        wall_res.append(game.WALL_RES)
+    return wall_res
+
+
+def test_steps_up_when_wall_columns_are_slow(game, governor):
+    cooldown = game.WallResGovernor.cooldown_frames
+    wall_res = run(game, governor, cooldown * 2 + 2, 0.05, 0.04)
+    # Waits out the cooldown, goes up, and waits again before the next step
+    assert wall_res == [1] * cooldown + [2] * (cooldown + 1) + [3]
+
+
+def test_stays_when_something_else_is_slow(game, governor):
+    # Raising WALL_RES would save 0.0025s of a 0.02s overrun
+    assert set(run(game, governor, 100, 0.05, 0.005)) == {1}
+
+
+def test_stops_at_max_wall_res(game, governor, monkeypatch):
+    monkeypatch.setattr(game, 'MAX_WALL_RES', 2)
+    assert run(game, governor, 200, 0.05, 0.04)[-1] == 2
+
+
+def test_steps_down_when_frames_are_fast(game, governor, monkeypatch):
+    monkeypatch.setattr(game, 'WALL_RES', 3)
+    cooldown = game.WallResGovernor.cooldown_frames
+    wall_res = run(game, governor, cooldown * 3, 0.01, 0.005)
+    assert wall_res[cooldown] == 2
+    assert wall_res[-1] == 1  # Never below the WALL_RES the game started with
+
+
+def test_holds_between_thresholds(game, governor, monkeypatch):
+    monkeypatch.setattr(game, 'WALL_RES', 2)
+    # Fast enough not to go up, but going down would take the frame over lower_threshold of the budget
+    assert set(run(game, governor, 200, 0.025, 0.01)) == {2}
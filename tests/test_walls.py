@@ -0,0 +1,204 @@
+import numpy as np
+import pytest
+
+
+@pytest.fixture
+def walls(game):
+    return game.ColumnLayer(game.R_W)
+
+
+def add_columns(walls, display_xs, perp_dist=2.0, texture_id=1, columns=None, face=(3, 4, True)):
+    count = len(display_xs)
+    walls.add_many(np.array(display_xs), np.full(count, perp_dist), np.full(count, texture_id),
+                   np.arange(count) if columns is None else np.array(columns),
+                   np.full(count, face[0]), np.full(count, face[1]), np.full(count, face[2]))
+
+
+def test_spans_merge_columns_on_same_tile_side(game, walls):
+    add_columns(walls, range(0, 4), columns=range(10, 14))
+    add_columns(walls, range(4, 8), columns=range(14, 18), face=(3, 4, False))  # Other side of the same tile
+    add_columns(walls, range(8, 10), columns=range(0, 2), face=(4, 4, True))  # Neighbouring tile
+    add_columns(walls, range(10, 12), columns=range(2, 4), face=(-1, 0, False))  # Doors are never merged
+    walls.finish()
+    assert game.get_wall_spans(walls) == [(0, 4), (4, 8), (8, 10), (10, 11), (11, 12)]
+
+
+def test_spans_split_on_gaps_height_and_texture_wrap(game, walls):
+    add_columns(walls, [0, 1, 3, 4], columns=[10, 11, 12, 13])  # Gap where a column is missing
+    add_columns(walls, [5, 6], columns=[20, 2])  # Texture starts over
+    walls.finish()
+    walls.height[3] += game.SPAN_HEIGHT_TOLERANCE + 1
+    assert game.get_wall_spans(walls) == [(0, 2), (2, 3), (3, 4), (4, 5), (5, 6)]
+
+
+def test_spans_off(game, walls, monkeypatch):
+    monkeypatch.setattr(game, 'SPAN_MERGING', False)
+    add_columns(walls, range(3))
+    walls.finish()
+    assert game.get_wall_spans(walls) == [(0, 1), (1, 2), (2, 3)]
+
+
+def test_clear_and_add(game, walls):
+    assert walls.size == game.R_W  # One column for every ray
+    add_columns(walls, [5, 2], perp_dist=4.0)
+    walls.finish()
+    assert walls.count == 2
+    assert walls.display_x[:2].tolist() == [2, 5]  # Sorted by display_x
+    assert walls.column[:2].tolist() == [1, 0]
+    assert walls.height[:2].tolist() == [int(game.Drawable.constant / 4)] * 2
+
+    walls.add_missed([7])
+    walls.clear()
+    assert walls.count == 0 and not walls.missed.any()
+    add_columns(walls, [9])
+    walls.finish()
+    assert walls.count == 1 and walls.display_x[0] == 9
+
+
+def test_grows_past_size(game, walls):
+    add_columns(walls, list(range(game.R_W)) * 2)
+    assert walls.size == game.R_W * 2
+    walls.finish()
+    assert walls.count == game.R_W * 2
+
+
+def test_depth_array(game, walls, monkeypatch):
+    monkeypatch.setattr(game, 'WALL_RES', 2)
+    add_columns(walls, [0, 2], perp_dist=3.0)
+    add_columns(walls, [game.R_W - 1], perp_dist=5.0)  # Partly off screen
+    walls.add_missed([4])
+    walls.finish()
+    depth = walls.depth_array
+    assert depth[:4].tolist() == [3.0] * 4
+    assert depth[4:6].tolist() == [np.inf] * 2
+    assert depth[6:game.R_W - 1].tolist() == [0] * (game.R_W - 7)
+    assert depth[game.R_W - 1] == 5.0
+
+
+ROOM = ['#######',
+        '#.....#',
+        '#.....#',
+        '#######']
+
+
+def test_depth_array_after_send_rays(make_level):
+    game = make_level(ROOM, (1.5, 1.5))
+    game.send_rays()
+    walls = game.WALLS
+    assert walls.count == game.R_W
+    assert walls.depth_array.tolist() == walls.perp_dist[:walls.count].tolist()
+    assert walls.depth_array[game.H_W] == pytest.approx(4.5)  # Straight ahead to the right wall
+    assert (walls.depth_array < 4.5 + 1e-9).all()
+    assert not game.BLUE_PORTAL_WALLS.count and not game.BLUE_PORTAL_WALLS.depth_array.any()
+
+
+def test_walls_are_reused_until_something_changes(make_level, monkeypatch):
+    game = make_level(ROOM, (1.5, 1.5))
+    game.send_rays()
+    game.send_rays()
+    assert game.WALLS_REUSED
+
+    changes = [
+        lambda: game.update_tile_offset(6, 1, 0.5),  # Doors and push walls moving
+        lambda: setattr(game.PLAYER, 'x', 2.0),
+        lambda: (game.PLAYER.rotate(0.1), game.PLAYER.update_direction()),
+        lambda: monkeypatch.setattr(game, 'RAYCASTER', 'scalar'),
+        lambda: monkeypatch.setattr(game, 'WALL_RES', 2),
+    ]
+    for change in changes:
+        change()
+        game.send_rays()
+        assert not game.WALLS_REUSED
+        game.send_rays()
+        assert game.WALLS_REUSED
+
+
+def test_wall_snapshot_is_dropped_when_walls_change(make_level, monkeypatch):
+    game = make_level(ROOM, (1.5, 1.5))
+    sky = game.pygame.Surface((game.R_W * 2, game.H_H))
+    monkeypatch.setattr(game, 'LEVEL', type('Level', (), {'skytexture': sky}), raising=False)
+    monkeypatch.setattr(game, 'draw_hud', lambda: None)
+
+    def draw():
+        game.send_rays()
+        game.SPRITE_PROJECTION.project(game.WALLS)
+        game.draw_frame()
+        return game.pygame.surfarray.array3d(game.VIEW)
+
+    first = draw()
+    assert game.WALL_SNAPSHOT.image is None  # Walls weren't reused yet
+    assert (draw() == first).all()
+    snapshot = game.WALL_SNAPSHOT.image
+    assert snapshot is not None
+    assert (draw() == first).all()
+    assert game.WALL_SNAPSHOT.image is snapshot
+
+    game.update_tile_offset(6, 1, 0.5)
+    game.send_rays()
+    game.draw_frame()
+    assert game.WALL_SNAPSHOT.image is None
+
+
+def test_parallel_raycaster_without_workers_casts_like_vectorized(make_level, monkeypatch):
+    game = make_level(ROOM, (1.5, 1.5))
+    game.send_rays()
+    expected = game.WALLS.perp_dist[:game.WALLS.count].copy()
+    monkeypatch.setattr(game, 'RAYCASTER', 'parallel')
+    monkeypatch.setattr(game, 'RAYCAST_WORKER_COUNT', 1, raising=False)
+    game.send_rays()
+    assert game.RAYCAST_POOL is None
+    assert (game.WALLS.perp_dist[:game.WALLS.count] == expected).all()
+
+
+HALL = ['#################',
+        '#...............#',
+        '#...............#',
+        '#################']
+
+
+@pytest.mark.parametrize('raycaster', ['scalar', 'vectorized'])
+def test_rays_past_max_draw_dist_are_missed(make_level, monkeypatch, raycaster):
+    game = make_level(HALL, (1.5, 1.5), 0.013)
+    monkeypatch.setattr(game, 'RAYCASTER', raycaster)
+    monkeypatch.setattr(game, 'MAX_DRAW_DIST', 5)
+    game.send_rays()
+    walls = game.WALLS
+    depth = walls.depth_array
+    # Down the hall the end wall is 14.5 away, walls to the sides are close
+    assert depth[game.H_W] == np.inf
+    assert np.isinf(depth).any() and np.isfinite(depth).any()
+    assert (depth[np.isfinite(depth)] < 5).all()
+    # Missed rays add no columns, so no wall layer draws anything there
+    assert walls.count == np.isfinite(depth).sum()
+    assert not set(np.flatnonzero(np.isinf(depth)).tolist()) & set(walls.display_x[:walls.count].tolist())
+    drawn = {x for first, end in game.get_wall_spans(walls) for x in walls.display_x[first:end].tolist()}
+    assert drawn == set(np.flatnonzero(np.isfinite(depth)).tolist())
+
+
+def test_see_through_columns_by_opacity(game, make_texture, monkeypatch):
+    # Columns of the texture are fully transparent, opaque and half transparent in pairs, so mip level 1 has them too
+    clear, red, glass = (0, 0, 0, 0), (255, 0, 0, 255), (0, 255, 0, 128)
+    texture = make_texture([clear, clear, red, red, glass, glass], alpha=True)
+    strips = game.TextureStrips([texture])
+    monkeypatch.setattr(game, 'TEXTURE_STRIPS', strips, raising=False)
+    opaque_id = strips.opaque_ids[0]
+    assert opaque_id != 0 and not strips.alpha[opaque_id]
+
+    near, far = 0.5, game.Drawable.constant / game.TEXTURE_SIZE * 3  # Drawn at mip levels 0 and 1
+    for dist, level in ((near, 0), (far, 1)):
+        walls = game.ColumnLayer(game.R_W, see_through=True)
+        add_columns(walls, [10, 11, 12], perp_dist=dist, texture_id=0, columns=[0, 2, 4])
+        walls.finish()
+        assert game.get_mip_levels(game.TEXTURE_SIZE, walls.height[:walls.count]).tolist() == [level] * 2
+        # Transparent column is dropped, opaque one is drawn from the copy without alpha and hides what's behind it
+        assert walls.count == 2
+        assert walls.display_x[:2].tolist() == [11, 12]
+        assert walls.texture_id[:2].tolist() == [opaque_id, 0]
+        assert walls.depth_array[10:13].tolist() == [0, dist, 0]
+
+        game.VIEW.fill((0, 0, 255))
+        walls.draw_columns(np.arange(walls.count))
+        assert game.VIEW.get_at((10, game.H_H)) == (0, 0, 255, 255)
+        assert game.VIEW.get_at((11, game.H_H)) == red
+        green, blue = game.VIEW.get_at((12, game.H_H))[1:3]
+        assert 0 < green < 255 and 0 < blue < 255  # Blended over what's behind it